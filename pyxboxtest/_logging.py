@@ -0,0 +1,147 @@
+"""Logging used throughout pyxboxtest. Output is split into channels that can
+be configured separately:
+
+- pyxboxtest.kd: kernel debug output that has been read
+- pyxboxtest.input: controller input and resets sent to XQEMU
+- pyxboxtest.xqemu: starting and stopping XQEMU
+"""
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+KD_LOGGER = logging.getLogger("pyxboxtest.kd")
+INPUT_LOGGER = logging.getLogger("pyxboxtest.input")
+XQEMU_LOGGER = logging.getLogger("pyxboxtest.xqemu")
+
+CHANNEL_LOGGERS = {"kd": KD_LOGGER, "input": INPUT_LOGGER, "xqemu": XQEMU_LOGGER}
+
+
+class XQEMULogRateLimitFilter(logging.Filter):
+    """Drops records from a logger once it logs more than a certain number per
+    second, so that a chatty app can't slow the tests down. Counts the records
+    that it drops.
+    """
+
+    def __init__(self, records_per_second: float, burst: Optional[int] = None):
+        """:param records_per_second: the sustained rate that is allowed
+        :param burst: how many records may be logged at once before the rate \
+            limit applies, defaults to one second's worth
+        """
+        super().__init__()
+        if records_per_second <= 0:
+            raise ValueError("records_per_second must be positive")
+        self._records_per_second = records_per_second
+        self._burst = burst if burst is not None else max(records_per_second, 1)
+        self._lock = threading.Lock()
+        # Token bucket for each logger: (tokens, time last topped up)
+        self._buckets: Dict[str, List[float]] = {}
+        self._num_dropped: Dict[str, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.setdefault(record.name, [self._burst, now])
+            bucket[0] = min(
+                self._burst, bucket[0] + (now - bucket[1]) * self._records_per_second
+            )
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True
+            self._num_dropped[record.name] = self._num_dropped.get(record.name, 0) + 1
+            return False
+
+    def get_num_dropped(self) -> Dict[str, int]:
+        """:returns: how many records have been dropped for each logger"""
+        with self._lock:
+            return dict(self._num_dropped)
+
+
+class _DeferredFormattingQueueHandler(logging.handlers.QueueHandler):
+    """Leaves formatting the message to the listener's thread. pyxboxtest
+    never changes the arguments of a record after logging it
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class XQEMULoggingSetup:
+    """Applies a logging configuration to pyxboxtest's channels and undoes it
+    when closed
+    """
+
+    def __init__(
+        self,
+        levels: Optional[Dict[str, str]] = None,
+        max_records_per_second: Optional[float] = None,
+        log_filename: Optional[str] = None,
+    ):
+        """:param levels: the level of each channel (kd, input or xqemu). The \
+            key "pyxboxtest" sets the default for every channel
+        :param max_records_per_second: rate limit for each channel
+        :param log_filename: if given, records are written to this file by a \
+            background thread instead of being passed on to pytest
+        :raises ValueError: if a channel or level doesn't exist
+        """
+        self._root_logger = logging.getLogger("pyxboxtest")
+        self._loggers = {"pyxboxtest": self._root_logger, **CHANNEL_LOGGERS}
+        self._original_levels = {
+            name: logger.level for name, logger in self._loggers.items()
+        }
+        for name, level in (levels or {}).items():
+            if name not in self._loggers:
+                raise ValueError(
+                    f"Unknown logging channel {name}, "
+                    + f"expected one of {tuple(self._loggers)}"
+                )
+            self._loggers[name].setLevel(level.upper())
+
+        self.rate_limit_filter: Optional[XQEMULogRateLimitFilter] = None
+        if max_records_per_second is not None:
+            self.rate_limit_filter = XQEMULogRateLimitFilter(max_records_per_second)
+            for logger in CHANNEL_LOGGERS.values():
+                logger.addFilter(self.rate_limit_filter)
+
+        self._queue_handler: Optional[_DeferredFormattingQueueHandler] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._file_handler: Optional[logging.FileHandler] = None
+        if log_filename is not None:
+            # Formatting and writing happen in the listener's thread so the
+            # thread that is running the test only has to queue each record
+            record_queue: queue.SimpleQueue = queue.SimpleQueue()
+            self._file_handler = logging.FileHandler(log_filename)
+            self._file_handler.setFormatter(
+                logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+            )
+            self._listener = logging.handlers.QueueListener(
+                record_queue, self._file_handler, respect_handler_level=True
+            )
+            self._queue_handler = _DeferredFormattingQueueHandler(record_queue)
+            self._root_logger.addHandler(self._queue_handler)
+            self._root_logger.propagate = False
+            self._listener.start()
+
+    def get_num_dropped(self) -> Dict[str, int]:
+        """:returns: how many records were dropped by the rate limit for each \
+            channel
+        """
+        if self.rate_limit_filter is None:
+            return {}
+        return self.rate_limit_filter.get_num_dropped()
+
+    def close(self) -> None:
+        """Flush any queued records and restore the original configuration"""
+        if self._listener is not None:
+            self._root_logger.removeHandler(self._queue_handler)
+            self._root_logger.propagate = True
+            self._listener.stop()
+            self._file_handler.close()
+        if self.rate_limit_filter is not None:
+            for logger in CHANNEL_LOGGERS.values():
+                logger.removeFilter(self.rate_limit_filter)
+        for name, level in self._original_levels.items():
+            self._loggers[name].setLevel(level)
@@ -1,9 +1,12 @@
 """A collection of utility functions required by pyxboxtest but are not a part of the framework"""
+from contextlib import contextmanager
 from ftplib import FTP
+import os
 import re
 import socket
+import tempfile
 import time
-from typing import Any, Callable, Set
+from typing import Any, Callable, Dict, Iterator, Set
 
 
 def validate_xbox_file_path(path: str) -> None:
@@ -69,15 +72,148 @@ def retry_every(
             time.sleep(delay_before_retry)
 
 
+def _get_port_lease_dir() -> str:
+    """:returns: the directory of the current user's port leases. Other \
+        users' lease files can't be locked (or even created) by this user, \
+        on Windows the temporary directory is already per user
+    """
+    if hasattr(os, "getuid"):
+        return os.path.join(
+            tempfile.gettempdir(), f"pyxboxtest_port_leases_{os.getuid()}"
+        )
+    return os.path.join(tempfile.gettempdir(), "pyxboxtest_port_leases")
+
+
+# Shared by every process of this user so that ports reserved by one process
+# (e.g. a pytest-xdist worker) are never given to another
+_PORT_LEASE_DIR = _get_port_lease_dir()
+
+
+# The lease files of this process that it holds locks on, by port
+_lease_fds: Dict[int, int] = {}
+
+if os.name == "posix":
+    import fcntl
+
+    def _try_to_lock(fd: int) -> bool:
+        """:returns: True if this process now holds the lock on the file"""
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def _lock(fd: int) -> None:
+        """Wait until this process holds the lock on the file"""
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+    def _unlock(fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+else:
+    import msvcrt  # pylint: disable=import-error
+
+    def _try_to_lock(fd: int) -> bool:
+        """:returns: True if this process now holds the lock on the file"""
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def _lock(fd: int) -> None:
+        """Wait until this process holds the lock on the file"""
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass  # Gave up after 10 seconds, keep waiting
+
+    def _unlock(fd: int) -> None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def locked_file(filename: str) -> Iterator[None]:
+    """Hold an exclusive lock on a file, shared by every process on this \
+        machine, for the duration of the with block. The file is created if \
+        it doesn't exist and is left behind.
+    """
+    fd = os.open(filename, os.O_CREAT | os.O_RDWR)
+    try:
+        _lock(fd)
+        try:
+            yield
+        finally:
+            _unlock(fd)
+    finally:
+        os.close(fd)
+
+
+def _try_to_lease_port(port: int) -> bool:
+    """Lock the lease file for the port. The OS drops the lock when the process
+    exits, so leases left behind by processes that have died are free without
+    having to check whether a process still exists.
+
+    :returns: True if this process now holds the lease
+    """
+    lease_path = os.path.join(_PORT_LEASE_DIR, f"{port}.lease")
+    try:
+        lease_fd = os.open(lease_path, os.O_CREAT | os.O_RDWR)
+    except FileNotFoundError:
+        os.makedirs(_PORT_LEASE_DIR, exist_ok=True)
+        return _try_to_lease_port(port)
+    try:
+        # The holder may have released the lease and removed the file after
+        # we opened it, a lock on a removed file is no lease at all
+        is_leased = _try_to_lock(lease_fd) and os.path.samestat(
+            os.fstat(lease_fd), os.stat(lease_path)
+        )
+    except FileNotFoundError:
+        is_leased = False
+    if not is_leased:
+        os.close(lease_fd)
+        return False
+    # Only for people wondering who holds the lease
+    os.ftruncate(lease_fd, 0)
+    os.write(lease_fd, str(os.getpid()).encode())
+    _lease_fds[port] = lease_fd
+    return True
+
+
+def _release_port_lease(port: int) -> None:
+    """Give up the lease on the port, if this process holds it"""
+    lease_fd = _lease_fds.pop(port, None)
+    if lease_fd is None:
+        return
+    lease_path = os.path.join(_PORT_LEASE_DIR, f"{port}.lease")
+    if os.name != "posix":
+        # Windows can't remove open files. If another process opens it in the
+        # meantime it is left for them
+        os.close(lease_fd)
+    try:
+        # On POSIX it is removed whilst still locked, see _try_to_lease_port
+        os.remove(lease_path)
+    except OSError:
+        pass
+    if os.name == "posix":
+        os.close(lease_fd)
+
+
 class UnusedPort:
     """Used to obtain a unique port that is not in use by the OS or
-    "reserved for use" in this app
+    "reserved for use" by any process using pyxboxtest on this machine
 
     Once a port has been reserved by instantiating an object of this class it
-    will not be given again until after the object is destroyed
+    will not be given again until after it is released, either explicitly with
+    :py:meth:`release` (or by using it as a context manager) or when the
+    object is destroyed.
     """
 
     _reserved_ports: Set[int] = set()
+    _num_collisions = 0
 
     def __init__(self):
         unused_socks = []
@@ -85,10 +221,13 @@ class UnusedPort:
         sock.bind(("", 0))
 
         # Make sure that we are not using a port that has already
-        # been marked as in use!
+        # been marked as in use by us or another process!
         # Keep the "bound sock" around so that OS won't just
         # keep allocating us the same socket though
-        while sock.getsockname()[1] in UnusedPort._reserved_ports:
+        while sock.getsockname()[1] in UnusedPort._reserved_ports or (
+            not _try_to_lease_port(sock.getsockname()[1])
+        ):
+            UnusedPort._num_collisions += 1
             unused_socks.append(sock)
             sock = socket.socket()
             sock.bind(("", 0))
@@ -99,9 +238,27 @@ class UnusedPort:
 
         self._port_number = sock.getsockname()[1]
         UnusedPort._reserved_ports.add(self._port_number)
+        self._released = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
 
     def __del__(self):
-        UnusedPort._reserved_ports.remove(self._port_number)
+        self.release()
+
+    def release(self) -> None:
+        """Allow the port to be given out again. Safe to call more than once"""
+        if getattr(self, "_released", True):
+            return
+        self._released = True
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        UnusedPort._reserved_ports.discard(self._port_number)
+        _release_port_lease(self._port_number)
 
     def get_port_number(self) -> int:
         """The number of the port"""
@@ -110,3 +267,10 @@ class UnusedPort:
             self._sock.close()
         self._sock = None
         return self._port_number
+
+    @staticmethod
+    def get_num_collisions() -> int:
+        """:returns: how many times a port that the OS offered was already \
+            reserved, by this process or another
+        """
+        return UnusedPort._num_collisions
@@ -1,28 +1,152 @@
-"""Pytest specific setup, currently just adds the headless option to pytest"""
+"""Pytest specific setup, adds pyxboxtest's options to pytest and provides
+session wide fixtures
+"""
+import os
+from typing import Dict, Iterator, List, Optional
+
 import pytest
 
-from .xqemu._xqemu_temporary_directories import _initialise_temp_dirs
-from .xqemu.xqemu_params import XQEMUFirmware
+from ._logging import XQEMULoggingSetup
+from ._utils import UnusedPort
+from .xqemu._xqemu_temporary_directories import _initialise_temp_dirs, get_temp_dirs
+from .xqemu.xqemu_kd_hub import XQEMUKDHub, close_shared_kd_hub, get_shared_kd_hub
+from .xqemu.xqemu_params import XQEMUChannelTransport, XQEMUFirmware
+from .xqemu.xqemu_vm_pool import XQEMUVMPool
+from .xqemu.screen.xqemu_golden_images import XQEMUGoldenImageStore
+from .xqemu.screen.xqemu_screenshot_store import XQEMUScreenshotStore
 from .xqemu.xqemu_xbox_app_runner import (
     XQEMUXboxAppRunner,
     _XQEMUXboxAppRunnerGlobalParams,
+    _save_recordings,
+    _start_taking_new_screenshots,
+    _take_new_screenshots,
 )
 
+# Kept so that the pool's stats can be reported at the end of the session
+_session_vm_pool: Optional[XQEMUVMPool] = None
+# Kept so that the hub's stats can be reported at the end of the session
+_session_kd_hub: Optional[XQEMUKDHub] = None
+_logging_setup: Optional[XQEMULoggingSetup] = None
+# Compresses the screenshots saved by each test once it has finished
+_screenshot_store: Optional[XQEMUScreenshotStore] = None
+
+
+def _parse_log_levels(log_levels: List[str]) -> Dict[str, str]:
+    """:param log_levels: e.g. ["kd=WARNING", "DEBUG"], a level on its own \
+        applies to every channel
+    """
+    levels = {"pyxboxtest": "INFO"}
+    for log_level in log_levels:
+        channel, _, level = log_level.rpartition("=")
+        levels[channel or "pyxboxtest"] = level
+    return levels
+
+
+def pytest_configure(config):
+    """Set up pyxboxtest's logging"""
+    global _logging_setup  # pylint: disable=global-statement
+    rate_limit = config.getoption("--xqemu-log-rate-limit")
+    _logging_setup = XQEMULoggingSetup(
+        _parse_log_levels(config.getoption("--xqemu-log-level")),
+        rate_limit if rate_limit > 0 else None,
+        config.getoption("--xqemu-log-file"),
+    )
+
+
+def pytest_unconfigure(config):  # pylint: disable=unused-argument
+    """Make sure that all of the logs are written"""
+    if _logging_setup is not None:
+        _logging_setup.close()
+
+
+def pytest_runtest_logfinish(nodeid, location):  # pylint: disable=unused-argument
+    """Compress the test's screenshots in the background, nothing can use them
+    once it has finished
+    """
+    if _screenshot_store is not None:
+        for screenshot_path in _take_new_screenshots():
+            _screenshot_store.add(screenshot_path, nodeid)
+
+
+def pytest_sessionfinish(session):  # pylint: disable=unused-argument
+    """Wait for the screenshots to be compressed and stop the KD hub thread"""
+    if _screenshot_store is not None:
+        _screenshot_store.close()
+    close_shared_kd_hub()
+
 
 @pytest.fixture(scope="session", autouse=True)
 def _initial_framework_setup(request, tmp_path_factory):
     """Never use this fixture directly!"""
+    global _screenshot_store  # pylint: disable=global-statement
     _initialise_temp_dirs(tmp_path_factory)
     XQEMUXboxAppRunner._global_params = _XQEMUXboxAppRunnerGlobalParams(
         XQEMUFirmware(
             request.config.getoption("--mcpx-rom"), request.config.getoption("--bios")
         ),
         request.config.getoption("--headless"),
+        channel_transport=XQEMUChannelTransport(
+            request.config.getoption("--xqemu-channel-transport")
+        ),
+        record_fps=request.config.getoption("--xqemu-record-fps"),
+    )
+    if not request.config.getoption("--xqemu-keep-raw-screenshots"):
+        _screenshot_store = XQEMUScreenshotStore(get_temp_dirs().screenshots_dir)
+        _start_taking_new_screenshots()
+
+
+@pytest.fixture(scope="session")
+def xqemu_vm_pool(request) -> Iterator[XQEMUVMPool]:
+    """A pool of booted instances of XQEMU shared by the whole session"""
+    global _session_vm_pool  # pylint: disable=global-statement
+    _session_vm_pool = XQEMUVMPool(request.config.getoption("--xqemu-vm-pool-size"))
+    try:
+        yield _session_vm_pool
+    finally:
+        _session_vm_pool.close()
+
+
+@pytest.fixture(scope="session")
+def xqemu_kd_hub() -> XQEMUKDHub:
+    """Drains the KD output of every instance of XQEMU that uses it from a
+    single thread, pass it to :py:class:`~pyxboxtest.xqemu.XQEMUXboxAppRunner`
+    """
+    global _session_kd_hub  # pylint: disable=global-statement
+    _session_kd_hub = get_shared_kd_hub()
+    return _session_kd_hub
+
+
+@pytest.fixture(scope="session")
+def xqemu_golden_images(request) -> XQEMUGoldenImageStore:
+    """The golden images that frames can be compared with"""
+    goldens_dir = request.config.getoption("--xqemu-goldens-dir")
+    if goldens_dir is None:
+        goldens_dir = os.path.join(str(request.config.rootdir), "xqemu_goldens")
+    return XQEMUGoldenImageStore(
+        goldens_dir,
+        get_temp_dirs().golden_diffs_dir,
+        request.config.getoption("--xqemu-update-goldens"),
     )
 
 
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):  # pylint: disable=unused-argument
+    """Save what the runners that are still recording saw when a test fails.
+    Runners used in a with block save it as they exit, so this catches the
+    ones from fixtures
+    """
+    outcome = yield
+    report = outcome.get_result()
+    if report.failed and report.when == "call":
+        # Not waited for, they are encoded in the background
+        for recording_path in _save_recordings():
+            report.sections.append(
+                ("pyxboxtest recording", f"Recording saved to {recording_path}")
+            )
+
+
 def pytest_addoption(parser):
-    """Add the headless option to pytest's command line option parser"""
+    """Add pyxboxtest's options to pytest's command line option parser"""
     parser.addoption(
         "--headless",
         action="store_true",
@@ -33,3 +157,107 @@ def pytest_addoption(parser):
         "--mcpx-rom", type=str, help="MCPX rom used to boot the xbox", required=True
     )
     parser.addoption("--bios", type=str, help="Xbox BIOS (kernel) image", required=True)
+    parser.addoption(
+        "--xqemu-channel-transport",
+        choices=tuple(transport.value for transport in XQEMUChannelTransport),
+        default=XQEMUChannelTransport.TCP_PORT.value,
+        help="How pyxboxtest connects to the KD and QMP channels of XQEMU",
+    )
+    parser.addoption(
+        "--xqemu-log-level",
+        action="append",
+        default=[],
+        help="Log level for pyxboxtest's logging channels (kd, input or xqemu) "
+        + "e.g. kd=WARNING. A level on its own applies to every channel. "
+        + "Defaults to INFO",
+    )
+    parser.addoption(
+        "--xqemu-log-rate-limit",
+        type=float,
+        default=1000,
+        help="Maximum log records per second for each channel, extra records "
+        + "are dropped. 0 means no limit. KD logs on disk are not affected",
+    )
+    parser.addoption(
+        "--xqemu-log-file",
+        type=str,
+        default=None,
+        help="Write pyxboxtest's logs to this file from a background thread "
+        + "rather than passing them on to pytest",
+    )
+    parser.addoption(
+        "--xqemu-goldens-dir",
+        type=str,
+        default=None,
+        help="Directory of golden images for the xqemu_golden_images fixture, "
+        + "defaults to xqemu_goldens in pytest's root directory",
+    )
+    parser.addoption(
+        "--xqemu-update-goldens",
+        action="store_true",
+        default=False,
+        help="Save frames that don't match their golden images as the new goldens",
+    )
+    parser.addoption(
+        "--xqemu-record-fps",
+        type=float,
+        default=0,
+        help="Record the screen this many times a second, the last frames are "
+        + "saved as an animated PNG when a test fails. 0 means don't record",
+    )
+    parser.addoption(
+        "--xqemu-keep-raw-screenshots",
+        action="store_true",
+        default=False,
+        help="Keep screenshots as PPMs rather than replacing them with PNGs "
+        + "(stored once per distinct image) when each test finishes",
+    )
+    parser.addoption(
+        "--xqemu-vm-pool-size",
+        type=int,
+        default=1,
+        help="Number of idle instances of XQEMU kept by the pool for each "
+        + "firmware/RAM size/headless combination",
+    )
+
+
+def pytest_terminal_summary(terminalreporter):
+    """Report how well the VM pool, KD hub, logging, port allocation and
+    screenshot compression did
+    """
+    if UnusedPort.get_num_collisions():
+        terminalreporter.write_line(
+            f"pyxboxtest port allocation: {UnusedPort.get_num_collisions()} "
+            + "ports were skipped as they were already reserved"
+        )
+    if _session_vm_pool is not None:
+        stats = _session_vm_pool.get_stats()
+        terminalreporter.write_line(
+            f"pyxboxtest VM pool: {stats.hits} hits, {stats.misses} misses"
+        )
+    if _session_kd_hub is not None:
+        all_stats = _session_kd_hub.get_stats().values()
+        terminalreporter.write_line(
+            f"pyxboxtest KD hub: {len(all_stats)} instances of XQEMU, "
+            + f"{sum(stats.bytes_received for stats in all_stats)} bytes, "
+            + f"{sum(stats.lines_dropped for stats in all_stats)} lines dropped"
+        )
+    num_dropped = {} if _logging_setup is None else _logging_setup.get_num_dropped()
+    dropped = [
+        f"{channel.rsplit('.', 1)[-1]}: {count}"
+        for channel, count in sorted(num_dropped.items())
+        if count
+    ]
+    if dropped:
+        terminalreporter.write_line(
+            "pyxboxtest logging: records dropped by the rate limit, "
+            + ", ".join(dropped)
+        )
+    if _screenshot_store is not None and _screenshot_store.get_stats().num_screenshots:
+        stats = _screenshot_store.get_stats()
+        terminalreporter.write_line(
+            f"pyxboxtest screenshots: {stats.num_screenshots} stored as "
+            + f"{stats.num_blobs} PNGs, {stats.raw_bytes / 2 ** 20:.1f} MB "
+            + f"compressed to {stats.stored_bytes / 2 ** 20:.1f} MB in "
+            + get_temp_dirs().screenshots_dir
+        )
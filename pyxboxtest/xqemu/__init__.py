@@ -6,11 +6,46 @@ and reading from the serial port.
 
 from .xqemu_controller_buttons import XQEMUXboxControllerButtons
 from .xqemu_ftp_client import XQEMUFTPClient
+from .xqemu_input_timeline import (
+    XQEMUInputBatch,
+    XQEMUInputEvent,
+    XQEMUInputTimeline,
+    XQEMUInputTimelineReport,
+    play_input_timeline,
+)
+from .xqemu_kd_log import XQEMUKDLog, XQEMUKDLogMatch
+from .xqemu_kd_telemetry import (
+    XQEMUKDTelemetry,
+    XQEMUKDTelemetryAssertionError,
+    XQEMUKDTelemetryMarker,
+)
+from .xqemu_kd_ring_buffer import XQEMUKDCursor, XQEMUKDLine, XQEMUKDRingBuffer
+from .xqemu_kd_hub import (
+    XQEMUKDHub,
+    XQEMUKDHubStats,
+    close_shared_kd_hub,
+    get_shared_kd_hub,
+)
+from .xqemu_kd_expect import XQEMUKDExpectTimeoutError, XQEMUKDMatch
+from .xqemu_kd_records import XQEMUKDInvalidRecordError, XQEMUKDRecordTimeoutError
 from .xqemu_kd_capturer import XQEMUKDCapturer
 from .xqemu_params import (
+    XQEMUChannelTransport,
     XQEMUFirmware,
     NetworkTransportProtocol,
     XQEMUNetworkForwardRule,
     XQEMURAMSize,
 )
+from .xqemu_readiness import (
+    XQEMUExitedError,
+    XQEMUReadinessMonitor,
+    XQEMUReadinessTimeoutError,
+)
 from .xqemu_xbox_app_runner import XQEMUXboxAppRunner
+from .xqemu_async_xbox_app_runner import (
+    AsyncQEMUMonitorProtocol,
+    AsyncXQEMUFTPClient,
+    AsyncXQEMUKDCapturer,
+    AsyncXQEMUXboxAppRunner,
+)
+from .xqemu_vm_pool import XQEMUVMPool, XQEMUVMPoolStats
@@ -2,8 +2,20 @@
 
 Uses the directory given by pytest as the root
 """
+import atexit
+import os
+import shutil
+import tempfile
 from typing import NamedTuple
 
+# Unix socket paths are limited to 108 bytes on Linux (104 on macOS).
+# Leave room for the per instance subdirectory and the socket filename
+_MAX_SOCKETS_DIR_LENGTH = 80
+
+# Frames grabbed from the screen are only on disk for a moment so keep them
+# in memory where possible
+_SHARED_MEMORY_DIR = "/dev/shm"
+
 
 class _TemporaryDirectories(NamedTuple):
     """Immutable storage for the temporary directories"""
@@ -11,6 +23,11 @@ class _TemporaryDirectories(NamedTuple):
     hdd_images_dir: str
     hdd_templates_dir: str
     screenshots_dir: str
+    sockets_dir: str
+    kd_logs_dir: str
+    frames_dir: str
+    golden_diffs_dir: str
+    recordings_dir: str
 
 
 def get_temp_dirs() -> _TemporaryDirectories:
@@ -37,4 +54,31 @@ def _initialise_temp_dirs(tmp_path_factory) -> None:
         tmp_path_factory.mktemp("xqemu_hdd_images", numbered=False),
         tmp_path_factory.mktemp("xqemu_hdd_template_images", numbered=False),
         tmp_path_factory.mktemp("xqemu_screenshots", numbered=False),
+        _get_sockets_dir(tmp_path_factory),
+        tmp_path_factory.mktemp("xqemu_kd_logs", numbered=False),
+        _get_frames_dir(tmp_path_factory),
+        tmp_path_factory.mktemp("xqemu_golden_diffs", numbered=False),
+        tmp_path_factory.mktemp("xqemu_recordings", numbered=False),
     )
+
+
+def _get_sockets_dir(tmp_path_factory) -> str:
+    """:returns: a directory for Unix sockets, outside of pytest's temp dir \
+        if that is too deeply nested for a socket path
+    """
+    sockets_dir = str(tmp_path_factory.mktemp("xqemu_sockets", numbered=False))
+    if len(sockets_dir) > _MAX_SOCKETS_DIR_LENGTH:
+        sockets_dir = tempfile.mkdtemp(prefix="pyxboxtest-")
+    return sockets_dir
+
+
+def _get_frames_dir(tmp_path_factory) -> str:
+    """:returns: a directory on a tmpfs for frames grabbed from the screen, \
+        in pytest's temp dir if there isn't a tmpfs
+    """
+    if os.path.isdir(_SHARED_MEMORY_DIR) and os.access(_SHARED_MEMORY_DIR, os.W_OK):
+        frames_dir = tempfile.mkdtemp(prefix="pyxboxtest-", dir=_SHARED_MEMORY_DIR)
+        # Nothing else will clean up the shared memory
+        atexit.register(shutil.rmtree, frames_dir, ignore_errors=True)
+        return frames_dir
+    return str(tmp_path_factory.mktemp("xqemu_frames", numbered=False))
@@ -0,0 +1,41 @@
+"""Tools for working with what XQEMU shows on screen"""
+from .xqemu_ppm import XQEMUPPMFormatError, load_ppm, load_ppms
+from .xqemu_png import (
+    XQEMUPNGFormatError,
+    decode_png,
+    encode_apng,
+    encode_png,
+    load_png,
+    save_apng,
+    save_png,
+)
+from .xqemu_screen_wait import (
+    XQEMUScreenRegion,
+    XQEMUScreenTimeoutError,
+    get_changed_fraction,
+    wait_for_screen_change,
+    wait_for_screen_stable,
+)
+from .xqemu_golden_images import (
+    XQEMUGoldenImageComparison,
+    XQEMUGoldenImageMismatchError,
+    XQEMUGoldenImageMissingError,
+    XQEMUGoldenImageStore,
+    get_hash_distance,
+    get_perceptual_hash,
+    get_ssim,
+)
+from .xqemu_template_matching import XQEMUTemplateMatch, find_template
+from .xqemu_ocr import (
+    XQEMUOCRCacheInfo,
+    XQEMUOCRReader,
+    preprocess_for_ocr,
+    tesseract_ocr,
+)
+from .xqemu_frame_recorder import XQEMUFrameRecorder, XQEMURecordedFrame
+from .xqemu_screenshot_store import XQEMUScreenshotStore, XQEMUScreenshotStoreStats
+from .xqemu_frame_rate import (
+    XQEMUFrameRateMeasurement,
+    XQEMUFrameStall,
+    measure_frame_rate,
+)
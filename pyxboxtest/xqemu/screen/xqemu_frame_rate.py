@@ -0,0 +1,116 @@
+"""Estimating how fast an app renders by sampling the screen as fast as
+possible and timing when it changes
+"""
+import time
+from typing import Callable, List, NamedTuple, Tuple
+import zlib
+
+import numpy as np
+
+_DEFAULT_STALL_TIME = 0.1
+# If nearly every sample is a new frame the app renders at least as fast as
+# the screen can be sampled, so the frame rate is only a lower bound
+_SAMPLE_LIMITED_FRACTION = 0.9
+
+
+class XQEMUFrameStall(NamedTuple):
+    """A time when the screen didn't change
+
+    :param start_time: seconds after the measurement started
+    :param duration: in seconds
+    """
+
+    start_time: float
+    duration: float
+
+
+class XQEMUFrameRateMeasurement(NamedTuple):
+    """How fast the screen changed
+
+    :param duration: how long the screen was watched for in seconds
+    :param num_samples: how many times the screen was sampled
+    :param num_frames: how many times it had changed when it was sampled
+    :param fps: frames per second. Frames that were replaced between two \
+        samples aren't seen, so if is_sample_limited this is a lower bound
+    :param sample_rate: samples per second, after the first one
+    :param mean_frame_time: seconds between changes, 0 if there were fewer \
+        than 2 changes
+    :param frame_time_variance: in seconds squared
+    :param max_frame_time: in seconds
+    :param stalls: times when the screen didn't change for longer than the \
+        stall time, including at the start and end of the measurement
+    :param is_sample_limited: whether nearly every sample was a new frame, \
+        i.e. the app may render faster than the screen can be sampled
+    """
+
+    duration: float
+    num_samples: int
+    num_frames: int
+    fps: float
+    sample_rate: float
+    mean_frame_time: float
+    frame_time_variance: float
+    max_frame_time: float
+    stalls: Tuple[XQEMUFrameStall, ...]
+    is_sample_limited: bool
+
+
+def _get_checksum(frame: np.ndarray) -> int:
+    """CRC-32 is much cheaper than a cryptographic hash and still covers \
+        every pixel, so that small changes (e.g. a spinner) are seen
+    """
+    return zlib.crc32(np.ascontiguousarray(frame).data)
+
+
+def measure_frame_rate(
+    grab_frame: Callable[[], np.ndarray],
+    duration: float = 5.0,
+    stall_time: float = _DEFAULT_STALL_TIME,
+) -> XQEMUFrameRateMeasurement:
+    """Watch the screen for a while to estimate the app's frame rate, e.g. \
+        to catch performance regressions. The screen is sampled back to back \
+        and only checksummed, so the measurement costs the guest little more \
+        than the screendumps themselves.
+
+    :param grab_frame: gets what is on screen now
+    :param duration: how long to watch the screen for in seconds
+    :param stall_time: report the screen not changing for longer than this, \
+        in seconds
+    """
+    last_checksum = _get_checksum(grab_frame())
+    start_time = last_sample_time = time.perf_counter()
+    end_time = start_time + duration
+    num_samples = 1
+    # When each new frame was first seen, estimated as halfway between that
+    # sample and the one before
+    change_times: List[float] = []
+    while last_sample_time < end_time:
+        checksum = _get_checksum(grab_frame())
+        sample_time = time.perf_counter()
+        num_samples += 1
+        if checksum != last_checksum:
+            change_times.append((last_sample_time + sample_time) / 2 - start_time)
+            last_checksum = checksum
+        last_sample_time = sample_time
+
+    measured_time = last_sample_time - start_time
+    frame_times = np.diff(change_times)
+    gaps = np.diff([0.0, *change_times, measured_time])
+    gap_starts = [0.0, *change_times]
+    return XQEMUFrameRateMeasurement(
+        measured_time,
+        num_samples,
+        len(change_times),
+        len(change_times) / measured_time if measured_time else 0.0,
+        (num_samples - 1) / measured_time if measured_time else 0.0,
+        float(frame_times.mean()) if frame_times.size else 0.0,
+        float(frame_times.var()) if frame_times.size else 0.0,
+        float(frame_times.max()) if frame_times.size else 0.0,
+        tuple(
+            XQEMUFrameStall(gap_start, float(gap))
+            for gap_start, gap in zip(gap_starts, gaps)
+            if gap > stall_time
+        ),
+        num_samples > 1
+        and len(change_times) >= (num_samples - 1) * _SAMPLE_LIMITED_FRACTION,
+    )
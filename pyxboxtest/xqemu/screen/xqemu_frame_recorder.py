@@ -0,0 +1,191 @@
+"""Records what is on screen in the background so that there is a clip of
+what led up to a test failing, not just a screenshot
+"""
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+import threading
+import time
+from typing import Callable, Deque, List, NamedTuple, Optional
+
+import numpy as np
+
+from ..._logging import XQEMU_LOGGER
+from .xqemu_png import save_apng
+
+_DEFAULT_FPS = 5.0
+_DEFAULT_MAX_FRAMES = 100
+
+
+class XQEMURecordedFrame(NamedTuple):
+    """A frame and how long it was on screen for
+
+    :param pixels: read only RGB pixels of shape (height, width, 3)
+    :param start_time: when it was first seen, from :py:func:`time.perf_counter`
+    :param duration: how long until the next frame, in seconds
+    """
+
+    pixels: np.ndarray
+    start_time: float
+    duration: float
+
+
+def _fit_to_canvas(pixels: np.ndarray, height: int, width: int) -> np.ndarray:
+    """Pad with black, the screen's resolution can change whilst recording"""
+    if pixels.shape[:2] == (height, width):
+        return pixels
+    canvas = np.zeros((height, width, pixels.shape[2]), pixels.dtype)
+    canvas[: pixels.shape[0], : pixels.shape[1]] = pixels
+    return canvas
+
+
+def _save_animation(filename: str, frames: List[XQEMURecordedFrame]) -> str:
+    height = max(frame.pixels.shape[0] for frame in frames)
+    width = max(frame.pixels.shape[1] for frame in frames)
+    save_apng(
+        filename,
+        [_fit_to_canvas(frame.pixels, height, width) for frame in frames],
+        [frame.duration for frame in frames],
+        compression_level=1,
+    )
+    return filename
+
+
+def _get_encoder() -> ThreadPoolExecutor:
+    """A single thread shared by all recorders, so that saving recordings \
+        never competes with the tests for more than one core. Python waits \
+        for its work to finish before exiting.
+    """
+    if _get_encoder.executor is None:
+        _get_encoder.executor = ThreadPoolExecutor(
+            1, thread_name_prefix="pyxboxtest-recording-encoder"
+        )
+    return _get_encoder.executor
+
+
+_get_encoder.executor = None
+
+
+class XQEMUFrameRecorder:
+    """Samples the screen from a background thread into a ring of the most \
+        recent frames. A frame that is the same as the one before it only \
+        makes that frame's duration longer, so a static screen costs one \
+        frame's memory however long it is shown for.
+    """
+
+    def __init__(
+        self,
+        grab_frame: Callable[[], np.ndarray],
+        fps: float = _DEFAULT_FPS,
+        max_frames: int = _DEFAULT_MAX_FRAMES,
+    ):
+        """:param grab_frame: gets what is on screen now, it must be safe to \
+            call from another thread
+        :param fps: how many times a second to sample the screen
+        :param max_frames: how many distinct frames to keep
+        """
+        if fps <= 0 or max_frames <= 0:
+            raise ValueError("fps and max_frames must be positive")
+        self._grab_frame = grab_frame
+        self._interval = 1 / fps
+        # Each is [pixels, digest, first seen, last seen]
+        self._frames: Deque[list] = deque(maxlen=max_frames)
+        self._num_samples = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self) -> None:
+        frame = self._grab_frame()
+        now = time.perf_counter()
+        digest = hashlib.sha1(np.ascontiguousarray(frame).data).digest()
+        with self._lock:
+            self._num_samples += 1
+            if self._frames and self._frames[-1][1] == digest:
+                self._frames[-1][3] = now
+                return
+        # Copied so that the ring doesn't hold the memory maps (and their file
+        # descriptors) open
+        pixels = np.array(frame)
+        pixels.flags.writeable = False
+        with self._lock:
+            self._frames.append([pixels, digest, now, now])
+
+    def _run(self) -> None:
+        next_sample_time = time.perf_counter()
+        failing = False
+        while not self._stop_event.wait(
+            max(next_sample_time - time.perf_counter(), 0)
+        ):
+            try:
+                self._sample()
+                failing = False
+            except Exception as e:  # pylint: disable=broad-except
+                # e.g. XQEMU isn't ready yet, or has exited
+                if not failing:
+                    XQEMU_LOGGER.debug("Failed to record a frame: %s", e)
+                failing = True
+            # Skip samples that there wasn't time for rather than catching up
+            next_sample_time = max(
+                next_sample_time + self._interval, time.perf_counter()
+            )
+
+    def start(self) -> None:
+        """Start recording, does nothing if already recording"""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="pyxboxtest-frame-recorder", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop recording, the frames are kept"""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def is_recording(self) -> bool:
+        """:returns: True if frames are being recorded"""
+        return self._thread is not None
+
+    def get_num_samples(self) -> int:
+        """:returns: how many times the screen has been sampled, including \
+            samples that were the same as the frame before
+        """
+        with self._lock:
+            return self._num_samples
+
+    def clear(self) -> None:
+        """Forget the recorded frames, e.g. when the next test starts"""
+        with self._lock:
+            self._frames.clear()
+            self._num_samples = 0
+
+    def get_frames(self) -> List[XQEMURecordedFrame]:
+        """:returns: the recorded frames, oldest first"""
+        with self._lock:
+            frames = [tuple(frame) for frame in self._frames]
+        # Each frame lasts until the next one, the last one at least as long
+        # as it has been seen for
+        end_times = [frame[2] for frame in frames[1:]]
+        if frames:
+            end_times.append(frames[-1][3] + self._interval)
+        return [
+            XQEMURecordedFrame(pixels, first_seen, end_time - first_seen)
+            for (pixels, _, first_seen, _), end_time in zip(frames, end_times)
+        ]
+
+    def save_recording(self, filename: str) -> Optional["Future[str]"]:
+        """Save the recorded frames as an animated PNG. It is encoded on a \
+            background thread, so this returns straight away.
+
+        :returns: the filename once it is saved, None if there are no frames
+        """
+        frames = self.get_frames()
+        if not frames:
+            return None
+        return _get_encoder().submit(_save_animation, filename, frames)
@@ -0,0 +1,379 @@
+"""Comparing frames with reference ("golden") images that are kept in a
+content addressed store, so that identical goldens used by many tests are
+only stored once
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Dict, NamedTuple, Optional
+
+import numpy as np
+
+from ..._utils import locked_file
+from .xqemu_png import load_png, save_png
+from .xqemu_screen_wait import XQEMUScreenRegion, _crop, get_changed_fraction
+
+# Size of the image that the perceptual hash is computed from
+_HASH_IMAGE_SIZE = 32
+# The low frequencies used for the hash, the top left of the DCT
+_HASH_SIZE = 8
+# Window size used for SSIM
+_SSIM_WINDOW = 7
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+
+
+class XQEMUGoldenImageMismatchError(AssertionError):
+    """A frame didn't match its golden image"""
+
+
+class XQEMUGoldenImageMissingError(AssertionError):
+    """There is no golden image with that name, run with \
+    --xqemu-update-goldens to create it
+    """
+
+
+class XQEMUGoldenImageComparison(NamedTuple):
+    """How a frame compared with its golden image
+
+    :param matched: True if the frame is close enough
+    :param hash_distance: how many bits of the perceptual hashes differ
+    :param changed_fraction: the fraction of the pixels that differ, None if \
+        the pixels weren't compared
+    :param ssim: the structural similarity, None if not computed
+    :param diff_filename: an image showing the differences, if they didn't \
+        match
+    """
+
+    matched: bool
+    hash_distance: int
+    changed_fraction: Optional[float]
+    ssim: Optional[float]
+    diff_filename: Optional[str]
+
+
+def _to_grey(frame: np.ndarray) -> np.ndarray:
+    """:returns: float32 luma of an RGB(A) frame"""
+    if frame.ndim == 2:
+        return frame.astype(np.float32)
+    if frame.shape[2] < 3:
+        return frame[:, :, 0].astype(np.float32)
+    return frame[:, :, :3].astype(np.float32) @ np.array(
+        (0.299, 0.587, 0.114), np.float32
+    )
+
+
+def _resize_area(grey: np.ndarray, size: int) -> np.ndarray:
+    """Shrink by averaging the pixels that fall in each output pixel"""
+    height, width = grey.shape
+    row_starts = np.linspace(0, height, size, endpoint=False).astype(int)
+    column_starts = np.linspace(0, width, size, endpoint=False).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(grey, row_starts, 0), column_starts, 1)
+    row_counts = np.diff(np.append(row_starts, height))
+    column_counts = np.diff(np.append(column_starts, width))
+    return sums / np.outer(row_counts, column_counts)
+
+
+def _get_dct_matrix(size: int) -> np.ndarray:
+    """:returns: the orthonormal DCT-II matrix"""
+    k = np.arange(size)[:, np.newaxis]
+    n = np.arange(size)[np.newaxis, :]
+    matrix = np.sqrt(2 / size) * np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT_MATRIX = _get_dct_matrix(_HASH_IMAGE_SIZE)
+
+
+def get_perceptual_hash(frame: np.ndarray) -> int:
+    """A 64 bit hash that changes little when the image changes little, \
+        compare hashes with :py:func:`get_hash_distance`
+
+    :param frame: (height, width, channels) or (height, width) array
+    """
+    grey = _to_grey(frame)
+    # Tiny images (e.g. small regions) are scaled up first
+    for axis, length in enumerate(grey.shape):
+        if length < _HASH_IMAGE_SIZE:
+            grey = np.repeat(grey, -(-_HASH_IMAGE_SIZE // length), axis)
+    small = _resize_area(grey, _HASH_IMAGE_SIZE)
+    low_frequencies = (_DCT_MATRIX @ small @ _DCT_MATRIX.T)[:_HASH_SIZE, :_HASH_SIZE]
+    # The DC term is the average brightness, which is too easily affected
+    coefficients = low_frequencies.flatten()[1:]
+    bits = coefficients > np.median(coefficients)
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def get_hash_distance(hash1: int, hash2: int) -> int:
+    """:returns: the number of bits that differ"""
+    return bin(hash1 ^ hash2).count("1")
+
+
+def _box_filter(image: np.ndarray, size: int) -> np.ndarray:
+    """:returns: the mean of every size x size window that fits in the image"""
+    sums = np.pad(image, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+    window_sums = (
+        sums[size:, size:]
+        - sums[:-size, size:]
+        - sums[size:, :-size]
+        + sums[:-size, :-size]
+    )
+    return window_sums / (size * size)
+
+
+def get_ssim(frame: np.ndarray, reference: np.ndarray) -> float:
+    """:returns: the mean structural similarity of the two frames' luma, 1 \
+        if they are the same
+    """
+    if frame.shape != reference.shape:
+        return 0.0
+    x = _to_grey(frame).astype(np.float64)
+    y = _to_grey(reference).astype(np.float64)
+    if min(x.shape) < _SSIM_WINDOW:
+        return 1.0 if np.array_equal(x, y) else 0.0
+    mean_x = _box_filter(x, _SSIM_WINDOW)
+    mean_y = _box_filter(y, _SSIM_WINDOW)
+    variance_x = _box_filter(x * x, _SSIM_WINDOW) - mean_x ** 2
+    variance_y = _box_filter(y * y, _SSIM_WINDOW) - mean_y ** 2
+    covariance = _box_filter(x * y, _SSIM_WINDOW) - mean_x * mean_y
+    ssim = ((2 * mean_x * mean_y + _SSIM_C1) * (2 * covariance + _SSIM_C2)) / (
+        (mean_x ** 2 + mean_y ** 2 + _SSIM_C1) * (variance_x + variance_y + _SSIM_C2)
+    )
+    return float(ssim.mean())
+
+
+def _get_digest(frame: np.ndarray) -> str:
+    """:returns: the content address of a frame, of its values in their own \
+        type so that e.g. 16 bit frames that differ in the low bits differ
+    """
+    digest = hashlib.sha256(str(frame.shape).encode())
+    if frame.dtype != np.uint8:
+        frame = frame.astype(frame.dtype.newbyteorder("="), copy=False)
+        digest.update(frame.dtype.str.encode())
+    digest.update(np.ascontiguousarray(frame).data)
+    return digest.hexdigest()
+
+
+def _make_diff_image(
+    frame: np.ndarray, golden: np.ndarray, changed: np.ndarray
+) -> np.ndarray:
+    """:returns: the frame, the golden and the golden dimmed with the \
+        changed pixels in red, side by side
+    """
+    diff = (golden[:, :, :3] // 3).copy()
+    diff[changed] = (255, 0, 0)
+    return np.concatenate((frame[:, :, :3], golden[:, :, :3], diff), axis=1)
+
+
+class XQEMUGoldenImageStore:
+    """Golden images saved in a directory that can be committed alongside the
+    tests. Each distinct image is saved once as a PNG named after the hash of
+    its pixels, and an index maps the goldens' names to those images.
+
+    In update mode missing or mismatched goldens are saved from the frame
+    rather than failing the test.
+    """
+
+    def __init__(self, root_dir: str, diff_dir: str, update: bool = False):
+        """:param root_dir: where the goldens are kept
+        :param diff_dir: where images showing the differences are saved when \
+            a frame doesn't match
+        :param update: save frames as goldens rather than failing
+        """
+        self._root_dir = root_dir
+        self._diff_dir = diff_dir
+        self._update = update
+        self._index_filename = os.path.join(root_dir, "index.json")
+        self._lock = threading.Lock()
+        self._index: Dict[str, Dict] = {}
+        if os.path.exists(self._index_filename):
+            with open(self._index_filename) as index_file:
+                self._index = json.load(index_file)
+        self._num_diffs = 0
+
+    def _get_blob_filename(self, digest: str) -> str:
+        return os.path.join(self._root_dir, "blobs", digest[:2], digest + ".png")
+
+    def get_golden(self, name: str) -> Optional[np.ndarray]:
+        """:returns: the golden image or None if there isn't one"""
+        with self._lock:
+            entry = self._index.get(name)
+        if entry is None:
+            return None
+        return load_png(self._get_blob_filename(entry["digest"]))
+
+    def save_golden(self, name: str, frame: np.ndarray) -> None:
+        """Save a frame as the golden image with this name, replacing any \
+            existing golden with that name
+        """
+        digest = _get_digest(frame)
+        blob_filename = self._get_blob_filename(digest)
+        if not os.path.exists(blob_filename):
+            os.makedirs(os.path.dirname(blob_filename), exist_ok=True)
+            _write_atomically(blob_filename, lambda filename: save_png(filename, frame))
+        entry = {
+            "digest": digest,
+            "perceptual_hash": f"{get_perceptual_hash(frame):016x}",
+        }
+        with self._lock, locked_file(f"{self._index_filename}.lock"):
+            # Other processes (e.g. pytest-xdist workers) may have added
+            # goldens too, the file lock keeps their entries
+            if os.path.exists(self._index_filename):
+                with open(self._index_filename) as index_file:
+                    self._index = json.load(index_file)
+            self._index[name] = entry
+            index = json.dumps(self._index, indent=2, sort_keys=True)
+            _write_atomically(
+                self._index_filename,
+                lambda filename: _write_text(filename, index),
+            )
+
+    def compare(
+        self,
+        frame: np.ndarray,
+        name: str,
+        region: Optional[XQEMUScreenRegion] = None,
+        pixel_threshold: int = 0,
+        max_changed_fraction: float = 0.0,
+        min_ssim: Optional[float] = None,
+        max_hash_distance: Optional[int] = None,
+    ) -> XQEMUGoldenImageComparison:
+        """Compare a frame with a golden image. Identical frames are matched \
+            by their hash, the pixels (or SSIM) are compared otherwise.
+
+        :param region: only compare this part of the frame, the golden is of \
+            the region alone
+        :param pixel_threshold: ignore changes to a channel of up to this much
+        :param max_changed_fraction: the fraction of the pixels that may differ
+        :param min_ssim: if given, compare the structural similarity rather \
+            than the individual pixels
+        :param max_hash_distance: if given, frames whose perceptual hashes \
+            differ by at most this many bits match without their pixels \
+            being compared. The hash is noise for flat or dark images, so \
+            only use this for detailed ones
+        :raises XQEMUGoldenImageMissingError: if there is no such golden
+        """
+        frame = _crop(frame, region)
+        with self._lock:
+            entry = self._index.get(name)
+        if entry is None:
+            raise XQEMUGoldenImageMissingError(
+                f"No golden image called {name}, run with --xqemu-update-goldens"
+            )
+        if _get_digest(frame) == entry["digest"]:
+            return XQEMUGoldenImageComparison(True, 0, 0.0, None, None)
+
+        hash_distance = get_hash_distance(
+            get_perceptual_hash(frame), int(entry["perceptual_hash"], 16)
+        )
+        if max_hash_distance is not None and hash_distance <= max_hash_distance:
+            return XQEMUGoldenImageComparison(True, hash_distance, None, None, None)
+        golden = self.get_golden(name)
+        changed_fraction = None
+        ssim = None
+        if frame.shape == golden.shape:
+            changed_fraction = get_changed_fraction(
+                frame, golden, pixel_threshold=pixel_threshold
+            )
+            if min_ssim is None:
+                matched = changed_fraction <= max_changed_fraction
+            else:
+                ssim = get_ssim(frame, golden)
+                matched = ssim >= min_ssim
+            if matched:
+                return XQEMUGoldenImageComparison(
+                    True, hash_distance, changed_fraction, ssim, None
+                )
+        return XQEMUGoldenImageComparison(
+            False,
+            hash_distance,
+            changed_fraction,
+            ssim,
+            self._save_diff(frame, golden, name, pixel_threshold),
+        )
+
+    def _save_diff(
+        self, frame: np.ndarray, golden: np.ndarray, name: str, pixel_threshold: int
+    ) -> Optional[str]:
+        """:returns: the filename of the diff image, None if the frames are \
+            different sizes
+        """
+        if frame.shape != golden.shape:
+            return None
+        difference = np.maximum(frame, golden) - np.minimum(frame, golden)
+        changed = difference.max(axis=2) > pixel_threshold
+        with self._lock:
+            self._num_diffs += 1
+            safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+            diff_filename = os.path.join(
+                self._diff_dir, f"{self._num_diffs}-{safe_name}.diff.png"
+            )
+        save_png(diff_filename, _make_diff_image(frame, golden, changed))
+        return diff_filename
+
+    def assert_matches(
+        self,
+        frame: np.ndarray,
+        name: str,
+        region: Optional[XQEMUScreenRegion] = None,
+        pixel_threshold: int = 0,
+        max_changed_fraction: float = 0.0,
+        min_ssim: Optional[float] = None,
+        max_hash_distance: Optional[int] = None,
+    ) -> None:
+        """Check that a frame matches a golden image, see :py:meth:`compare`. \
+            In update mode the frame is saved as the golden instead if it \
+            doesn't match or there isn't a golden yet.
+
+        :raises XQEMUGoldenImageMismatchError: if they don't match
+        :raises XQEMUGoldenImageMissingError: if there is no such golden
+        """
+        try:
+            comparison = self.compare(
+                frame,
+                name,
+                region,
+                pixel_threshold,
+                max_changed_fraction,
+                min_ssim,
+                max_hash_distance,
+            )
+        except XQEMUGoldenImageMissingError:
+            if not self._update:
+                raise
+            comparison = None
+        if comparison is not None and comparison.matched:
+            return
+        if self._update:
+            self.save_golden(name, _crop(frame, region))
+            return
+        raise XQEMUGoldenImageMismatchError(
+            f"Frame doesn't match golden image {name}: {comparison.hash_distance} "
+            + f"bits of the perceptual hash, {comparison.changed_fraction} of the "
+            + f"pixels and SSIM {comparison.ssim} differ. "
+            + f"Differences: {comparison.diff_filename}"
+        )
+
+
+def _write_text(filename: str, text: str) -> None:
+    with open(filename, "w") as text_file:
+        text_file.write(text)
+
+
+def _write_atomically(filename: str, write) -> None:
+    """Write to a temporary file then move it into place, so that readers \
+        never see a partly written file
+    """
+    descriptor, temporary_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename), suffix=".tmp"
+    )
+    os.close(descriptor)
+    try:
+        write(temporary_filename)
+        os.replace(temporary_filename, filename)
+    except BaseException:
+        os.remove(temporary_filename)
+        raise
@@ -0,0 +1,206 @@
+"""Reading text from declared regions of the screen. Regions are cropped and
+thresholded with NumPy, OCR runs in a pool of processes so tests aren't blocked
+and results are cached so that reading an unchanged region again is free
+"""
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+import hashlib
+import threading
+from typing import Callable, Dict, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from .xqemu_golden_images import _to_grey
+from .xqemu_screen_wait import XQEMUScreenRegion, _crop
+
+# Tesseract reads text best with a margin around it
+_BORDER = 8
+_DEFAULT_CACHE_SIZE = 256
+
+OCRFunction = Callable[[np.ndarray], str]
+
+
+class XQEMUOCRCacheInfo(NamedTuple):
+    """How well the cache of OCR results is working"""
+
+    hits: int
+    misses: int
+    size: int
+
+
+def _get_otsu_threshold(grey: np.ndarray) -> int:
+    """:returns: the threshold that best separates the pixels in two"""
+    histogram = np.bincount(grey.ravel(), minlength=256).astype(np.float64)
+    weights = np.cumsum(histogram)
+    sums = np.cumsum(histogram * np.arange(256))
+    total_weight, total_sum = weights[-1], sums[-1]
+    # Proportional to the variance between the two classes at each threshold
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variances = (total_sum * weights - sums * total_weight) ** 2 / (
+            weights * (total_weight - weights)
+        )
+    return int(np.argmax(np.nan_to_num(variances, nan=0, posinf=0)))
+
+
+def preprocess_for_ocr(
+    pixels: np.ndarray, threshold: Optional[int] = None, scale: int = 1
+) -> np.ndarray:
+    """Turn a region of the screen into black text on a white background, \
+        which is what OCR engines read best
+
+    :param pixels: an RGB(A) or grey image
+    :param threshold: the brightness that separates text from the \
+        background, chosen for each image (with Otsu's method) if None. The \
+        text is assumed to be whichever side covers fewer pixels
+    :param scale: enlarge by this factor, OCR struggles with small text
+    :returns: uint8 array of shape (height, width) of 0 (text) and 255
+    """
+    grey = np.clip(_to_grey(pixels) + 0.5, 0, 255).astype(np.uint8)
+    if threshold is None:
+        threshold = _get_otsu_threshold(grey)
+    text = grey > threshold
+    if np.count_nonzero(text) * 2 > text.size:
+        text = ~text
+    binary = np.where(text, np.uint8(0), np.uint8(255))
+    if scale > 1:
+        binary = np.repeat(np.repeat(binary, scale, 0), scale, 1)
+    return np.pad(binary, _BORDER, constant_values=255)
+
+
+def tesseract_ocr(pixels: np.ndarray) -> str:
+    """Read text with Tesseract, runs in the worker processes
+
+    :raises RuntimeError: if pytesseract or Pillow isn't installed
+    """
+    try:
+        # Optional, only needed for OCR
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+        import pytesseract  # pylint: disable=import-outside-toplevel
+    except ImportError as error:
+        raise RuntimeError(
+            "OCR with Tesseract needs pytesseract and Pillow, install them "
+            + "with: pip install pytesseract pillow"
+        ) from error
+    return pytesseract.image_to_string(Image.fromarray(pixels)).strip()
+
+
+class XQEMUOCRReader:
+    """Reads the text in named regions of frames.
+
+    Text that is read is cached by the region's pixels, so re-reading a \
+    screen that hasn't changed doesn't run OCR again, even whilst the first \
+    read is still running.
+    """
+
+    def __init__(
+        self,
+        regions: Dict[str, XQEMUScreenRegion],
+        threshold: Optional[int] = None,
+        scale: int = 2,
+        ocr_function: OCRFunction = tesseract_ocr,
+        executor: Optional[Executor] = None,
+        cache_size: int = _DEFAULT_CACHE_SIZE,
+    ):
+        """:param regions: the regions to read, by name
+        :param threshold: see :py:func:`preprocess_for_ocr`
+        :param scale: see :py:func:`preprocess_for_ocr`
+        :param ocr_function: reads the text in a preprocessed image, it must \
+            be a module level function so that it can be sent to the workers
+        :param executor: runs ocr_function, defaults to a pool of processes \
+            which is created when it is first needed
+        :param cache_size: the number of results to cache
+        """
+        self._regions = dict(regions)
+        self._threshold = threshold
+        self._scale = scale
+        self._ocr_function = ocr_function
+        self._executor = executor
+        self._owns_executor = executor is None
+        self._cache_size = cache_size
+        self._cache: "OrderedDict[tuple, Future]" = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor()
+        return self._executor
+
+    def _read_region(self, frame: np.ndarray, region: XQEMUScreenRegion) -> Future:
+        pixels = np.ascontiguousarray(_crop(frame, region))
+        key = (
+            hashlib.sha1(pixels.data).hexdigest(),
+            pixels.shape,
+            self._threshold,
+            self._scale,
+        )
+        with self._lock:
+            future = self._cache.get(key)
+            if future is not None:
+                self._hits += 1
+                self._cache.move_to_end(key)
+                return future
+            self._misses += 1
+            future = self._get_executor().submit(
+                self._ocr_function,
+                preprocess_for_ocr(pixels, self._threshold, self._scale),
+            )
+            self._cache[key] = future
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        future.add_done_callback(lambda done: self._forget_failure(key, done))
+        return future
+
+    def _forget_failure(self, key: tuple, future: Future) -> None:
+        """Failures aren't cached, so that they are retried"""
+        if future.cancelled() or future.exception() is not None:
+            with self._lock:
+                if self._cache.get(key) is future:
+                    del self._cache[key]
+
+    def read_text_async(
+        self, frame: np.ndarray, names: Optional[Sequence[str]] = None
+    ) -> Dict[str, Future]:
+        """Start reading the text in regions of a frame, without waiting for it
+
+        :param names: the regions to read, defaults to all of them
+        :returns: futures of the text in each region, by name
+        :raises KeyError: if a region hasn't been declared
+        """
+        if names is None:
+            names = tuple(self._regions)
+        return {name: self._read_region(frame, self._regions[name]) for name in names}
+
+    def read_text(
+        self,
+        frame: np.ndarray,
+        names: Optional[Sequence[str]] = None,
+        timeout: Optional[float] = None,
+    ) -> Dict[str, str]:
+        """Read the text in regions of a frame, see :py:meth:`read_text_async`
+
+        :param timeout: how long to wait for the text in seconds
+        :returns: the text in each region, by name
+        """
+        futures = self.read_text_async(frame, names)
+        return {name: future.result(timeout) for name, future in futures.items()}
+
+    def get_cache_info(self) -> XQEMUOCRCacheInfo:
+        """:returns: the number of reads that were and weren't cached and the \
+            number of results cached
+        """
+        with self._lock:
+            return XQEMUOCRCacheInfo(self._hits, self._misses, len(self._cache))
+
+    def close(self) -> None:
+        """Stop the worker processes, if they were created by this reader"""
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self) -> "XQEMUOCRReader":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,274 @@
+"""A small PNG encoder and decoder for frames, so that images can be saved
+compressed without any dependencies other than NumPy
+"""
+import struct
+from typing import Sequence, Tuple
+import zlib
+
+import numpy as np
+
+_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PNG colour types that are supported, with their number of channels
+_CHANNELS = {0: 1, 2: 3, 4: 2, 6: 4}
+_COLOUR_TYPES = {channels: colour_type for colour_type, channels in _CHANNELS.items()}
+_FILTER_NONE, _FILTER_SUB, _FILTER_UP, _FILTER_AVERAGE, _FILTER_PAETH = range(5)
+
+
+class XQEMUPNGFormatError(ValueError):
+    """The file is not a PNG image that can be decoded"""
+
+
+def _make_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data))
+    )
+
+
+def _compress(pixels: np.ndarray, compression_level: int) -> bytes:
+    """:returns: the compressed, filtered rows of an image"""
+    height, width, channels = pixels.shape
+    rows = pixels.reshape(height, width * channels)
+    # Every row uses the "up" filter: the difference from the row above.
+    # It compresses screens well and is vectorised, unlike adaptive filtering
+    filtered = np.empty((height, width * channels + 1), np.uint8)
+    filtered[:, 0] = _FILTER_UP
+    filtered[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+    return zlib.compress(filtered.tobytes(), compression_level)
+
+
+def _check_pixels(pixels: np.ndarray) -> np.ndarray:
+    """:returns: the pixels with a channel axis
+    :raises ValueError: if they can't be encoded
+    """
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, np.newaxis]
+    if (
+        pixels.dtype != np.uint8
+        or pixels.ndim != 3
+        or pixels.shape[2] not in _COLOUR_TYPES
+    ):
+        raise ValueError(f"Can't encode {pixels.dtype} pixels of shape {pixels.shape}")
+    return pixels
+
+
+def _make_header_chunk(width: int, height: int, channels: int) -> bytes:
+    return _make_chunk(
+        b"IHDR",
+        struct.pack(">IIBBBBB", width, height, 8, _COLOUR_TYPES[channels], 0, 0, 0),
+    )
+
+
+def encode_png(pixels: np.ndarray, compression_level: int = 6) -> bytes:
+    """:param pixels: uint8 array of shape (height, width, channels) with 1 \
+        (grey), 2 (grey and alpha), 3 (RGB) or 4 (RGBA) channels, or of \
+        shape (height, width) for grey
+    :param compression_level: zlib's compression level, 1 is fastest
+    :returns: the PNG file's contents
+    """
+    pixels = _check_pixels(pixels)
+    height, width, channels = pixels.shape
+    return (
+        _SIGNATURE
+        + _make_header_chunk(width, height, channels)
+        + _make_chunk(b"IDAT", _compress(pixels, compression_level))
+        + _make_chunk(b"IEND", b"")
+    )
+
+
+def _get_changed_box(frame: np.ndarray, previous: np.ndarray) -> Tuple[int, ...]:
+    """:returns: the top, bottom, left and right of the pixels that changed, \
+        one pixel if none did
+    """
+    changed = np.any(frame != previous, axis=2)
+    rows = np.flatnonzero(changed.any(axis=1))
+    if not rows.size:
+        return 0, 1, 0, 1
+    columns = np.flatnonzero(changed.any(axis=0))
+    return rows[0], rows[-1] + 1, columns[0], columns[-1] + 1
+
+
+def encode_apng(
+    frames: Sequence[np.ndarray],
+    durations: Sequence[float],
+    compression_level: int = 6,
+    num_plays: int = 0,
+) -> bytes:
+    """Encode an animated PNG, which browsers play like a video. Each frame \
+        after the first only stores the part that changed, so mostly static \
+        screens are cheap to store. Viewers that don't support animation \
+        show the first frame.
+
+    :param frames: pixels of the same shape, see :py:func:`encode_png`
+    :param durations: how long to show each frame in seconds, up to 65 \
+        seconds
+    :param num_plays: how many times to play the animation, 0 is forever
+    :returns: the PNG file's contents
+    """
+    if not frames or len(frames) != len(durations):
+        raise ValueError("There must be a duration for each of at least 1 frame")
+    frames = [_check_pixels(frame) for frame in frames]
+    height, width, channels = frames[0].shape
+    if any(frame.shape != frames[0].shape for frame in frames):
+        raise ValueError("The frames must all be the same shape")
+    chunks = [
+        _SIGNATURE,
+        _make_header_chunk(width, height, channels),
+        _make_chunk(b"acTL", struct.pack(">II", len(frames), num_plays)),
+    ]
+    sequence_num = 0
+    previous = None
+    for frame, duration in zip(frames, durations):
+        if previous is None:
+            top, bottom, left, right = 0, height, 0, width
+        else:
+            top, bottom, left, right = _get_changed_box(frame, previous)
+        delay_ms = min(max(round(duration * 1000), 1), 0xFFFF)
+        # Not disposed, and replacing the pixels under it
+        frame_control = struct.pack(
+            ">IIIIIHHBB",
+            sequence_num,
+            right - left,
+            bottom - top,
+            left,
+            top,
+            delay_ms,
+            1000,
+            0,
+            0,
+        )
+        chunks.append(_make_chunk(b"fcTL", frame_control))
+        data = _compress(
+            np.ascontiguousarray(frame[top:bottom, left:right]), compression_level
+        )
+        if previous is None:
+            chunks.append(_make_chunk(b"IDAT", data))
+            sequence_num += 1
+        else:
+            chunks.append(
+                _make_chunk(b"fdAT", struct.pack(">I", sequence_num + 1) + data)
+            )
+            sequence_num += 2
+        previous = frame
+    chunks.append(_make_chunk(b"IEND", b""))
+    return b"".join(chunks)
+
+
+def save_png(filename: str, pixels: np.ndarray, compression_level: int = 6) -> None:
+    """Save pixels as a PNG image, see :py:func:`encode_png`"""
+    with open(filename, "wb") as png_file:
+        png_file.write(encode_png(pixels, compression_level))
+
+
+def save_apng(
+    filename: str,
+    frames: Sequence[np.ndarray],
+    durations: Sequence[float],
+    compression_level: int = 6,
+) -> None:
+    """Save an animated PNG, see :py:func:`encode_apng`"""
+    with open(filename, "wb") as png_file:
+        png_file.write(encode_apng(frames, durations, compression_level))
+
+
+def decode_png(data: bytes) -> np.ndarray:
+    """Decode an 8 bit, non-interlaced, grey, RGB or RGBA PNG image. Only \
+        the first frame of animated PNGs is decoded
+
+    :returns: uint8 array of shape (height, width, channels)
+    :raises XQEMUPNGFormatError: if the image can't be decoded
+    """
+    if not data.startswith(_SIGNATURE):
+        raise XQEMUPNGFormatError("Not a PNG image")
+    position = len(_SIGNATURE)
+    header = None
+    compressed = []
+    while position + 8 <= len(data):
+        length, chunk_type = struct.unpack_from(">I4s", data, position)
+        chunk_data = data[position + 8 : position + 8 + length]
+        position += 12 + length
+        if chunk_type == b"IHDR":
+            header = struct.unpack(">IIBBBBB", chunk_data)
+        elif chunk_type == b"IDAT":
+            compressed.append(chunk_data)
+        elif chunk_type == b"IEND":
+            break
+    if header is None:
+        raise XQEMUPNGFormatError("No IHDR chunk")
+    width, height, bit_depth, colour_type, _, _, interlace = header
+    if bit_depth != 8 or colour_type not in _CHANNELS or interlace:
+        raise XQEMUPNGFormatError(
+            f"Unsupported PNG: bit depth {bit_depth}, colour type {colour_type}, "
+            + f"interlace {interlace}"
+        )
+    channels = _CHANNELS[colour_type]
+    try:
+        raw = zlib.decompress(b"".join(compressed))
+    except zlib.error as error:
+        raise XQEMUPNGFormatError("Corrupt image data") from error
+    row_size = width * channels
+    if len(raw) != height * (row_size + 1):
+        raise XQEMUPNGFormatError("Wrong amount of image data")
+    filtered = np.frombuffer(raw, np.uint8).reshape(height, row_size + 1)
+    return _unfilter(filtered, channels).reshape(height, width, channels)
+
+
+def load_png(filename: str) -> np.ndarray:
+    """Load a PNG image, see :py:func:`decode_png`"""
+    with open(filename, "rb") as png_file:
+        return decode_png(png_file.read())
+
+
+def _unfilter(filtered: np.ndarray, bytes_per_pixel: int) -> np.ndarray:
+    filter_types = filtered[:, 0]
+    rows = filtered[:, 1:].copy()
+    if not np.any(filter_types):
+        return rows
+    if np.all(filter_types == _FILTER_UP):
+        # Each row is the sum of the ones above, wrapping around like uint8
+        return np.cumsum(rows, axis=0, dtype=np.uint8)
+    previous = np.zeros(rows.shape[1], np.uint8)
+    for row, filter_type in zip(rows, filter_types):
+        _unfilter_row(row, previous, filter_type, bytes_per_pixel)
+        previous = row
+    return rows
+
+
+def _unfilter_row(
+    row: np.ndarray, previous: np.ndarray, filter_type: int, bytes_per_pixel: int
+) -> None:
+    """Undo the filter on one row in place"""
+    if filter_type == _FILTER_NONE:
+        return
+    if filter_type == _FILTER_UP:
+        row += previous
+        return
+    if filter_type == _FILTER_SUB:
+        # Each channel is the running sum of the same channel to the left
+        pixels = row.reshape(-1, bytes_per_pixel)
+        np.cumsum(pixels, axis=0, dtype=np.uint8, out=pixels)
+        return
+    if filter_type not in (_FILTER_AVERAGE, _FILTER_PAETH):
+        raise XQEMUPNGFormatError(f"Unknown filter type {filter_type}")
+    # These depend on the pixel to the left once it has been unfiltered, so
+    # they can't be vectorised along the row
+    values = row.astype(np.int32)
+    above = previous.astype(np.int32)
+    for i in range(len(values)):
+        left = values[i - bytes_per_pixel] if i >= bytes_per_pixel else 0
+        if filter_type == _FILTER_AVERAGE:
+            predictor = (left + above[i]) // 2
+        else:
+            upper_left = above[i - bytes_per_pixel] if i >= bytes_per_pixel else 0
+            estimate = left + above[i] - upper_left
+            distances = (
+                abs(estimate - left),
+                abs(estimate - above[i]),
+                abs(estimate - upper_left),
+            )
+            predictor = (left, above[i], upper_left)[distances.index(min(distances))]
+        values[i] = (values[i] + predictor) & 0xFF
+    row[:] = values
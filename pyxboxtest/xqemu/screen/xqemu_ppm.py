@@ -0,0 +1,103 @@
+"""Reads the PPM images saved by XQEMU's screendump command straight into
+NumPy arrays by memory mapping them, so the pixels are never copied
+"""
+import mmap
+from typing import Sequence, Tuple
+
+import numpy as np
+
+# "P6", width, height and the maximum value
+_NUM_HEADER_FIELDS = 4
+
+
+class XQEMUPPMFormatError(ValueError):
+    """The file is not a binary (P6) PPM image"""
+
+
+def _parse_header(data: mmap.mmap) -> Tuple[int, int, int, int]:
+    """:returns: the width, height and maximum value of the image and the \
+        offset at which the pixels start
+    :raises XQEMUPPMFormatError: if the header is invalid
+    """
+    fields = []
+    position = 0
+    while len(fields) < _NUM_HEADER_FIELDS:
+        # Skip whitespace and comments between the fields
+        while position < len(data) and data[position : position + 1].isspace():
+            position += 1
+        if data[position : position + 1] == b"#":
+            position = data.find(b"\n", position)
+            if position == -1:
+                break
+            continue
+        end = position
+        while end < len(data) and not data[end : end + 1].isspace():
+            end += 1
+        if end == position:
+            break
+        fields.append(data[position:end])
+        position = end
+    # Exactly one whitespace character separates the header from the pixels
+    if len(fields) < _NUM_HEADER_FIELDS or position >= len(data):
+        raise XQEMUPPMFormatError("Incomplete PPM header")
+    if fields[0] != b"P6":
+        raise XQEMUPPMFormatError(f"Not a binary PPM image: {fields[0]!r}")
+    try:
+        width, height, max_value = (int(field) for field in fields[1:])
+    except ValueError:
+        raise XQEMUPPMFormatError(f"Invalid PPM header: {fields!r}") from None
+    if width <= 0 or height <= 0 or not 0 < max_value < 2 ** 16:
+        raise XQEMUPPMFormatError(f"Invalid PPM header: {fields!r}")
+    return width, height, max_value, position + 1
+
+
+def load_ppm(filename: str) -> np.ndarray:
+    """Memory map a PPM image. The file can be deleted straight away, the \
+        pixels stay valid for as long as the array (or a view of it) exists. \
+        Each mapped image holds a file descriptor open, use \
+        :py:func:`load_ppms` for long sequences of images.
+
+    :returns: a read only array of shape (height, width, 3), of uint8 if the \
+        image's maximum value is below 256 and big endian uint16 otherwise
+    :raises XQEMUPPMFormatError: if the file is not a binary PPM image
+    """
+    with open(filename, "rb") as ppm_file:
+        try:
+            data = mmap.mmap(ppm_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise XQEMUPPMFormatError(f"{filename} is empty") from None
+    width, height, max_value, offset = _parse_header(data)
+    dtype = np.dtype(np.uint8) if max_value < 256 else np.dtype(">u2")
+    num_values = width * height * 3
+    if offset + num_values * dtype.itemsize > len(data):
+        raise XQEMUPPMFormatError(f"{filename} is truncated")
+    # The array keeps the map open, a read only map gives a read only array
+    return np.frombuffer(data, dtype, num_values, offset).reshape(height, width, 3)
+
+
+def load_ppms(filenames: Sequence[str]) -> np.ndarray:
+    """Load a sequence of PPM images e.g. recorded frames, so that they can \
+        be checked all at once with vectorised operations. Each image is \
+        mapped and copied straight into one array, so only one image is \
+        mapped at a time.
+
+    :returns: an array of shape (number of images, height, width, 3)
+    :raises XQEMUPPMFormatError: if a file is not a binary PPM image
+    :raises ValueError: if the images are not all the same size and depth, \
+        or there are none
+    """
+    if not filenames:
+        raise ValueError("No images to load")
+    first_image = load_ppm(filenames[0])
+    images = np.empty((len(filenames), *first_image.shape), first_image.dtype)
+    images[0] = first_image
+    del first_image
+    for i, filename in enumerate(filenames[1:], 1):
+        image = load_ppm(filename)
+        if image.shape != images.shape[1:] or image.dtype != images.dtype:
+            raise ValueError(
+                f"{filename} is {image.shape} {image.dtype}, expected "
+                + f"{images.shape[1:]} {images.dtype}"
+            )
+        images[i] = image
+    return images
@@ -0,0 +1,180 @@
+"""Waiting for what is on screen to settle or to change, by sampling frames
+and comparing them with vectorised NumPy operations
+"""
+import time
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+
+# Sample quickly whilst the screen is changing and back off whilst it isn't
+_MIN_POLL_INTERVAL = 0.02
+_MAX_POLL_INTERVAL = 0.5
+
+
+class XQEMUScreenRegion(NamedTuple):
+    """A rectangle on screen, in pixels from the top left"""
+
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+class XQEMUScreenTimeoutError(TimeoutError):
+    """The screen did not settle or change in time"""
+
+
+def _crop(frame: np.ndarray, region: Optional[XQEMUScreenRegion]) -> np.ndarray:
+    """:returns: a view of the region of the frame, the whole frame if None"""
+    if region is None:
+        return frame
+    rows = slice(region.y, region.y + region.height)
+    return frame[rows, region.x : region.x + region.width]
+
+
+def get_changed_fraction(
+    frame: np.ndarray,
+    reference: np.ndarray,
+    region: Optional[XQEMUScreenRegion] = None,
+    mask: Optional[np.ndarray] = None,
+    pixel_threshold: int = 0,
+) -> float:
+    """Compare two frames of the same size
+
+    :param region: only compare this part of the frames
+    :param mask: only compare the pixels that are True in this boolean array \
+        of shape (height, width), or (region height, region width) if there \
+        is a region
+    :param pixel_threshold: a pixel has only changed if one of its channels \
+        has changed by more than this, so that noise can be ignored
+    :returns: the fraction of the pixels that have changed, from 0 to 1. A \
+        change of size counts as every pixel changing
+    """
+    if frame.shape != reference.shape:
+        return 1.0
+    frame = _crop(frame, region)
+    reference = _crop(reference, region)
+    # Avoids the unsigned subtraction wrapping around without making a wider
+    # copy of either frame
+    difference = np.maximum(frame, reference) - np.minimum(frame, reference)
+    changed = difference.max(axis=2) > pixel_threshold
+    if mask is None:
+        return float(changed.mean()) if changed.size else 0.0
+    num_compared = np.count_nonzero(mask)
+    return np.count_nonzero(changed & mask) / num_compared if num_compared else 0.0
+
+
+class _AdaptivePoller:
+    """Sleeps between samples, for longer each time nothing changes"""
+
+    def __init__(
+        self,
+        deadline: float,
+        min_interval: float = _MIN_POLL_INTERVAL,
+        max_interval: float = _MAX_POLL_INTERVAL,
+    ):
+        self._deadline = deadline
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._interval = min_interval
+
+    def wait(self, changed: bool, wake_by: Optional[float] = None) -> bool:
+        """:param changed: whether the screen changed since the last sample
+        :param wake_by: don't sleep past this time
+        :returns: False if the deadline has passed
+        """
+        if changed:
+            self._interval = self._min_interval
+        else:
+            self._interval = min(self._interval * 2, self._max_interval)
+        now = time.perf_counter()
+        if now >= self._deadline:
+            return False
+        wake_at = min(now + self._interval, self._deadline)
+        if wake_by is not None:
+            wake_at = min(wake_at, wake_by)
+        time.sleep(max(wake_at - now, 0))
+        return True
+
+
+def wait_for_screen_stable(
+    grab_frame: Callable[[], np.ndarray],
+    stable_time: float = 0.5,
+    timeout: float = 30.0,
+    region: Optional[XQEMUScreenRegion] = None,
+    mask: Optional[np.ndarray] = None,
+    pixel_threshold: int = 0,
+    max_changed_fraction: float = 0.0,
+) -> np.ndarray:
+    """Wait until the screen stops changing, e.g. once an app has rendered
+
+    :param grab_frame: gets what is on screen now
+    :param stable_time: how long the screen must stay the same, in seconds
+    :param timeout: how long to wait in seconds
+    :param max_changed_fraction: the screen counts as the same if no more \
+        than this fraction of the pixels change, see \
+        :py:func:`get_changed_fraction` for the other parameters
+    :returns: the settled frame
+    :raises XQEMUScreenTimeoutError: if the screen doesn't settle in time
+    """
+    start = time.perf_counter()
+    poller = _AdaptivePoller(start + timeout)
+    reference = grab_frame()
+    stable_since = start
+    changed = True
+    while True:
+        if time.perf_counter() - stable_since >= stable_time:
+            return reference
+        if not poller.wait(changed, stable_since + stable_time):
+            raise XQEMUScreenTimeoutError(
+                f"The screen didn't stay the same for {stable_time} seconds "
+                + f"within {timeout} seconds"
+            )
+        frame = grab_frame()
+        changed = (
+            get_changed_fraction(frame, reference, region, mask, pixel_threshold)
+            > max_changed_fraction
+        )
+        # Compared with the start of the stable period rather than the last
+        # frame so that a slow fade still counts as a change
+        if changed:
+            reference = frame
+            stable_since = time.perf_counter()
+
+
+def wait_for_screen_change(
+    grab_frame: Callable[[], np.ndarray],
+    reference: Optional[np.ndarray] = None,
+    timeout: float = 30.0,
+    region: Optional[XQEMUScreenRegion] = None,
+    mask: Optional[np.ndarray] = None,
+    pixel_threshold: int = 0,
+    min_changed_fraction: float = 0.0,
+) -> np.ndarray:
+    """Wait until the screen changes, e.g. after pressing a button
+
+    :param grab_frame: gets what is on screen now
+    :param reference: the frame to compare with, defaults to what is on \
+        screen now. Pass a frame grabbed before triggering the change so \
+        that a quick change isn't missed
+    :param timeout: how long to wait in seconds
+    :param min_changed_fraction: the screen has only changed once more than \
+        this fraction of the pixels change, see \
+        :py:func:`get_changed_fraction` for the other parameters
+    :returns: the changed frame
+    :raises XQEMUScreenTimeoutError: if the screen doesn't change in time
+    """
+    poller = _AdaptivePoller(time.perf_counter() + timeout)
+    if reference is None:
+        reference = grab_frame()
+    while True:
+        frame = grab_frame()
+        if (
+            get_changed_fraction(frame, reference, region, mask, pixel_threshold)
+            > min_changed_fraction
+        ):
+            return frame
+        if not poller.wait(changed=False):
+            raise XQEMUScreenTimeoutError(
+                f"The screen didn't change within {timeout} seconds"
+            )
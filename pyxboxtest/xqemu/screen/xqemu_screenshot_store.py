@@ -0,0 +1,155 @@
+"""Compresses screenshots into PNGs in the background, storing each distinct
+image once, so that big test runs don't fill the disk with raw PPMs
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import defaultdict
+import json
+import os
+import threading
+from typing import Dict, List, NamedTuple, Optional, Set
+
+import numpy as np
+
+from ..._logging import XQEMU_LOGGER
+from .xqemu_golden_images import _get_digest, _write_atomically, _write_text
+from .xqemu_png import save_png
+from .xqemu_ppm import XQEMUPPMFormatError, load_ppm
+
+_BLOBS_DIR = "blobs"
+_INDEX_FILENAME = "index.json"
+_DEFAULT_NUM_WORKERS = 2
+
+
+class XQEMUScreenshotStoreStats(NamedTuple):
+    """How much space the store saved
+
+    :param num_screenshots: the number of screenshots that were compressed
+    :param num_blobs: the number of distinct images stored
+    :param raw_bytes: the size of the screenshots before they were compressed
+    :param stored_bytes: the size of the stored images
+    """
+
+    num_screenshots: int
+    num_blobs: int
+    raw_bytes: int
+    stored_bytes: int
+
+
+class XQEMUScreenshotStore:
+    """Replaces PPM screenshots with PNGs named after their content, from a \
+        pool of threads (zlib and NumPy release the GIL). The index, \
+        index.json, lists the screenshots taken by each test and the PNG \
+        that each one was stored as.
+    """
+
+    def __init__(
+        self,
+        store_dir: str,
+        num_workers: int = _DEFAULT_NUM_WORKERS,
+        compression_level: int = 6,
+    ):
+        """:param store_dir: where to store the PNGs and the index
+        :param num_workers: the number of screenshots to compress at once
+        :param compression_level: zlib's compression level, 1 is fastest
+        """
+        self._store_dir = store_dir
+        self._compression_level = compression_level
+        self._executor = ThreadPoolExecutor(
+            num_workers, thread_name_prefix="pyxboxtest-screenshot-store"
+        )
+        self._lock = threading.Lock()
+        self._index: Dict[str, List[Dict[str, str]]] = defaultdict(list)
+        self._digests: Set[str] = set()
+        self._raw_bytes = 0
+        self._stored_bytes = 0
+        self._num_screenshots = 0
+
+    def _get_blob_path(self, digest: str) -> str:
+        """:returns: the path of an image relative to the store"""
+        return os.path.join(_BLOBS_DIR, digest[:2], digest + ".png")
+
+    def _store(self, screenshot_filename: str, test_name: str) -> Optional[str]:
+        try:
+            pixels = load_ppm(screenshot_filename)
+        except (FileNotFoundError, XQEMUPPMFormatError) as e:
+            # e.g. XQEMU failed to save it
+            XQEMU_LOGGER.debug("Not storing screenshot: %s", e)
+            return None
+        if pixels.dtype != np.uint8:
+            return None  # Deeper than a PNG of bytes, kept as it is
+        digest = _get_digest(pixels)
+        blob_path = self._get_blob_path(digest)
+        with self._lock:
+            is_new = digest not in self._digests
+            self._digests.add(digest)
+        stored_bytes = 0
+        if is_new:
+            full_blob_path = os.path.join(self._store_dir, blob_path)
+            try:
+                os.makedirs(os.path.dirname(full_blob_path), exist_ok=True)
+                _write_atomically(
+                    full_blob_path,
+                    lambda filename: save_png(
+                        filename, pixels, self._compression_level
+                    ),
+                )
+            except BaseException:
+                with self._lock:
+                    self._digests.discard(digest)
+                raise
+            stored_bytes = os.path.getsize(full_blob_path)
+        del pixels
+        raw_bytes = os.path.getsize(screenshot_filename)
+        os.remove(screenshot_filename)
+        with self._lock:
+            self._num_screenshots += 1
+            self._raw_bytes += raw_bytes
+            self._stored_bytes += stored_bytes
+            self._index[test_name].append(
+                {"screenshot": os.path.basename(screenshot_filename), "blob": blob_path}
+            )
+        return blob_path
+
+    def add(self, screenshot_filename: str, test_name: str) -> "Future[Optional[str]]":
+        """Compress a PPM screenshot in the background and then delete it. It \
+            must not be used once it has been added.
+
+        :param test_name: the test that took it, for the index
+        :returns: the path of the PNG relative to the store, None if the \
+            screenshot couldn't be read
+        """
+        return self._executor.submit(self._store, screenshot_filename, test_name)
+
+    def get_index(self) -> Dict[str, List[Dict[str, str]]]:
+        """:returns: the screenshots stored so far for each test, with the \
+            paths of their PNGs relative to the store
+        """
+        with self._lock:
+            return {
+                test_name: [dict(entry) for entry in entries]
+                for test_name, entries in self._index.items()
+            }
+
+    def get_stats(self) -> XQEMUScreenshotStoreStats:
+        """:returns: how many screenshots were stored and how much space that \
+            took up
+        """
+        with self._lock:
+            return XQEMUScreenshotStoreStats(
+                self._num_screenshots,
+                len(self._digests),
+                self._raw_bytes,
+                self._stored_bytes,
+            )
+
+    def close(self) -> None:
+        """Wait for the screenshots to be stored and write the index"""
+        self._executor.shutdown(wait=True)
+        index = self.get_index()
+        if index:
+            _write_atomically(
+                os.path.join(self._store_dir, _INDEX_FILENAME),
+                lambda filename: _write_text(
+                    filename, json.dumps(index, indent=2, sort_keys=True)
+                ),
+            )
@@ -0,0 +1,283 @@
+"""Finding where an image (e.g. a menu item) is on screen using normalised
+cross-correlation, searched coarse to fine over image pyramids
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+from typing import List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .xqemu_golden_images import _to_grey
+from .xqemu_png import load_png
+from .xqemu_ppm import load_ppm
+from .xqemu_screen_wait import XQEMUScreenRegion, _crop
+
+# Stop shrinking once the template would be smaller than this
+_MIN_TEMPLATE_SIZE = 8
+_DEFAULT_MAX_LEVELS = 4
+# Matches that aren't aligned with the coarse pixels can score badly at the
+# coarse levels, so the best candidates there are refined whatever they score
+_MAX_CANDIDATES = 64
+# How far (in pixels) around each candidate to search at the next finer level
+_REFINE_RADIUS = 2
+_NUM_CACHED_TEMPLATES = 32
+
+TemplateImage = Union[np.ndarray, str]
+
+
+class XQEMUTemplateMatch(NamedTuple):
+    """Where a template was found on screen
+
+    :param x: the left of the match in pixels
+    :param y: the top of the match in pixels
+    :param width: the width of the template
+    :param height: the height of the template
+    :param score: the normalised cross-correlation, 1 for a perfect match
+    """
+
+    x: int
+    y: int
+    width: int
+    height: int
+    score: float
+
+
+def _downsample(grey: np.ndarray) -> np.ndarray:
+    """Halve the size by averaging each 2x2 block of pixels"""
+    height, width = grey.shape[0] // 2, grey.shape[1] // 2
+    blocks = grey[: height * 2, : width * 2].reshape(height, 2, width, 2)
+    return blocks.mean(axis=(1, 3))
+
+
+def _get_window_sums(image: np.ndarray, height: int, width: int) -> np.ndarray:
+    """:returns: the sum of every height x width window that fits in the image"""
+    sums = np.pad(image, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+    return (
+        sums[height:, width:]
+        - sums[:-height, width:]
+        - sums[height:, :-width]
+        + sums[:-height, :-width]
+    )
+
+
+class _TemplatePyramid:
+    """A template at each level of detail, with what is needed to compute
+    normalised cross-correlation with it precomputed
+    """
+
+    def __init__(self, template: np.ndarray, max_levels: int):
+        grey = _to_grey(template).astype(np.float64)
+        self.height, self.width = grey.shape
+        # Zero mean templates and their norms, finest first
+        self.levels: List[Tuple[np.ndarray, float]] = []
+        while True:
+            zero_mean = grey - grey.mean()
+            norm = float(np.sqrt(np.sum(zero_mean * zero_mean)))
+            if not self.levels and norm == 0:
+                raise ValueError("Templates must not be a single colour")
+            self.levels.append((zero_mean, norm))
+            if (
+                len(self.levels) == max_levels
+                or min(grey.shape) // 2 < _MIN_TEMPLATE_SIZE
+            ):
+                break
+            grey = _downsample(grey)
+            if np.sum((grey - grey.mean()) ** 2) == 0:
+                break  # Too little detail left to search for
+
+
+class _TemplateCache:
+    """Least recently used cache of template pyramids, so that templates used
+    over and over (e.g. to navigate menus) are only prepared once
+    """
+
+    def __init__(self, max_size: int = _NUM_CACHED_TEMPLATES):
+        self._max_size = max_size
+        self._pyramids: "OrderedDict[tuple, _TemplatePyramid]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, template: TemplateImage, max_levels: int) -> _TemplatePyramid:
+        """:param template: an image, or the filename of a PNG or PPM image"""
+        if isinstance(template, str):
+            # Files are only loaded again if they change
+            key = (template, os.stat(template).st_mtime_ns, max_levels)
+        else:
+            digest = hashlib.sha1(np.ascontiguousarray(template).data).hexdigest()
+            key = (digest, template.shape, str(template.dtype), max_levels)
+        with self._lock:
+            pyramid = self._pyramids.get(key)
+            if pyramid is not None:
+                self._pyramids.move_to_end(key)
+                return pyramid
+        if isinstance(template, str):
+            template = _load_image(template)
+        pyramid = _TemplatePyramid(template, max_levels)
+        with self._lock:
+            self._pyramids[key] = pyramid
+            if len(self._pyramids) > self._max_size:
+                self._pyramids.popitem(last=False)
+        return pyramid
+
+
+_template_cache = _TemplateCache()
+
+
+def _load_image(filename: str) -> np.ndarray:
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".png":
+        return load_png(filename)
+    if extension == ".ppm":
+        return load_ppm(filename)
+    raise ValueError(f"Templates must be PNG or PPM images, not {filename}")
+
+
+def _correlate(image: np.ndarray, zero_mean: np.ndarray, norm: float) -> np.ndarray:
+    """:returns: the normalised cross-correlation at every position that the \
+        template fits, computed with FFTs
+    """
+    height, width = zero_mean.shape
+    shape = (image.shape[0] + height - 1, image.shape[1] + width - 1)
+    correlation = np.fft.irfft2(
+        np.fft.rfft2(image, shape) * np.fft.rfft2(zero_mean[::-1, ::-1], shape), shape
+    )[height - 1 : image.shape[0], width - 1 : image.shape[1]]
+    sums = _get_window_sums(image, height, width)
+    squared_sums = _get_window_sums(image * image, height, width)
+    variances = np.maximum(squared_sums - sums * sums / (height * width), 0)
+    return _normalise(correlation, variances, norm)
+
+
+def _normalise(correlation: np.ndarray, variances: np.ndarray, norm: float):
+    denominators = np.sqrt(variances) * norm
+    # Windows of a single colour don't match anything
+    flat = denominators < 1e-6 * norm
+    scores = correlation / np.where(flat, 1, denominators)
+    scores[flat] = 0
+    return scores
+
+
+def _refine(
+    image: np.ndarray, zero_mean: np.ndarray, norm: float, x: int, y: int
+) -> Optional[Tuple[float, int, int]]:
+    """Search the positions near (x, y) directly
+    :returns: the best score and its position, None if the template doesn't \
+        fit near there
+    """
+    height, width = zero_mean.shape
+    left = max(x - _REFINE_RADIUS, 0)
+    top = max(y - _REFINE_RADIUS, 0)
+    right = min(x + _REFINE_RADIUS, image.shape[1] - width)
+    bottom = min(y + _REFINE_RADIUS, image.shape[0] - height)
+    if right < left or bottom < top:
+        return None
+    patches = sliding_window_view(
+        image[top : bottom + height, left : right + width], (height, width)
+    )
+    correlation = np.einsum("abij,ij->ab", patches, zero_mean)
+    sums = patches.sum(axis=(2, 3))
+    squared_sums = np.einsum("abij,abij->ab", patches, patches)
+    variances = np.maximum(squared_sums - sums * sums / (height * width), 0)
+    scores = _normalise(correlation, variances, norm)
+    best_y, best_x = divmod(int(np.argmax(scores)), scores.shape[1])
+    return float(scores[best_y, best_x]), left + best_x, top + best_y
+
+
+def _pick_peaks(
+    scores: np.ndarray, min_score: float, height: int, width: int, max_peaks: int
+) -> List[Tuple[int, int]]:
+    """:returns: the positions of the best scores, best first, ignoring \
+        positions that overlap a better one by more than half
+    """
+    scores = scores.copy()
+    peaks = []
+    while len(peaks) < max_peaks and scores.size:
+        y, x = divmod(int(np.argmax(scores)), scores.shape[1])
+        if scores[y, x] < min_score:
+            break
+        peaks.append((x, y))
+        scores[
+            max(y - height // 2, 0) : y + height // 2 + 1,
+            max(x - width // 2, 0) : x + width // 2 + 1,
+        ] = -np.inf
+    return peaks
+
+
+def _remove_overlapping(matches: List[XQEMUTemplateMatch]) -> List[XQEMUTemplateMatch]:
+    kept: List[XQEMUTemplateMatch] = []
+    for match in sorted(matches, key=lambda match: -match.score):
+        if all(
+            abs(match.x - other.x) > match.width // 2
+            or abs(match.y - other.y) > match.height // 2
+            for other in kept
+        ):
+            kept.append(match)
+    return kept
+
+
+def find_template(
+    frame: np.ndarray,
+    template: TemplateImage,
+    region: Optional[XQEMUScreenRegion] = None,
+    threshold: float = 0.9,
+    max_matches: Optional[int] = None,
+    max_levels: int = _DEFAULT_MAX_LEVELS,
+) -> List[XQEMUTemplateMatch]:
+    """Find where a template appears in a frame. The frame is searched at \
+        low resolution first and the best candidates are refined at each \
+        higher resolution, so only a few positions are compared in full.
+
+    :param template: an image or the filename of a PNG or PPM image. The \
+        template's preparation is cached, so using the same template again \
+        is cheap
+    :param region: only search this part of the frame
+    :param threshold: the lowest normalised cross-correlation that counts \
+        as a match, from -1 to 1
+    :param max_matches: return at most this many matches
+    :param max_levels: the number of levels of detail to search
+    :returns: the matches, best first, in frame coordinates
+    :raises ValueError: if the template is a single colour
+    """
+    pyramid = _template_cache.get(template, max_levels)
+    grey = _to_grey(_crop(frame, region)).astype(np.float64)
+    images = [grey]
+    for _ in range(len(pyramid.levels) - 1):
+        images.append(_downsample(images[-1]))
+
+    coarsest = len(pyramid.levels) - 1
+    zero_mean, norm = pyramid.levels[coarsest]
+    if any(
+        image_size < template_size
+        for image_size, template_size in zip(images[coarsest].shape, zero_mean.shape)
+    ):
+        return []
+    candidates = _pick_peaks(
+        _correlate(images[coarsest], zero_mean, norm),
+        0.0 if coarsest else threshold,
+        *zero_mean.shape,
+        _MAX_CANDIDATES if coarsest else max_matches or _MAX_CANDIDATES,
+    )
+    matches = []
+    for x, y in candidates:
+        if coarsest == 0:
+            refined = _refine(grey, *pyramid.levels[0], x, y)
+        for level in range(coarsest - 1, -1, -1):
+            zero_mean, norm = pyramid.levels[level]
+            refined = _refine(images[level], zero_mean, norm, x * 2, y * 2)
+            if refined is None:
+                # The score and position would be from a coarser level
+                break
+            _, x, y = refined
+        if refined is not None and refined[0] >= threshold:
+            score, x, y = refined
+            matches.append(
+                XQEMUTemplateMatch(
+                    x + (region.x if region else 0),
+                    y + (region.y if region else 0),
+                    pyramid.width,
+                    pyramid.height,
+                    score,
+                )
+            )
+    return _remove_overlapping(matches)[:max_matches]
@@ -0,0 +1,406 @@
+"""asyncio versions of :py:class:`XQEMUXboxAppRunner` and the clients that
+it uses, so that one process (and one thread) can drive many instances of
+XQEMU at once
+"""
+import asyncio
+from asyncio.subprocess import Process
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractAsyncContextManager
+from io import BytesIO
+import json
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+import numpy as np
+from qmp import QMPError
+
+from .._logging import INPUT_LOGGER, KD_LOGGER
+
+# pytype: disable=pyi-error
+from . import (
+    XQEMUChannelTransport,
+    XQEMUFTPClient,
+    XQEMURAMSize,
+    XQEMUXboxControllerButtons,
+)
+
+# pytype: enable=pyi-error
+from .xqemu_readiness import XQEMUReadinessMonitor
+from .xqemu_xbox_app_runner import (
+    _XQEMUChannels,
+    _add_new_screenshot,
+    _get_frame_path,
+    _get_global_params,
+    _get_screenshot_path,
+    _get_xqemu_args,
+    _load_frame,
+    _remove_frame,
+)
+
+_T = TypeVar("_T")
+
+# ftplib is blocking so FTP operations are run here. The pool is shared by
+# every instance so that there is not a thread per instance of XQEMU
+_FTP_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="pyxboxtest-ftp")
+
+# KD lines can be very long (e.g. JSON output)
+_KD_STREAM_LIMIT = 2 ** 20
+
+
+async def _open_connection(
+    address: Union[int, str], limit: int = 2 ** 16
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """:param address: a local port or the path of a Unix socket"""
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(address, limit=limit)
+    return await asyncio.open_connection("127.0.0.1", address, limit=limit)
+
+
+class AsyncXQEMUKDCapturer:
+    """Captures kernel debug (serial port) output from XQEMU using asyncio"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Use :py:meth:`connect` rather than creating this directly"""
+        self._reader = reader
+        self._writer = writer
+
+    @classmethod
+    async def connect(
+        cls,
+        port: Union[int, str],
+        readiness: Optional[XQEMUReadinessMonitor] = None,
+    ) -> "AsyncXQEMUKDCapturer":
+        """:param port: the port on which XQEMU outputs KD data, or the path \
+            of a Unix socket
+        :param readiness: used to wait for XQEMU to open the port
+        """
+        if readiness is None:
+            readiness = XQEMUReadinessMonitor()
+        reader, writer = await readiness.wait_until_ready_async(
+            "kd", lambda: _open_connection(port, limit=_KD_STREAM_LIMIT)
+        )
+        return cls(reader, writer)
+
+    def close(self) -> None:
+        """Stop listening for serial port output"""
+        self._writer.close()
+
+    async def get_num_chars(self, num_chars: int, encoding: str = "ascii") -> str:
+        """Waits until output is available
+        :returns: at most num_chars characters
+        """
+        return (await self._reader.read(num_chars)).decode(encoding)
+
+    async def get_all(self, encoding: str = "ascii", wait_time: float = 0.001) -> str:
+        """:param wait_time: how long to wait for more data to arrive before \
+            deciding that there is no more available
+        :returns: all currently available data
+        """
+        chunks = []
+        while True:
+            try:
+                chunk = await asyncio.wait_for(self._reader.read(4096), wait_time)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks).decode(encoding)
+
+    async def get_line(self, delim_char="\n", encoding: str = "ascii") -> str:
+        """Waits until output is available
+        :returns: entire line (ending with delim_char) of kernel debug output
+        """
+        return (await self._reader.readuntil(delim_char.encode(encoding))).decode(
+            encoding
+        )
+
+
+class AsyncQEMUMonitorProtocol:
+    """A minimal asyncio QMP client"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Use :py:meth:`connect` rather than creating this directly"""
+        self._reader = reader
+        self._writer = writer
+        self._events: List[Dict[str, Any]] = []
+        # Responses are matched to commands by order so only one command may
+        # be in flight at a time
+        self._command_lock = asyncio.Lock()
+
+    @classmethod
+    async def connect(cls, port: Union[int, str]) -> "AsyncQEMUMonitorProtocol":
+        """Connect and negotiate capabilities
+        :param port: the QMP port, or the path of a Unix socket
+        :raises QMPError: if XQEMU does not greet us
+        """
+        reader, writer = await _open_connection(port)
+        qemu_monitor = cls(reader, writer)
+        try:
+            greeting = await qemu_monitor._read_message()
+            if "QMP" not in greeting:
+                raise QMPError("Did not receive a QMP greeting")
+            await qemu_monitor.command("qmp_capabilities")
+        except:
+            qemu_monitor.close()
+            raise
+        return qemu_monitor
+
+    async def _read_message(self) -> Dict[str, Any]:
+        line = await self._reader.readline()
+        if not line:
+            raise QMPError("QMP connection closed")
+        return json.loads(line)
+
+    async def command(self, cmd: str, **kwds) -> Any:
+        """Send a command and wait for its response
+        :returns: what the command returned
+        :raises QMPError: if XQEMU reports an error
+        """
+        message: Dict[str, Any] = {"execute": cmd}
+        if kwds:
+            message["arguments"] = kwds
+        async with self._command_lock:
+            self._writer.write(json.dumps(message).encode("utf-8"))
+            await self._writer.drain()
+            while True:
+                response = await self._read_message()
+                if "event" in response:
+                    self._events.append(response)
+                    continue
+                if "error" in response:
+                    raise QMPError(response["error"]["desc"])
+                return response["return"]
+
+    def get_events(self) -> List[Dict[str, Any]]:
+        """:returns: the events that have arrived whilst waiting for \
+            responses to commands. They are removed from the queue
+        """
+        events = self._events
+        self._events = []
+        return events
+
+    def close(self) -> None:
+        """Close the connection"""
+        self._writer.close()
+
+
+class AsyncXQEMUFTPClient:
+    """Runs the blocking :py:class:`XQEMUFTPClient` on a small thread pool
+    that is shared by all instances of XQEMU
+    """
+
+    def __init__(self, ftp_client: XQEMUFTPClient):
+        """Use :py:meth:`connect` rather than creating this directly"""
+        self._ftp_client = ftp_client
+
+    @classmethod
+    async def connect(
+        cls, forwarded_port: int, readiness: Optional[XQEMUReadinessMonitor] = None
+    ) -> "AsyncXQEMUFTPClient":
+        """:param forwarded_port: port that the FTP connection was forwarded to"""
+        ftp_client = await asyncio.get_running_loop().run_in_executor(
+            _FTP_EXECUTOR, lambda: XQEMUFTPClient(forwarded_port, readiness=readiness)
+        )
+        return cls(ftp_client)
+
+    async def run(self, operation: Callable[[XQEMUFTPClient], _T]) -> _T:
+        """Run any operation on the underlying FTP client
+        e.g. `await client.run(lambda ftp: ftp.mkd("/E/test"))`
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            _FTP_EXECUTOR, operation, self._ftp_client
+        )
+
+    async def login(self, username: str, password: str) -> None:
+        """Log in to the FTP server"""
+        await self.run(lambda ftp: ftp.login(username, password))
+
+    async def nlst(self, path: str) -> List[str]:
+        """:returns: the names of the files in a directory"""
+        return await self.run(lambda ftp: ftp.nlst(path))
+
+    async def upload(self, path: str, data: bytes) -> None:
+        """Store data in a file on the Xbox"""
+        await self.run(lambda ftp: ftp.storbinary(f"STOR {path}", BytesIO(data)))
+
+    async def download(self, path: str) -> bytes:
+        """:returns: the contents of a file on the Xbox"""
+        data = BytesIO()
+        await self.run(lambda ftp: ftp.retrbinary(f"RETR {path}", data.write))
+        return data.getvalue()
+
+    async def close(self) -> None:
+        """Close the connection"""
+        await self.run(lambda ftp: ftp.close())
+
+
+class AsyncXQEMUXboxAppRunner(AbstractAsyncContextManager):
+    """The same as :py:class:`XQEMUXboxAppRunner` but for use with asyncio,
+    use it with async with. Many of these can be run at once from a single
+    thread e.g. to test multiple consoles talking to each other.
+    """
+
+    def __init__(
+        self,
+        hdd_filename: Optional[str] = None,
+        dvd_filename: Optional[str] = None,
+        ram_size: XQEMURAMSize = XQEMURAMSize.RAM64m,
+        force_headless: bool = False,
+        channel_transport: Optional[XQEMUChannelTransport] = None,
+    ):
+        """:param force_headless: only use this if you are doing something
+        fancy like using a "hidden" Xbox app to do some test setup!
+        :param channel_transport: how to connect to XQEMU's KD and QMP \
+            channels, defaults to the one chosen on the command line
+        """
+        global_params = _get_global_params()
+
+        self._channels = _XQEMUChannels(
+            channel_transport or global_params.channel_transport
+        )
+        self._xqemu_args = _get_xqemu_args(
+            global_params,
+            ram_size,
+            force_headless or global_params.headless,
+            hdd_filename,
+            dvd_filename,
+            self._channels,
+        )
+
+        self._app: Optional[Process] = None
+        self._readiness: Optional[XQEMUReadinessMonitor] = None
+        self._kd_capturer_instance: Optional[AsyncXQEMUKDCapturer] = None
+        self._qemu_monitor_instance: Optional[AsyncQEMUMonitorProtocol] = None
+        # Created on entry so that it belongs to the running event loop
+        self._qemu_monitor_lock: Optional[asyncio.Lock] = None
+
+    async def get_ftp_client(
+        self, username: Optional[str] = None, password: Optional[str] = None
+    ) -> AsyncXQEMUFTPClient:
+        """This assumes that an FTP client is actually running in the app..."""
+        ftp_client = await AsyncXQEMUFTPClient.connect(
+            self._channels.ftp_forward_port, self._get_readiness()
+        )
+        if username is not None and password is not None:
+            await ftp_client.login(username, password)
+        return ftp_client
+
+    async def get_qemu_monitor(self) -> AsyncQEMUMonitorProtocol:
+        """:returns: a qemu monitor that's used to communicate with XQEMU"""
+        readiness = self._get_readiness()
+        async with self._qemu_monitor_lock:
+            if self._qemu_monitor_instance is None:
+                self._qemu_monitor_instance = await readiness.wait_until_ready_async(
+                    "qmp",
+                    lambda: AsyncQEMUMonitorProtocol.connect(
+                        self._channels.qemu_monitor_address
+                    ),
+                    (OSError, QMPError),
+                )
+        return self._qemu_monitor_instance
+
+    async def press_controller_buttons(
+        self,
+        buttons: Sequence[XQEMUXboxControllerButtons],
+        hold_time: Optional[int] = None,
+    ) -> None:
+        """Press buttons on the virtual xbox controller"""
+        args: Dict[str, Any] = {
+            "keys": [{"type": "qcode", "data": key.value} for key in buttons]
+        }
+        if hold_time is not None:
+            args["hold-time"] = hold_time
+        INPUT_LOGGER.info("send-key %s", args)
+        await (await self.get_qemu_monitor()).command("send-key", **args)
+
+    async def reset_xbox(self) -> None:
+        """Reset the Xbox, see :py:meth:`XQEMUXboxAppRunner.reset_xbox`"""
+        INPUT_LOGGER.info("system_reset")
+        await (await self.get_qemu_monitor()).command("system_reset")
+
+    async def save_screenshot(self, filename: str) -> str:
+        """Save a screenshot in ppm format, see \
+            :py:meth:`XQEMUXboxAppRunner.save_screenshot`
+        :returns: the path to the screenshot
+        """
+        screenshot_path = _get_screenshot_path(filename)
+        await (await self.get_qemu_monitor()).command(
+            "screendump", filename=screenshot_path
+        )
+        _add_new_screenshot(screenshot_path)
+        return screenshot_path
+
+    async def grab_frame(self) -> np.ndarray:
+        """Get what is on screen without leaving a file behind, see \
+            :py:meth:`XQEMUXboxAppRunner.grab_frame`
+        """
+        frame_path = _get_frame_path()
+        try:
+            await (await self.get_qemu_monitor()).command(
+                "screendump", filename=frame_path
+            )
+            return _load_frame(frame_path)
+        finally:
+            _remove_frame(frame_path)
+
+    def get_kd_capturer(self) -> AsyncXQEMUKDCapturer:
+        """Can be used to retrieve text from the serial port"""
+        return self._kd_capturer_instance
+
+    def get_times_to_ready(self) -> Dict[str, float]:
+        """:returns: how long after XQEMU was started each channel became \
+            ready, in seconds
+        """
+        return self._get_readiness().get_times_to_ready()
+
+    def _get_readiness(self) -> XQEMUReadinessMonitor:
+        """:raises RuntimeError: if XQEMU hasn't been started with async with"""
+        if self._readiness is None:
+            raise RuntimeError("XQEMU hasn't been started, use async with")
+        return self._readiness
+
+    async def __aenter__(self):
+        self._qemu_monitor_lock = asyncio.Lock()
+        self._app = await asyncio.create_subprocess_exec(
+            *self._xqemu_args, **self._channels.get_popen_kwargs()
+        )
+        self._channels.xqemu_started()
+        self._readiness = XQEMUReadinessMonitor(self._app)
+        try:
+            self._kd_capturer_instance = await AsyncXQEMUKDCapturer.connect(
+                self._channels.kd_address, self._readiness
+            )
+        except:
+            await self._stop_xqemu()
+            raise
+        return self
+
+    async def _stop_xqemu(self) -> None:
+        if self._app.returncode is None:
+            self._app.terminate()
+        # Wait so that we can be sure that we can use the HDD image elsewhere
+        await self._app.wait()
+        self._channels.release()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            KD_LOGGER.info(
+                "Uncaptured KD output:\n%s", await self._kd_capturer_instance.get_all()
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            KD_LOGGER.warning("Error getting uncaptured KD output: %s", e)
+
+        self._kd_capturer_instance.close()
+        if self._qemu_monitor_instance is not None:
+            self._qemu_monitor_instance.close()
+        await self._stop_xqemu()
@@ -1,9 +1,10 @@
 """Allow an FTP connection to an Xbox app running FTP server within XQEMU"""
 from ftplib import FTP
+from typing import Optional
 
 from overrides import overrides
 
-from .._utils import retry_every
+from .xqemu_readiness import XQEMUReadinessMonitor
 
 
 class XQEMUFTPClient(FTP):
@@ -14,16 +15,27 @@ class XQEMUFTPClient(FTP):
 
     externalip = "10.0.2.2"
 
-    def __init__(self, forwarded_port: int, timeout: int = 60):
-        """:param forwarded_port: port that the FTP connection was forwarded to"""
+    def __init__(
+        self,
+        forwarded_port: int,
+        timeout: int = 60,
+        readiness: Optional[XQEMUReadinessMonitor] = None,
+    ):
+        """:param forwarded_port: port that the FTP connection was forwarded to
+        :param readiness: used to wait for the FTP server to start
+        """
         super().__init__()
         self.set_pasv(False)
+        if readiness is None:
+            readiness = XQEMUReadinessMonitor()
 
-        # If the connection is opened too early then it cannot connect
+        # If the connection is opened too early then it cannot connect.
+        # XQEMU accepts forwarded connections before the server in the app is
+        # running and then closes them, so ftplib sees EOF instead of a welcome
         def try_connect():
             self.connect("127.0.0.1", forwarded_port, timeout)
 
-        retry_every(try_connect)
+        readiness.wait_until_ready("ftp", try_connect, (OSError, EOFError))
 
     @overrides
     def sendport(self, host, port):
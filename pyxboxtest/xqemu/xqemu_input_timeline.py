@@ -0,0 +1,207 @@
+"""Scripts of controller input with precise timing, e.g. combos.
+
+Events at the same time are sent in a single input-send-event command, so
+the guest sees them together, and each command is sent at its time by
+sleeping until just before it and then spinning.
+"""
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+
+from .xqemu_controller_buttons import XQEMUXboxControllerButtons
+
+# Sleeping can overshoot by a millisecond or so, spin for the last part
+_DEFAULT_SPIN_TIME = 0.002
+# Times are rounded to microseconds so that e.g. holding from 0.1s for 0.05s
+# ends at the same time as a press at 0.15s
+_TIME_DECIMALS = 6
+
+
+class XQEMUInputEvent(NamedTuple):
+    """A button being pressed or released
+
+    :param time: seconds after the start of the timeline
+    :param button: the button
+    :param down: True if pressed, False if released
+    """
+
+    time: float
+    button: XQEMUXboxControllerButtons
+    down: bool
+
+
+class XQEMUInputBatch(NamedTuple):
+    """Events sent in one input-send-event command
+
+    :param time: seconds after the start of the timeline
+    :param events: the input-send-event arguments for each event
+    """
+
+    time: float
+    events: Tuple[Dict[str, Any], ...]
+
+
+class XQEMUInputTimelineReport(NamedTuple):
+    """How precisely a timeline was played
+
+    :param num_batches: the number of commands sent
+    :param num_events: the number of presses and releases sent
+    :param lateness: how late (in seconds) each command was sent
+    :param mean_jitter: the mean lateness in seconds
+    :param max_jitter: the largest lateness in seconds
+    :param max_round_trip: the longest that XQEMU took to respond, in seconds
+    """
+
+    num_batches: int
+    num_events: int
+    lateness: Tuple[float, ...]
+    mean_jitter: float
+    max_jitter: float
+    max_round_trip: float
+
+
+class XQEMUInputTimeline:
+    """A script of controller input, built by chaining calls, e.g. a combo::
+
+        XQEMUInputTimeline().hold(0, 0.1, DPAD_DOWN).hold(0.1, 0.1, A, B)
+
+    All times are in seconds from the start of the timeline
+    """
+
+    def __init__(self):
+        self._events: List[XQEMUInputEvent] = []
+
+    def press(
+        self, time_offset: float, *buttons: XQEMUXboxControllerButtons
+    ) -> "XQEMUInputTimeline":
+        """Press buttons and keep them pressed"""
+        if time_offset < 0:
+            raise ValueError(f"Events can't be before the start: {time_offset}")
+        self._events += (
+            XQEMUInputEvent(round(time_offset, _TIME_DECIMALS), button, True)
+            for button in buttons
+        )
+        return self
+
+    def release(
+        self, time_offset: float, *buttons: XQEMUXboxControllerButtons
+    ) -> "XQEMUInputTimeline":
+        """Release buttons that were pressed"""
+        if time_offset < 0:
+            raise ValueError(f"Events can't be before the start: {time_offset}")
+        self._events += (
+            XQEMUInputEvent(round(time_offset, _TIME_DECIMALS), button, False)
+            for button in buttons
+        )
+        return self
+
+    def hold(
+        self,
+        time_offset: float,
+        duration: float,
+        *buttons: XQEMUXboxControllerButtons,
+    ) -> "XQEMUInputTimeline":
+        """Press buttons and release them after the duration"""
+        if duration <= 0:
+            raise ValueError(f"Buttons must be held for some time: {duration}")
+        return self.press(time_offset, *buttons).release(
+            time_offset + duration, *buttons
+        )
+
+    def get_events(self) -> Tuple[XQEMUInputEvent, ...]:
+        """:returns: the events in the order they will be sent, releases \
+            before presses at the same time
+        """
+        return tuple(sorted(self._events, key=lambda event: (event.time, event.down)))
+
+    def compile(self) -> Tuple[XQEMUInputBatch, ...]:
+        """:returns: the input-send-event commands to send
+        :raises ValueError: if a button is pressed whilst pressed, released \
+            whilst released, released and pressed again at the same time or \
+            left pressed at the end
+        """
+        pressed = set()
+        # The guest polls the controller, so a button released and pressed
+        # again in one command would just look held
+        release_times: Dict[XQEMUXboxControllerButtons, float] = {}
+        batches: List[XQEMUInputBatch] = []
+        for event in self.get_events():
+            if event.down == (event.button in pressed):
+                raise ValueError(
+                    f"{event.button.name} is already "
+                    + ("pressed" if event.down else "released")
+                    + f" at {event.time}s"
+                )
+            if event.down and release_times.get(event.button) == event.time:
+                raise ValueError(
+                    f"{event.button.name} is released and pressed again at the "
+                    f"same time, {event.time}s, so would never be seen released"
+                )
+            if event.down:
+                pressed.add(event.button)
+            else:
+                pressed.remove(event.button)
+                release_times[event.button] = event.time
+            qmp_event = {
+                "type": "key",
+                "data": {
+                    "down": event.down,
+                    "key": {"type": "qcode", "data": event.button.value},
+                },
+            }
+            if batches and batches[-1].time == event.time:
+                batches[-1] = XQEMUInputBatch(
+                    event.time, batches[-1].events + (qmp_event,)
+                )
+            else:
+                batches.append(XQEMUInputBatch(event.time, (qmp_event,)))
+        if pressed:
+            raise ValueError(
+                "Buttons are never released: "
+                + ", ".join(sorted(button.name for button in pressed))
+            )
+        return tuple(batches)
+
+
+def _wait_until(target_time: float, spin_time: float) -> None:
+    remaining = target_time - time.perf_counter()
+    if remaining > spin_time:
+        time.sleep(remaining - spin_time)
+    while time.perf_counter() < target_time:
+        pass
+
+
+def play_input_timeline(
+    command: Callable[..., Any],
+    timeline: XQEMUInputTimeline,
+    spin_time: float = _DEFAULT_SPIN_TIME,
+) -> XQEMUInputTimelineReport:
+    """Send a timeline's input, blocking until it has all been sent
+
+    :param command: sends a QMP command, e.g. the command method of \
+        :py:class:`~qmp.QEMUMonitorProtocol`
+    :param spin_time: how long before each command to stop sleeping and \
+        spin, longer is more precise but uses more CPU
+    :returns: how late each command was sent. A command that takes XQEMU \
+        longer to respond to than the gap before the next makes the next late
+    :raises ValueError: if the timeline is invalid, see \
+        :py:meth:`XQEMUInputTimeline.compile`
+    """
+    batches = timeline.compile()
+    lateness = []
+    max_round_trip = 0.0
+    start_time = time.perf_counter()
+    for batch in batches:
+        target_time = start_time + batch.time
+        _wait_until(target_time, spin_time)
+        send_time = time.perf_counter()
+        command("input-send-event", events=list(batch.events))
+        max_round_trip = max(max_round_trip, time.perf_counter() - send_time)
+        lateness.append(send_time - target_time)
+    return XQEMUInputTimelineReport(
+        len(batches),
+        sum(len(batch.events) for batch in batches),
+        tuple(lateness),
+        sum(lateness) / len(lateness) if lateness else 0.0,
+        max(lateness, default=0.0),
+        max_round_trip,
+    )
@@ -1,72 +1,500 @@
 """Captures kernel debug (serial port) output from XQEMU"""
+import codecs
+import select
 import socket
+import struct
+import threading
+import time
+from typing import Any, Iterator, Optional, Sequence, Union
 
-from .._utils import retry_every
+from .._logging import KD_LOGGER
+from .xqemu_kd_hub import XQEMUKDHub, XQEMUKDHubStats
+from .xqemu_kd_log import XQEMUKDLog
+from .xqemu_kd_records import XQEMUKDRecordTimeoutError, _JSONRecordFilter
+from .xqemu_kd_telemetry import XQEMUKDTelemetry, _KDTelemetryFilter
+from .xqemu_kd_ring_buffer import (
+    _DEFAULT_MAX_CHARS,
+    XQEMUKDCursor,
+    XQEMUKDRingBuffer,
+)
+from .xqemu_kd_expect import (
+    KDPattern,
+    XQEMUKDExpectTimeoutError,
+    XQEMUKDMatch,
+    _KDPatternMatcher,
+)
+from .xqemu_readiness import XQEMUReadinessMonitor
+
+# Read in large chunks so that verbose apps don't cost a syscall per byte
+_CHUNK_SIZE = 65536
 
 
 class XQEMUKDCapturer:
-    """Captures kernel debug (serial port) output from XQEMU"""
+    """Captures kernel debug (serial port) output from XQEMU
+
+    By default output is only read from the socket when a getter is called.
+    If capture_in_background is set, a background thread reads output as soon
+    as it arrives into a ring buffer of timestamped lines instead, so XQEMU
+    never has to wait for the test to read it. The getters then read from the
+    ring buffer and their encoding arguments are ignored.
+
+    To watch many instances of XQEMU without a thread for each, give them all
+    the same :py:class:`~pyxboxtest.xqemu.XQEMUKDHub` instead.
+
+    Telemetry lines (see :py:mod:`~pyxboxtest.xqemu.xqemu_kd_telemetry`) are
+    removed from the output and aggregated, see :py:meth:`get_telemetry`.
+    """
+
+    def __init__(
+        self,
+        port: Union[int, str],
+        readiness: Optional[XQEMUReadinessMonitor] = None,
+        capture_in_background: bool = False,
+        max_buffered_chars: int = _DEFAULT_MAX_CHARS,
+        background_encoding: str = "ascii",
+        hub: Optional[XQEMUKDHub] = None,
+        log: Optional[XQEMUKDLog] = None,
+        parse_telemetry: bool = True,
+    ):
+        """:param port: the port on which to listen, or the path of a Unix \
+            socket
+        :param readiness: used to wait for XQEMU to open the port
+        :param max_buffered_chars: how much output the ring buffer keeps when \
+            capturing in the background
+        :param background_encoding: used to decode the output when capturing \
+            in the background
+        :param hub: capture in the background using this hub's thread rather \
+            than a thread of our own
+        :param log: all the raw output that is received is also written here, \
+            whether or not it is read by a test
+        :param parse_telemetry: recognise telemetry lines, if False they are \
+            left in the output
+        """
+        if readiness is None:
+            readiness = XQEMUReadinessMonitor()
+        if isinstance(port, str):
+            self._client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = port
+        else:
+            self._client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = ("", port)
+        readiness.wait_until_ready("kd", lambda: self._client.connect(address))
 
-    def __init__(self, port: int):
-        """:param port: the port on which to listen"""
-        self._client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        retry_every(lambda: self._client.connect(("", port)))
+        # Data that has been received but not returned yet. Bytes are decoded
+        # incrementally so that a multi-byte character split across two
+        # reads is not corrupted
+        self._encoding = "ascii"
+        self._decoder = codecs.getincrementaldecoder(self._encoding)()
+        self._buffer = ""
+        # Index of the first character in the buffer that has not been
+        # returned. Avoids copying the rest of the buffer for every line
+        self._position = 0
+        # How many characters have been returned in total
+        self._num_consumed = 0
+        self._eof = False
+
+        self._telemetry: Optional[XQEMUKDTelemetry] = None
+        self._telemetry_filter: Optional[_KDTelemetryFilter] = None
+        if parse_telemetry:
+            self._telemetry = XQEMUKDTelemetry()
+
+        self._log = log
+        self._background_encoding = background_encoding
+        self._ring_buffer: Optional[XQEMUKDRingBuffer] = None
+        self._cursor: Optional[XQEMUKDCursor] = None
+        self._reader_thread: Optional[threading.Thread] = None
+        self._hub = hub
+        self._hub_key: Optional[str] = None
+        if capture_in_background or hub is not None:
+            self._ring_buffer = XQEMUKDRingBuffer(
+                max_buffered_chars, background_encoding, log, self._telemetry
+            )
+            self._cursor = self._ring_buffer.get_cursor()
+        elif self._telemetry is not None:
+            self._telemetry_filter = _KDTelemetryFilter(self._telemetry)
+        if hub is not None:
+            self._hub_key = hub.register(self._client, self._ring_buffer, str(port))
+        elif capture_in_background:
+            self._reader_thread = threading.Thread(
+                target=self._read_in_background,
+                name="pyxboxtest-kd-reader",
+                daemon=True,
+            )
+            self._reader_thread.start()
 
     def close(self) -> None:
         """Stop listening for serial port output"""
+        if self._hub_key is not None:
+            self._hub.unregister(self._hub_key)
+        if self._reader_thread is not None:
+            # Wakes up the reader thread
+            try:
+                self._client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._reader_thread.join()
         self._client.close()
 
-    def _get_num_chars(
-        self, num_chars: int, encoding: str, blocking: bool = True
-    ) -> str:
-        """Used internally to get a number of characters
-        :returns: at most num_chars characters
+    def _read_in_background(self) -> None:
+        """Runs in the reader thread until the connection is closed"""
+        try:
+            while True:
+                data = self._client.recv(_CHUNK_SIZE)
+                if not data:
+                    break
+                self._ring_buffer.feed(data)
+        except OSError:
+            pass
+        finally:
+            self._ring_buffer.close()
+
+    def get_cursor(self, from_oldest: bool = True) -> XQEMUKDCursor:
+        """Read timestamped lines independently of the getters and of any \
+            other cursors
+
+        :param from_oldest: start at the oldest line that is still stored \
+            rather than at the next line to arrive
+        :raises RuntimeError: if not capturing in the background
         """
+        if self._ring_buffer is None:
+            raise RuntimeError("Cursors need capture_in_background=True")
+        return self._ring_buffer.get_cursor(from_oldest)
+
+    def get_hub_stats(self) -> XQEMUKDHubStats:
+        """:returns: the hub's counters for this instance of XQEMU
+        :raises RuntimeError: if not capturing with a hub
+        """
+        if self._hub_key is None:
+            raise RuntimeError("Not capturing with a hub")
+        return self._hub.get_stats(self._hub_key)[self._hub_key]
+
+    def get_telemetry(self) -> XQEMUKDTelemetry:
+        """:returns: the telemetry received so far. When not capturing in \
+            the background, any output that is waiting is read first (it \
+            can still be read by the getters)
+        :raises RuntimeError: if telemetry isn't being parsed
+        """
+        if self._telemetry is None:
+            raise RuntimeError("Telemetry needs parse_telemetry=True")
+        if self._cursor is None:
+            while self._receive(blocking=False):
+                pass
+        return self._telemetry
+
+    def _set_encoding(self, encoding: str) -> None:
+        """Re-decode any buffered data if the encoding has changed"""
+        if encoding == self._encoding or self._ring_buffer is not None:
+            return
+        undecoded, _ = self._decoder.getstate()
+        pending = self._buffer[self._position :].encode(self._encoding) + undecoded
+        self._encoding = encoding
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._buffer = self._decoder.decode(pending)
+        self._position = 0
+
+    def _receive(self, blocking: bool) -> bool:
+        """Read a chunk of data into the buffer
+        :returns: False if no data was available or the connection is closed
+        """
+        if self._eof:
+            return False
+        if self._cursor is not None:
+            text = self._receive_from_ring_buffer(blocking)
+        else:
+            text = self._receive_from_socket(blocking)
+        if text is None:
+            return False
+        self._buffer = self._buffer[self._position :] + text
+        self._position = 0
+        return True
+
+    def _receive_before(self, deadline: float) -> bool:
+        """Wait until the deadline for some data to read into the buffer
+        :returns: False if no data arrived or the connection is closed
+        """
+        timeout = deadline - time.perf_counter()
+        if self._eof or timeout <= 0:
+            return False
+        if self._cursor is not None:
+            line = self._cursor.read_line(timeout)
+            if line is None:
+                self._eof = self._ring_buffer.is_closed()
+                return False
+            self._buffer = self._buffer[self._position :] + line.text
+            self._position = 0
+            return True
+        readable, _, _ = select.select((self._client,), (), (), timeout)
+        return bool(readable) and self._receive(blocking=False)
+
+    def _receive_until(self, deadline: Optional[float]) -> bool:
+        """Wait for some data to read into the buffer
+        :param deadline: wait forever if None
+        :returns: False if no data arrived or the connection is closed
+        """
+        if deadline is None:
+            return self._receive(blocking=True)
+        return self._receive_before(deadline)
+
+    def _receive_from_socket(self, blocking: bool) -> Optional[str]:
+        """:returns: None if no data was available or the connection is closed"""
         if blocking:
-            data = self._client.recv(num_chars)
+            data = self._client.recv(_CHUNK_SIZE)
         else:
             try:
-                data = self._client.recv(num_chars, socket.MSG_DONTWAIT)
+                data = self._client.recv(_CHUNK_SIZE, socket.MSG_DONTWAIT)
             except BlockingIOError:
-                return ""
+                return None
+
+        if not data:
+            self._eof = True
+            if self._telemetry_filter is not None:
+                # An incomplete line held back in case it was telemetry
+                return self._telemetry_filter.flush(time.perf_counter()) or None
+            return None
+        if self._log is not None:
+            self._log.write(data)
+        text = self._decoder.decode(data)
+        if self._telemetry_filter is not None:
+            text = self._telemetry_filter.feed(text, time.perf_counter())
+        return text
 
-        return data.decode(encoding)
+    def _receive_from_ring_buffer(self, blocking: bool) -> Optional[str]:
+        """:returns: None if no lines were available or the connection is \
+            closed
+        """
+        if blocking:
+            line = self._cursor.read_line()
+            if line is None:
+                self._eof = True
+                return None
+            return line.text
+        lines = self._cursor.read_available()
+        return "".join(line.text for line in lines) if lines else None
+
+    def _take(self, num_chars: int) -> str:
+        """Remove and return up to num_chars characters from the buffer"""
+        data = self._buffer[self._position : self._position + num_chars]
+        self._position += len(data)
+        self._num_consumed += len(data)
+        return data
+
+    def _num_buffered_chars(self) -> int:
+        return len(self._buffer) - self._position
 
     def get_num_chars(self, num_chars: int, encoding: str = "ascii") -> str:
         """Blocks until output is available
         :returns: at most num_chars characters
         """
-        data = self._get_num_chars(num_chars, encoding)
-        print(data)
+        self._set_encoding(encoding)
+        # A chunk may end part way through a character, leaving nothing new
+        while not self._num_buffered_chars() and self._receive(blocking=True):
+            pass
+        data = self._take(num_chars)
+        KD_LOGGER.info("%s", data)
         return data
 
     def get_all(self, encoding: str = "ascii") -> str:
         """Non-blocking
         :returns: all currently available data
         """
-        chunk_size = 4096
-        ret = ""
-        data = self._get_num_chars(chunk_size, encoding, False)
-
-        while data:
-            ret += data
-            data = self._get_num_chars(chunk_size, encoding, False)
-
-        print(ret)
+        self._set_encoding(encoding)
+        while self._receive(blocking=False):
+            pass
+        ret = self._take(self._num_buffered_chars())
+        KD_LOGGER.info("%s", ret)
         return ret
 
-    def get_line(self, delim_char="\n", encoding: str = "ascii") -> str:
+    def get_line(
+        self,
+        delim_char="\n",
+        encoding: str = "ascii",
+        timeout: Optional[float] = None,
+    ) -> str:
         """Blocks until output is available
+        :param timeout: how long to wait for the line in seconds, forever if \
+            None
         :returns: entire line (ending with delim_char) of kernel debug output
+        :raises EOFError: if XQEMU closes the connection part way through a \
+            line
+        :raises XQEMUKDRecordTimeoutError: if the line doesn't arrive in time
         """
-        # Go character by character so that we don't read too far ahead.
-        # However, this method may be slow so the implementation may change in the future...
-        chunk_size = 1
-        char = self._get_num_chars(chunk_size, encoding)
-        line = char
-        while char != delim_char:
-            char = self._get_num_chars(chunk_size, encoding)
-            line += char
-
-        print(line)
+        self._set_encoding(encoding)
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        line = self._read_line(delim_char, deadline)
+        if line is None:
+            raise EOFError("KD connection closed before a full line was received")
+        KD_LOGGER.info("%s", line)
         return line
+
+    def _read_line(self, delim_char: str, deadline: Optional[float]) -> Optional[str]:
+        """:param deadline: wait forever if None
+        :returns: the next line or None if the connection is closed first
+        :raises XQEMUKDRecordTimeoutError: if the deadline passes first
+        """
+        delim_index = self._buffer.find(delim_char, self._position)
+        while delim_index == -1:
+            # Only search the newly received data next time
+            searched = max(self._num_buffered_chars() - len(delim_char) + 1, 0)
+            if not self._receive_until(deadline):
+                if self._eof:
+                    return None
+                self._raise_if_past(deadline)
+                continue
+            delim_index = self._buffer.find(delim_char, searched)
+        return self._take(delim_index + len(delim_char) - self._position)
+
+    def _read_chars(self, num_chars: int, deadline: Optional[float]) -> Optional[str]:
+        """:param deadline: wait forever if None
+        :returns: exactly num_chars characters or None if the connection is \
+            closed first
+        :raises XQEMUKDRecordTimeoutError: if the deadline passes first
+        """
+        while self._num_buffered_chars() < num_chars:
+            if not self._receive_until(deadline):
+                if self._eof:
+                    return None
+                self._raise_if_past(deadline)
+        return self._take(num_chars)
+
+    @staticmethod
+    def _raise_if_past(deadline: Optional[float]) -> None:
+        if deadline is not None and time.perf_counter() >= deadline:
+            raise XQEMUKDRecordTimeoutError("Timed out waiting for the next record")
+
+    def iter_json_records(
+        self,
+        keys: Optional[Sequence[str]] = None,
+        timeout: Optional[float] = None,
+        skip_invalid: bool = True,
+        encoding: str = "ascii",
+    ) -> Iterator[Any]:
+        """Decode KD output that contains one JSON document per line, e.g. \
+            telemetry from an app. Lines that aren't JSON objects or arrays \
+            are skipped. Iteration stops when XQEMU closes the connection.
+
+        :param keys: only yield objects that contain all of these keys. Lines \
+            that can't contain them are skipped without being decoded
+        :param timeout: how long to wait for each record in seconds, forever \
+            if None
+        :param skip_invalid: skip lines that look like JSON but aren't valid
+        :raises XQEMUKDRecordTimeoutError: if a record does not arrive in time
+        :raises XQEMUKDInvalidRecordError: if a line is not valid JSON and \
+            skip_invalid is False
+        """
+        record_filter = _JSONRecordFilter(keys, skip_invalid)
+        self._set_encoding(encoding)
+        while True:
+            deadline = None if timeout is None else time.perf_counter() + timeout
+            record = None
+            while record is None:
+                line = self._read_line("\n", deadline)
+                if line is None:
+                    return
+                # Debug as there may be a huge number of records
+                KD_LOGGER.debug("%s", line)
+                record = record_filter.decode(line)
+            yield record
+
+    def get_json_record(
+        self,
+        keys: Optional[Sequence[str]] = None,
+        timeout: Optional[float] = None,
+        encoding: str = "ascii",
+    ) -> Any:
+        """:returns: the next JSON record, see :py:meth:`iter_json_records`
+        :raises EOFError: if XQEMU closes the connection first
+        """
+        for record in self.iter_json_records(keys, timeout, encoding=encoding):
+            return record
+        raise EOFError("KD connection closed before a record was received")
+
+    def iter_binary_records(
+        self, header_format: str = "<I", timeout: Optional[float] = None
+    ) -> Iterator[bytes]:
+        """Decode KD output made of records that each start with their length
+
+        :param header_format: :py:mod:`struct` format of the length
+        :param timeout: how long to wait for each record in seconds, forever \
+            if None
+        :raises XQEMUKDRecordTimeoutError: if a record does not arrive in time
+        :raises ValueError: if capturing in the background with an encoding \
+            that can't represent binary data or with parse_telemetry set
+        """
+        # latin-1 maps every byte to the character with the same value, so
+        # binary data can pass through the text buffer unchanged
+        if self._ring_buffer is not None:
+            if codecs.lookup(self._background_encoding).name != "iso8859-1":
+                raise ValueError("Binary records need background_encoding='latin-1'")
+            if self._telemetry is not None:
+                raise ValueError("Binary records need parse_telemetry=False")
+        self._set_encoding("latin-1")
+        if self._telemetry_filter is not None:
+            # Binary data could look like telemetry, so stop parsing it
+            held = self._telemetry_filter.flush(time.perf_counter())
+            self._telemetry_filter = None
+            self._buffer = self._buffer[self._position :] + held
+            self._position = 0
+        header = struct.Struct(header_format)
+        while True:
+            deadline = None if timeout is None else time.perf_counter() + timeout
+            length_chars = self._read_chars(header.size, deadline)
+            if length_chars is None:
+                return
+            (length,) = header.unpack(length_chars.encode("latin-1"))
+            payload = self._read_chars(length, deadline)
+            if payload is None:
+                raise EOFError("KD connection closed part way through a record")
+            yield payload.encode("latin-1")
+
+    def expect(
+        self,
+        patterns: Union[KDPattern, Sequence[KDPattern]],
+        timeout: float = 30.0,
+        encoding: str = "ascii",
+    ) -> XQEMUKDMatch:
+        """Wait for KD output that matches any of the patterns. All output up \
+            to the end of the match is consumed.
+
+        If several patterns match, the one whose match ends first wins, then \
+        the one that comes first in patterns. Many literal patterns are \
+        matched in a single pass over the output.
+
+        :param patterns: literal strings and/or compiled regexes
+        :param timeout: how long to wait in seconds
+        :raises XQEMUKDExpectTimeoutError: if nothing matches in time, the \
+            output is not consumed
+        :raises EOFError: if XQEMU closes the connection before a match
+        """
+        if isinstance(patterns, str) or not isinstance(patterns, Sequence):
+            patterns = (patterns,)
+        matcher = _KDPatternMatcher(patterns)
+        self._set_encoding(encoding)
+        deadline = time.perf_counter() + timeout
+
+        found = matcher.search(self._buffer, self._position, self._position)
+        while found is None:
+            # Positions in the buffer change when more data is received
+            num_searched = len(self._buffer) - self._position
+            if not self._receive_before(deadline):
+                if self._eof:
+                    raise EOFError("KD connection closed before a match was found")
+                if time.perf_counter() >= deadline:
+                    raise XQEMUKDExpectTimeoutError(
+                        f"No match for {patterns} after {timeout} seconds. Most"
+                        f" recent output: {self._buffer[self._position :][-200:]!r}"
+                    )
+                continue
+            found = matcher.search(
+                self._buffer, self._position, self._position + num_searched
+            )
+
+        pattern_index, match_start, match_end, groups = found
+        match = XQEMUKDMatch(
+            matcher.get_pattern(pattern_index),
+            pattern_index,
+            self._buffer[match_start:match_end],
+            groups,
+            self._num_consumed + match_start - self._position,
+        )
+        KD_LOGGER.info("%s", self._take(match_end - self._position))
+        return match
@@ -0,0 +1,178 @@
+"""Matching of literal strings and regexes against streaming KD output, used
+by :py:meth:`~pyxboxtest.xqemu.XQEMUKDCapturer.expect`
+"""
+from collections import deque
+from typing import Dict, List, NamedTuple, Optional, Pattern, Sequence, Tuple, Union
+
+KDPattern = Union[str, Pattern[str]]
+# (pattern index, match start, match end, groups)
+_Found = Tuple[int, int, int, Tuple[Optional[str], ...]]
+
+# Below this many literals it is quicker to use str.find for each one
+_MIN_LITERALS_FOR_AUTOMATON = 8
+
+
+class XQEMUKDExpectTimeoutError(TimeoutError):
+    """None of the patterns were seen in the KD output before the deadline"""
+
+
+class XQEMUKDMatch(NamedTuple):
+    """What :py:meth:`~pyxboxtest.xqemu.XQEMUKDCapturer.expect` found
+
+    :param pattern: the pattern that matched, exactly as it was given
+    :param pattern_index: the position of the pattern in the list given
+    :param text: the text that matched
+    :param groups: the groups captured by a regex, empty for literals
+    :param offset: the position in the KD output (in characters, counting \
+        from the start of the output) at which the match starts
+    """
+
+    pattern: KDPattern
+    pattern_index: int
+    text: str
+    groups: Tuple[Optional[str], ...]
+    offset: int
+
+
+class _AhoCorasick:
+    """Finds the first place where any of many literals occurs in a single
+    pass over the text, however many literals there are
+    """
+
+    def __init__(self, literals: Sequence[str]):
+        """:param literals: non-empty strings to search for"""
+        trie: List[Dict[str, int]] = [{}]
+        # The (literal index, length) of the literal with the lowest index
+        # that ends at each state
+        own_outputs: List[Optional[Tuple[int, int]]] = [None]
+        for literal_index, literal in enumerate(literals):
+            state = 0
+            for char in literal:
+                if char not in trie[state]:
+                    trie.append({})
+                    own_outputs.append(None)
+                    trie[state][char] = len(trie) - 1
+                state = trie[state][char]
+            if own_outputs[state] is None:
+                own_outputs[state] = (literal_index, len(literal))
+
+        # Transitions are fully resolved (the failure links are folded in)
+        # so searching is a single dict lookup per character. States are
+        # visited breadth first so that failure states are always resolved
+        # before the states that use them
+        fail = [0] * len(trie)
+        self._outputs = list(own_outputs)
+        self._transitions: List[Dict[str, int]] = [dict(trie[0])] + [
+            {} for _ in trie[1:]
+        ]
+        queue = deque(trie[0].values())
+        while queue:
+            state = queue.popleft()
+            self._outputs[state] = _best_output(
+                own_outputs[state], self._outputs[fail[state]]
+            )
+            self._transitions[state] = {
+                **self._transitions[fail[state]],
+                **trie[state],
+            }
+            for char, child in trie[state].items():
+                fail[child] = self._transitions[fail[state]].get(char, 0)
+                queue.append(child)
+
+    def search(self, text: str, start: int) -> Optional[Tuple[int, int, int]]:
+        """:returns: (literal index, start, end) of the literal that ends \
+            first after start, the lowest index wins a tie
+        """
+        transitions = self._transitions
+        outputs = self._outputs
+        state = 0
+        for pos in range(start, len(text)):
+            state = transitions[state].get(text[pos], 0)
+            output = outputs[state]
+            if output is not None:
+                literal_index, length = output
+                return literal_index, pos + 1 - length, pos + 1
+        return None
+
+
+def _best_output(
+    first: Optional[Tuple[int, int]], second: Optional[Tuple[int, int]]
+) -> Optional[Tuple[int, int]]:
+    """:returns: the output for the literal with the lowest index"""
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return min(first, second)
+
+
+class _KDPatternMatcher:
+    """Searches for the pattern whose first match ends earliest. Literals are
+    only searched once whilst the text grows, regexes are searched from the
+    start each time as more text may change where they match.
+    """
+
+    def __init__(self, patterns: Sequence[KDPattern]):
+        """:raises ValueError: if there are no patterns or a literal is empty"""
+        if not patterns:
+            raise ValueError("At least one pattern is needed")
+        self._patterns = tuple(patterns)
+        self._literals = tuple(
+            (index, pattern)
+            for index, pattern in enumerate(self._patterns)
+            if isinstance(pattern, str)
+        )
+        if any(not literal for _, literal in self._literals):
+            raise ValueError("Literal patterns must not be empty")
+        self._regexes = tuple(
+            (index, pattern)
+            for index, pattern in enumerate(self._patterns)
+            if not isinstance(pattern, str)
+        )
+        self._max_literal_length = max(
+            (len(literal) for _, literal in self._literals), default=0
+        )
+        self._automaton: Optional[_AhoCorasick] = None
+        if len(self._literals) >= _MIN_LITERALS_FOR_AUTOMATON:
+            self._automaton = _AhoCorasick([literal for _, literal in self._literals])
+
+    def search(
+        self, text: str, start: int, searched_up_to: int
+    ) -> Optional[_Found]:
+        """:param start: where the unconsumed text starts
+        :param searched_up_to: no literal ends at or before this position
+        :returns: (pattern index, match start, match end, groups) or None
+        """
+        best: Optional[_Found] = None
+
+        literal_start = max(start, searched_up_to - self._max_literal_length + 1)
+        if self._automaton is not None:
+            found = self._automaton.search(text, literal_start)
+            if found is not None:
+                literal_index, match_start, match_end = found
+                best = (self._literals[literal_index][0], match_start, match_end, ())
+        else:
+            for index, literal in self._literals:
+                match_start = text.find(literal, literal_start)
+                if match_start != -1:
+                    best = _earlier(
+                        best, (index, match_start, match_start + len(literal), ())
+                    )
+
+        for index, regex in self._regexes:
+            match = regex.search(text, start)
+            if match is not None:
+                best = _earlier(
+                    best, (index, match.start(), match.end(), match.groups())
+                )
+        return best
+
+    def get_pattern(self, index: int) -> KDPattern:
+        return self._patterns[index]
+
+
+def _earlier(current: Optional[_Found], candidate: _Found) -> _Found:
+    """:returns: the match that ends first, or has the lowest pattern index"""
+    if current is None or (candidate[2], candidate[0]) < (current[2], current[0]):
+        return candidate
+    return current
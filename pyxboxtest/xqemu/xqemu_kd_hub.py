@@ -0,0 +1,257 @@
+"""Drains the KD (serial port) sockets of many instances of XQEMU from a
+single thread
+"""
+from concurrent.futures import Future
+from dataclasses import dataclass
+import selectors
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from .._logging import KD_LOGGER
+from .xqemu_kd_ring_buffer import XQEMUKDRingBuffer
+
+# Read in large chunks so that verbose apps don't cost a syscall per byte
+_CHUNK_SIZE = 65536
+
+
+class XQEMUKDHubStats(NamedTuple):
+    """Counters for the KD output of one instance of XQEMU
+
+    :param bytes_received: how much output has been read from the socket
+    :param num_reads: how many reads it took
+    :param lines_received: how many complete lines have been received
+    :param lines_dropped: how many lines were dropped to stay within the \
+        ring buffer's size limit
+    :param backlog_lines: how many lines the ring buffer holds now
+    """
+
+    bytes_received: int
+    num_reads: int
+    lines_received: int
+    lines_dropped: int
+    backlog_lines: int
+
+
+@dataclass
+class _Registration:
+    key: str
+    sock: socket.socket
+    ring_buffer: XQEMUKDRingBuffer
+    bytes_received: int = 0
+    num_reads: int = 0
+
+
+class XQEMUKDHub:
+    """Uses a selector (epoll where available) to read the KD output of every
+    registered instance of XQEMU into its own ring buffer, so that watching
+    dozens of instances doesn't need dozens of threads.
+
+    Tests in the same process should share one hub, see
+    :py:func:`get_shared_kd_hub`
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        # Used to wake up the hub thread so that it picks up changes
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ, None)
+
+        self._lock = threading.Lock()
+        self._pending_changes: List[Tuple[Callable[[], None], "Future[None]"]] = []
+        self._registrations: Dict[str, _Registration] = {}
+        self._num_registrations = 0
+        self._closed = False
+        # Set if the hub thread exits, whether it was closed or failed
+        self._stopped = False
+
+        self._thread = threading.Thread(
+            target=self._run, name="pyxboxtest-kd-hub", daemon=True
+        )
+        self._thread.start()
+
+    def register(
+        self, sock: socket.socket, ring_buffer: XQEMUKDRingBuffer, name: str
+    ) -> str:
+        """Start draining a connected KD socket into ring_buffer. The hub \
+            thread becomes the only thread that feeds ring_buffer.
+
+        :param name: used to identify the instance of XQEMU in the stats
+        :returns: the key for the instance in the stats
+        """
+        sock.setblocking(False)
+        with self._lock:
+            self._num_registrations += 1
+            key = f"{name} #{self._num_registrations}"
+            registration = _Registration(key, sock, ring_buffer)
+            self._registrations[key] = registration
+
+        def add() -> None:
+            self._selector.register(sock, selectors.EVENT_READ, registration)
+
+        self._change(add)
+        return key
+
+    def unregister(self, key: str) -> None:
+        """Stop draining a socket. Once this returns the hub will not touch \
+            the socket again so it is safe to close it. The ring buffer is \
+            closed, the stats are kept.
+        """
+        registration = self._registrations[key]
+        try:
+            self._change(lambda: self._stop_draining(registration))
+        except RuntimeError:
+            # The hub thread has stopped so nothing else uses the socket
+            registration.ring_buffer.close()
+
+    def _change(self, change: Callable[[], None]) -> None:
+        """Have the hub thread make a change to the selector and wait for it \
+            to be done, the selector can't be changed whilst it is in use
+
+        :raises RuntimeError: if the hub has been closed or its thread has \
+            stopped
+        """
+        future: "Future[None]" = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The KD hub has been closed")
+            if self._stopped:
+                raise RuntimeError("The KD hub thread has stopped, see the log")
+            self._pending_changes.append((change, future))
+        self._wakeup_writer.send(b"\0")
+        future.result()
+
+    def _stop_draining(self, registration: _Registration) -> None:
+        """Must only be called from the hub thread"""
+        try:
+            self._selector.unregister(registration.sock)
+        except (KeyError, ValueError):
+            pass  # Already done when the connection was closed
+        registration.ring_buffer.close()
+
+    def _run(self) -> None:
+        try:
+            while True:
+                for key, _ in self._selector.select():
+                    if key.data is None:
+                        if not self._apply_pending_changes():
+                            return
+                    else:
+                        self._drain(key.data)
+        except Exception:  # pylint: disable=broad-except
+            KD_LOGGER.exception("The KD hub thread failed")
+        finally:
+            # Nothing will make the changes that are still waiting
+            with self._lock:
+                self._stopped = True
+                changes, self._pending_changes = self._pending_changes, []
+            for _, future in changes:
+                future.set_exception(RuntimeError("The KD hub thread has stopped"))
+
+    def _apply_pending_changes(self) -> bool:
+        """:returns: False once the hub has been closed"""
+        try:
+            while self._wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            changes, self._pending_changes = self._pending_changes, []
+            closed = self._closed
+        for change, future in changes:
+            try:
+                change()
+            except Exception as error:  # pylint: disable=broad-except
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+        return not closed
+
+    def _drain(self, registration: _Registration) -> None:
+        """Read whatever is available from a KD socket"""
+        try:
+            data = registration.sock.recv(_CHUNK_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._stop_draining(registration)
+            return
+        registration.bytes_received += len(data)
+        registration.num_reads += 1
+        try:
+            registration.ring_buffer.feed(data, time.perf_counter())
+        except Exception:  # pylint: disable=broad-except
+            # e.g. the KD log couldn't be written. Only this instance of XQEMU
+            # is affected, the hub carries on draining the others
+            KD_LOGGER.exception(
+                "Stopped capturing the KD output of %s", registration.key
+            )
+            self._stop_draining(registration)
+
+    def get_stats(self, key: Optional[str] = None) -> Dict[str, XQEMUKDHubStats]:
+        """:param key: only get the stats for this instance of XQEMU
+        :returns: the stats for every instance of XQEMU ever registered
+        """
+        with self._lock:
+            registrations = (
+                dict(self._registrations)
+                if key is None
+                else {key: self._registrations[key]}
+            )
+        return {
+            key: XQEMUKDHubStats(
+                registration.bytes_received,
+                registration.num_reads,
+                registration.ring_buffer.get_num_lines_received(),
+                registration.ring_buffer.get_num_dropped(),
+                registration.ring_buffer.get_num_lines_stored(),
+            )
+            for key, registration in registrations.items()
+        }
+
+    def close(self) -> None:
+        """Stop the hub thread. Any sockets that are still registered are \
+            left open but their ring buffers are closed
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            registrations = tuple(self._registrations.values())
+        self._wakeup_writer.send(b"\0")
+        self._thread.join()
+        for registration in registrations:
+            registration.ring_buffer.close()
+        self._selector.close()
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+
+_shared_kd_hub: Optional[XQEMUKDHub] = None
+_shared_kd_hub_lock = threading.Lock()
+
+
+def get_shared_kd_hub() -> XQEMUKDHub:
+    """:returns: the hub shared by everything in this process, it is started \
+        the first time that it is needed
+    """
+    global _shared_kd_hub  # pylint: disable=global-statement
+    with _shared_kd_hub_lock:
+        if _shared_kd_hub is None:
+            _shared_kd_hub = XQEMUKDHub()
+        return _shared_kd_hub
+
+
+def close_shared_kd_hub() -> None:
+    """Close the shared hub if it was started, e.g. at the end of the test \
+        session. A new one is started if it is needed again.
+    """
+    global _shared_kd_hub  # pylint: disable=global-statement
+    with _shared_kd_hub_lock:
+        hub, _shared_kd_hub = _shared_kd_hub, None
+    if hub is not None:
+        hub.close()
@@ -0,0 +1,159 @@
+"""Saves KD output to disk so that it can be searched after a test has
+finished
+"""
+import mmap
+import os
+import re
+import threading
+from typing import Iterator, List, NamedTuple, Optional, Pattern, Union
+
+# Big writes are far cheaper than lots of small ones for chatty apps
+_WRITE_BUFFER_SIZE = 2 ** 20
+
+_DEFAULT_MAX_BYTES = 64 * 2 ** 20
+_DEFAULT_NUM_BACKUPS = 3
+
+
+class XQEMUKDLogMatch(NamedTuple):
+    """Something found by :py:meth:`XQEMUKDLog.search`
+
+    :param filename: the log file that it was found in
+    :param offset: the position in the file at which the match starts
+    :param text: the bytes that matched
+    :param line: the whole line that the match starts in, without the \
+        line ending
+    """
+
+    filename: str
+    offset: int
+    text: bytes
+    line: bytes
+
+
+class XQEMUKDLog:
+    """An append only log of raw KD output.
+
+    Once the log reaches max_bytes it is rotated: it is renamed to
+    "filename.1" (the previous "filename.1" becomes "filename.2" and so on)
+    and a new log is started. Only num_backups old logs are kept, so the
+    total size is capped.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        max_bytes: int = _DEFAULT_MAX_BYTES,
+        num_backups: int = _DEFAULT_NUM_BACKUPS,
+    ):
+        """:param max_bytes: the maximum size of each log file
+        :param num_backups: how many rotated log files to keep
+        """
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive")
+        self._filename = filename
+        self._max_bytes = max_bytes
+        self._num_backups = num_backups
+        # Output may be written from a background thread whilst a test
+        # searches the log
+        self._lock = threading.Lock()
+        self._file = open(filename, "ab", buffering=_WRITE_BUFFER_SIZE)
+        self._size = self._file.tell()
+
+    def get_filename(self) -> str:
+        """:returns: the path of the current log file"""
+        return self._filename
+
+    def get_filenames(self) -> List[str]:
+        """:returns: the paths of all the log files that exist, oldest first"""
+        backups = (f"{self._filename}.{i}" for i in range(self._num_backups, 0, -1))
+        return [
+            filename
+            for filename in (*backups, self._filename)
+            if os.path.exists(filename)
+        ]
+
+    def write(self, data: bytes) -> None:
+        """Append raw KD output to the log"""
+        with self._lock:
+            if self._file.closed:
+                return
+            if self._size + len(data) > self._max_bytes and self._size:
+                self._rotate()
+            self._file.write(data)
+            self._size += len(data)
+
+    def _rotate(self) -> None:
+        """Must be called with the lock held"""
+        self._file.close()
+        if self._num_backups:
+            for i in range(self._num_backups - 1, 0, -1):
+                backup = f"{self._filename}.{i}"
+                if os.path.exists(backup):
+                    os.replace(backup, f"{self._filename}.{i + 1}")
+            os.replace(self._filename, f"{self._filename}.1")
+        else:
+            os.remove(self._filename)
+        self._file = open(self._filename, "ab", buffering=_WRITE_BUFFER_SIZE)
+        self._size = 0
+
+    def flush(self) -> None:
+        """Make sure that everything written so far is on disk"""
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def reopen(self, filename: str) -> None:
+        """Carry on logging to a new file, e.g. when an instance of XQEMU is \
+            used by the next test. Only the new file is searched from then on.
+        """
+        with self._lock:
+            self._file.close()
+            self._filename = filename
+            self._file = open(filename, "ab", buffering=_WRITE_BUFFER_SIZE)
+            self._size = self._file.tell()
+
+    def close(self) -> None:
+        """Stop logging, the log can still be searched"""
+        with self._lock:
+            self._file.close()
+
+    def search(
+        self,
+        pattern: Union[str, bytes, Pattern[bytes]],
+        max_matches: Optional[int] = None,
+    ) -> Iterator[XQEMUKDLogMatch]:
+        """Search every log file, oldest first. The files are memory mapped \
+            so huge logs can be searched without reading them into memory.
+
+        :param pattern: a literal string or bytes, or a compiled bytes regex
+        :param max_matches: stop after this many matches
+        """
+        if isinstance(pattern, str):
+            pattern = pattern.encode()
+        if isinstance(pattern, bytes):
+            pattern = re.compile(re.escape(pattern))
+        self.flush()
+
+        num_matches = 0
+        for filename in self.get_filenames():
+            with open(filename, "rb") as log_file:
+                if os.fstat(log_file.fileno()).st_size == 0:
+                    continue  # Empty files can't be mapped
+                with mmap.mmap(
+                    log_file.fileno(), 0, access=mmap.ACCESS_READ
+                ) as log_map:
+                    for match in pattern.finditer(log_map):
+                        if max_matches is not None and num_matches >= max_matches:
+                            return
+                        num_matches += 1
+                        yield _make_match(filename, log_map, match)
+
+
+def _make_match(filename: str, log_map: mmap.mmap, match) -> XQEMUKDLogMatch:
+    line_start = log_map.rfind(b"\n", 0, match.start()) + 1
+    line_end = log_map.find(b"\n", match.start())
+    if line_end == -1:
+        line_end = len(log_map)
+    return XQEMUKDLogMatch(
+        filename, match.start(), match.group(), log_map[line_start:line_end]
+    )
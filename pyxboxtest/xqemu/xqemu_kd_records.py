@@ -0,0 +1,63 @@
+"""Decoding of structured records (one JSON document per line, or length
+prefixed binary) from KD output, used by
+:py:meth:`~pyxboxtest.xqemu.XQEMUKDCapturer.iter_json_records` and
+:py:meth:`~pyxboxtest.xqemu.XQEMUKDCapturer.iter_binary_records`
+"""
+import json
+from typing import Any, Optional, Sequence
+
+
+class XQEMUKDRecordTimeoutError(TimeoutError):
+    """The next record did not arrive in time"""
+
+
+class XQEMUKDInvalidRecordError(ValueError):
+    """A line looked like a JSON record but could not be decoded"""
+
+
+class _JSONRecordFilter:
+    """Decodes lines containing JSON records, skipping anything else as cheaply
+    as possible
+    """
+
+    def __init__(self, keys: Optional[Sequence[str]], skip_invalid: bool):
+        """:param keys: only decode objects that contain all of these keys
+        :param skip_invalid: skip lines that look like JSON but are not valid \
+            rather than raising an error
+        """
+        self._keys = tuple(keys) if keys else tuple()
+        # A key can't be in the object unless an encoded form of it is in the
+        # line, so most records that don't match are rejected without decoding
+        # them. Apps may write non-ASCII characters as they are or escaped
+        self._encoded_keys = tuple(
+            {json.dumps(key), json.dumps(key, ensure_ascii=False)}
+            for key in self._keys
+        )
+        self._skip_invalid = skip_invalid
+        self._decoder = json.JSONDecoder()
+
+    def decode(self, line: str) -> Optional[Any]:
+        """:returns: the decoded record or None if the line should be skipped
+        :raises XQEMUKDInvalidRecordError: if the line is not valid JSON and \
+            invalid lines are not being skipped
+        """
+        stripped = line.strip()
+        # Other KD output (e.g. from the kernel) may be mixed in
+        if not stripped.startswith(("{", "[")):
+            return None
+        if not all(
+            any(encoded_key in stripped for encoded_key in encoded_forms)
+            for encoded_forms in self._encoded_keys
+        ):
+            return None
+        try:
+            record = self._decoder.decode(stripped)
+        except json.JSONDecodeError as error:
+            if self._skip_invalid:
+                return None
+            raise XQEMUKDInvalidRecordError(f"Invalid JSON record: {line!r}") from error
+        if self._keys and not (
+            isinstance(record, dict) and all(key in record for key in self._keys)
+        ):
+            return None
+        return record
@@ -0,0 +1,220 @@
+"""A bounded buffer of timestamped KD lines that is filled in the background
+and read from with cursors
+"""
+import codecs
+from collections import deque
+import itertools
+import threading
+import time
+from typing import Deque, List, NamedTuple, Optional
+
+from .xqemu_kd_log import XQEMUKDLog
+from .xqemu_kd_telemetry import XQEMUKDTelemetry, _KDTelemetryFilter
+
+# Roughly 4MB of text per instance of XQEMU
+_DEFAULT_MAX_CHARS = 2 ** 22
+
+
+class XQEMUKDLine(NamedTuple):
+    """A line of KD output
+
+    :param index: the position of the line in the whole of the KD output, \
+        starting at 0
+    :param timestamp: :py:func:`time.perf_counter` when the end of the line \
+        was received
+    :param text: the line, including the line ending (except possibly for \
+        the very last line)
+    """
+
+    index: int
+    timestamp: float
+    text: str
+
+
+class XQEMUKDRingBuffer:
+    """Splits KD output into lines and stores the most recent ones. Once the
+    size limit is reached the oldest lines are dropped, so a fast app can
+    never make the test process run out of memory.
+
+    Bytes are usually fed in by a background thread that drains the serial
+    socket so that XQEMU never blocks on a full socket. Use cursors to read
+    the lines.
+    """
+
+    def __init__(
+        self,
+        max_chars: int = _DEFAULT_MAX_CHARS,
+        encoding: str = "ascii",
+        log: Optional[XQEMUKDLog] = None,
+        telemetry: Optional[XQEMUKDTelemetry] = None,
+    ):
+        """:param max_chars: the total length of the lines that are kept
+        :param encoding: used to decode the KD output. Invalid bytes are \
+            escaped rather than raising an error in the background
+        :param log: all the raw output that is fed in is also written here
+        :param telemetry: telemetry lines are added to this rather than \
+            being stored
+        """
+        if max_chars <= 0:
+            raise ValueError("max_chars must be positive")
+        self._max_chars = max_chars
+        self._log = log
+        self._decoder = codecs.getincrementaldecoder(encoding)(
+            errors="backslashreplace"
+        )
+        self._telemetry_filter = (
+            None if telemetry is None else _KDTelemetryFilter(telemetry)
+        )
+        self._partial_line = ""
+        self._lines: Deque[XQEMUKDLine] = deque()
+        self._num_chars = 0
+        self._next_index = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def feed(self, data: bytes, timestamp: Optional[float] = None) -> None:
+        """Add newly received KD output. Any incomplete line is kept until
+        the rest of it arrives. Only one thread may feed data in
+
+        :param timestamp: when the data was received, defaults to now
+        """
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        if self._log is not None:
+            self._log.write(data)
+        text = self._decoder.decode(data)
+        if self._telemetry_filter is not None:
+            text = self._telemetry_filter.feed(text, timestamp)
+        text = self._partial_line + text
+        *lines, self._partial_line = text.split("\n")
+        if not lines:
+            return
+        with self._condition:
+            for line in lines:
+                self._append(line + "\n", timestamp)
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        """No more data will be fed in. Keeps any incomplete last line and
+        wakes up any cursors that are waiting
+        """
+        timestamp = time.perf_counter()
+        last_line = self._decoder.decode(b"", final=True)
+        if self._telemetry_filter is not None:
+            last_line = self._telemetry_filter.feed(
+                last_line, timestamp
+            ) + self._telemetry_filter.flush(timestamp)
+        last_line = self._partial_line + last_line
+        self._partial_line = ""
+        with self._condition:
+            if last_line:
+                self._append(last_line, timestamp)
+            self._closed = True
+            self._condition.notify_all()
+
+    def _append(self, text: str, timestamp: float) -> None:
+        """Must be called with the lock held"""
+        self._lines.append(XQEMUKDLine(self._next_index, timestamp, text))
+        self._next_index += 1
+        self._num_chars += len(text)
+        # Always keep the newest line, even if it is over the limit by itself
+        while self._num_chars > self._max_chars and len(self._lines) > 1:
+            self._num_chars -= len(self._lines.popleft().text)
+
+    def get_cursor(self, from_oldest: bool = True) -> "XQEMUKDCursor":
+        """:param from_oldest: start at the oldest line that is still stored \
+            rather than at the next line to arrive
+        """
+        with self._condition:
+            if from_oldest:
+                return XQEMUKDCursor(self, self._get_first_index())
+            return XQEMUKDCursor(self, self._next_index)
+
+    def is_closed(self) -> bool:
+        """:returns: True if no more data will be fed in"""
+        with self._condition:
+            return self._closed
+
+    def get_num_lines_received(self) -> int:
+        """:returns: how many complete lines have been fed in"""
+        with self._condition:
+            return self._next_index
+
+    def get_num_lines_stored(self) -> int:
+        """:returns: how many lines are stored now"""
+        with self._condition:
+            return len(self._lines)
+
+    def get_num_dropped(self) -> int:
+        """:returns: how many lines have been dropped to stay within the \
+            size limit
+        """
+        with self._condition:
+            return self._get_first_index()
+
+    def _get_first_index(self) -> int:
+        """Must be called with the lock held"""
+        return self._next_index - len(self._lines)
+
+    def _wait_for_line(self, cursor: "XQEMUKDCursor", timeout: Optional[float]) -> bool:
+        """Wait for the line at the cursor to arrive. Must be called with the \
+            lock held
+
+        :returns: False if the wait timed out or no more lines will arrive
+        """
+        return self._condition.wait_for(
+            lambda: cursor.next_index < self._next_index or self._closed, timeout
+        ) and (cursor.next_index < self._next_index)
+
+    def _skip_dropped_lines(self, cursor: "XQEMUKDCursor") -> int:
+        """Must be called with the lock held
+        :returns: the position in the stored lines of the line at the cursor
+        """
+        first_index = self._get_first_index()
+        if cursor.next_index < first_index:
+            cursor.num_missed += first_index - cursor.next_index
+            cursor.next_index = first_index
+        return cursor.next_index - first_index
+
+
+class XQEMUKDCursor:
+    """A position in an :py:class:`XQEMUKDRingBuffer`. Each cursor reads
+    every line independently of any others.
+
+    If the cursor falls so far behind that lines it has not read yet are
+    dropped, it skips ahead to the oldest stored line and counts the lines
+    that it missed in num_missed
+    """
+
+    def __init__(self, ring_buffer: XQEMUKDRingBuffer, next_index: int):
+        """Use :py:meth:`XQEMUKDRingBuffer.get_cursor` rather than creating \
+            this directly
+        """
+        self._ring_buffer = ring_buffer
+        self.next_index = next_index
+        self.num_missed = 0
+
+    def read_line(self, timeout: Optional[float] = None) -> Optional[XQEMUKDLine]:
+        """Wait for the next line
+
+        :param timeout: how long to wait in seconds, forever if None
+        :returns: None if the timeout expires or there is no more KD output
+        """
+        ring_buffer = self._ring_buffer
+        with ring_buffer._condition:
+            if not ring_buffer._wait_for_line(self, timeout):
+                return None
+            line = ring_buffer._lines[ring_buffer._skip_dropped_lines(self)]
+            self.next_index += 1
+            return line
+
+    def read_available(self) -> List[XQEMUKDLine]:
+        """Non-blocking
+        :returns: every line that has arrived but has not been read yet
+        """
+        ring_buffer = self._ring_buffer
+        with ring_buffer._condition:
+            start = ring_buffer._skip_dropped_lines(self)
+            lines = list(itertools.islice(ring_buffer._lines, start, None))
+            self.next_index += len(lines)
+            return lines
@@ -0,0 +1,355 @@
+"""Telemetry (counters, timers and markers) sent by apps over KD.
+
+Each telemetry item is a line of its own in the KD output::
+
+    #TLM c <name> [<amount>]   add amount (default 1) to a counter
+    #TLM t <name> <ms>         a timer sample in milliseconds, e.g. a frame time
+    #TLM m <name> [<value>]    a marker, e.g. "level loaded"
+
+Names can't contain whitespace. Telemetry lines are removed from the KD output
+that tests read, anything after the prefix that can't be parsed is left in.
+"""
+import bisect
+import json
+import math
+import re
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+_PREFIX = "#TLM "
+_LINE_START_PREFIX = "\n" + _PREFIX
+
+# Chosen so that the common frame rates (120, 60 and 30 fps) fall on the edges
+_DEFAULT_HISTOGRAM_BOUNDS = (
+    1.0,
+    2.0,
+    5.0,
+    8.3,
+    16.7,
+    33.3,
+    50.0,
+    100.0,
+    200.0,
+    500.0,
+    1000.0,
+    2000.0,
+    5000.0,
+    10000.0,
+)
+_REPORT_PERCENTILES = (50, 90, 95, 99)
+_PERCENTILE_STAT = re.compile(r"p(\d+(?:\.\d+)?)")
+
+
+class XQEMUKDTelemetryAssertionError(AssertionError):
+    """A telemetry statistic was outside the expected range"""
+
+
+class XQEMUKDTelemetryMarker(NamedTuple):
+    """A marker sent by an app
+
+    :param name: the name of the marker
+    :param timestamp: :py:func:`time.perf_counter` when it was received
+    :param value: the value sent with it, if any
+    """
+
+    name: str
+    timestamp: float
+    value: Optional[float]
+
+
+class XQEMUKDTelemetry:
+    """Aggregates the telemetry sent by one app. Thread safe, as telemetry
+    may be received in the background whilst a test checks it.
+
+    Timer samples are all kept, so percentiles are exact.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._timers: Dict[str, List[float]] = {}
+        # Percentiles need the samples sorted, this is only done again once
+        # more samples have arrived
+        self._sorted_samples: Dict[str, List[float]] = {}
+        self._markers: List[XQEMUKDTelemetryMarker] = []
+        self._num_invalid = 0
+
+    def add_to_counter(self, name: str, amount: float = 1) -> None:
+        """Add to a counter, starting it at 0 if it is new"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def add_timer_sample(self, name: str, milliseconds: float) -> None:
+        """Record how long something took, e.g. a frame"""
+        with self._lock:
+            self._timers.setdefault(name, []).append(milliseconds)
+            self._sorted_samples.pop(name, None)
+
+    def add_marker(self, marker: XQEMUKDTelemetryMarker) -> None:
+        """Record that something happened, e.g. a level loaded"""
+        with self._lock:
+            self._markers.append(marker)
+
+    def _add_invalid_line(self) -> None:
+        with self._lock:
+            self._num_invalid += 1
+
+    def reset(self) -> None:
+        """Forget everything received so far, e.g. after a warm up period"""
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+            self._sorted_samples.clear()
+            self._markers.clear()
+            self._num_invalid = 0
+
+    def get_counter(self, name: str) -> float:
+        """:returns: the counter's total, 0 if it has never been sent"""
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def get_counters(self) -> Dict[str, float]:
+        """:returns: the total of every counter that has been sent"""
+        with self._lock:
+            return dict(self._counters)
+
+    def get_timer_names(self) -> Tuple[str, ...]:
+        """:returns: the names of the timers that have samples"""
+        with self._lock:
+            return tuple(self._timers)
+
+    def get_timer_samples(self, name: str) -> Tuple[float, ...]:
+        """:returns: the timer's samples in the order that they arrived"""
+        with self._lock:
+            return tuple(self._timers.get(name, ()))
+
+    def get_markers(self, name: Optional[str] = None) -> List[XQEMUKDTelemetryMarker]:
+        """:param name: only get markers with this name"""
+        with self._lock:
+            return [
+                marker for marker in self._markers if name in (None, marker.name)
+            ]
+
+    def get_num_invalid_lines(self) -> int:
+        """:returns: how many lines started like telemetry but couldn't be \
+            parsed
+        """
+        with self._lock:
+            return self._num_invalid
+
+    def _get_sorted_samples(self, name: str) -> List[float]:
+        """Must be called with the lock held
+        :raises KeyError: if the timer has no samples
+        """
+        if name not in self._sorted_samples:
+            self._sorted_samples[name] = sorted(self._timers[name])
+        return self._sorted_samples[name]
+
+    def get_stat(self, name: str, stat: str) -> float:
+        """:param stat: one of count, sum, min, max or mean, or a percentile \
+            e.g. p95 or p99.9 (nearest rank)
+        :raises KeyError: if the timer has no samples
+        :raises ValueError: if stat is not recognised
+        """
+        with self._lock:
+            return _calculate_stat(self._get_sorted_samples(name), stat)
+
+    def assert_stat(
+        self,
+        name: str,
+        stat: str,
+        less_than: Optional[float] = None,
+        greater_than: Optional[float] = None,
+    ) -> float:
+        """Check a timer statistic e.g. \
+            ``assert_stat("frame", "p95", less_than=33)``, see \
+            :py:meth:`get_stat`
+
+        :returns: the statistic
+        :raises XQEMUKDTelemetryAssertionError: if the statistic is out of \
+            range or the timer has no samples
+        """
+        try:
+            value = self.get_stat(name, stat)
+        except KeyError:
+            raise XQEMUKDTelemetryAssertionError(
+                f"No samples for timer {name}"
+            ) from None
+        if less_than is not None and not value < less_than:
+            raise XQEMUKDTelemetryAssertionError(
+                f"{stat} of {name} is {value}, expected less than {less_than}"
+            )
+        if greater_than is not None and not value > greater_than:
+            raise XQEMUKDTelemetryAssertionError(
+                f"{stat} of {name} is {value}, expected greater than {greater_than}"
+            )
+        return value
+
+    def get_histogram(
+        self, name: str, bounds: Sequence[float] = _DEFAULT_HISTOGRAM_BOUNDS
+    ) -> List[int]:
+        """:param bounds: the upper bounds (in milliseconds) of the buckets, \
+            in increasing order
+        :returns: the number of samples in each bucket, a bucket holds the \
+            samples below its bound and at or above the previous bound. The \
+            last count is for the samples at or above the last bound
+        :raises KeyError: if the timer has no samples
+        """
+        with self._lock:
+            samples = self._get_sorted_samples(name)
+            edges = [bisect.bisect_left(samples, bound) for bound in bounds]
+        return [
+            end - start for start, end in zip([0] + edges, edges + [len(samples)])
+        ]
+
+    def get_report(
+        self, histogram_bounds: Sequence[float] = _DEFAULT_HISTOGRAM_BOUNDS
+    ) -> Dict[str, Any]:
+        """:returns: a summary of everything received, that can be encoded \
+            as JSON
+        """
+        timers = {}
+        for name in self.get_timer_names():
+            stats = {
+                stat: self.get_stat(name, stat)
+                for stat in ("count", "min", "max", "mean")
+            }
+            for percentile in _REPORT_PERCENTILES:
+                stats[f"p{percentile}"] = self.get_stat(name, f"p{percentile}")
+            stats["histogram"] = {
+                "bounds": list(histogram_bounds),
+                "counts": self.get_histogram(name, histogram_bounds),
+            }
+            timers[name] = stats
+        return {
+            "counters": self.get_counters(),
+            "timers": timers,
+            "markers": [marker._asdict() for marker in self.get_markers()],
+            "num_invalid_lines": self.get_num_invalid_lines(),
+        }
+
+    def write_report(self, filename: str) -> None:
+        """Save :py:meth:`get_report` as JSON"""
+        with open(filename, "w") as report_file:
+            json.dump(self.get_report(), report_file, indent=2)
+
+    def is_empty(self) -> bool:
+        """:returns: True if no telemetry has been received"""
+        with self._lock:
+            return not (self._counters or self._timers or self._markers)
+
+
+def _calculate_stat(sorted_samples: List[float], stat: str) -> float:
+    if stat == "count":
+        return len(sorted_samples)
+    if stat == "sum":
+        return math.fsum(sorted_samples)
+    if stat == "min":
+        return sorted_samples[0]
+    if stat == "max":
+        return sorted_samples[-1]
+    if stat == "mean":
+        return math.fsum(sorted_samples) / len(sorted_samples)
+    match = _PERCENTILE_STAT.fullmatch(stat)
+    if match is None or float(match.group(1)) > 100:
+        raise ValueError(f"Unknown statistic {stat}")
+    rank = math.ceil(float(match.group(1)) / 100 * len(sorted_samples))
+    return sorted_samples[max(rank - 1, 0)]
+
+
+class _KDTelemetryFilter:
+    """Removes telemetry lines from KD output and adds them to an
+    :py:class:`XQEMUKDTelemetry`. Output is fed in as it arrives, in chunks
+    of any size.
+    """
+
+    def __init__(self, telemetry: XQEMUKDTelemetry):
+        self._telemetry = telemetry
+        # The end of the last chunk, held back until it is known whether it
+        # is the start of a telemetry line
+        self._held = ""
+        self._at_line_start = True
+
+    def feed(self, text: str, timestamp: float) -> str:
+        """:param timestamp: when the text was received
+        :returns: the text without any telemetry lines
+        """
+        if self._held:
+            text = self._held + text
+            self._held = ""
+        kept = []
+        position = 0
+        at_line_start = self._at_line_start
+        while True:
+            if at_line_start and text.startswith(_PREFIX, position):
+                start = position
+            else:
+                start = text.find(_LINE_START_PREFIX, position)
+                if start == -1:
+                    break
+                start += 1
+            end = text.find("\n", start)
+            if end == -1:
+                kept.append(text[position:start])
+                self._held = text[start:]
+                self._at_line_start = True
+                return "".join(kept)
+            if self._parse(text[start + len(_PREFIX) : end], timestamp):
+                kept.append(text[position:start])
+            else:
+                kept.append(text[position : end + 1])
+            position = end + 1
+            at_line_start = True
+
+        rest = text[position:]
+        last_line_start = rest.rfind("\n") + 1
+        partial_line = rest[last_line_start:]
+        if (
+            (last_line_start or at_line_start)
+            and partial_line
+            and _PREFIX.startswith(partial_line)
+        ):
+            self._held = partial_line
+            rest = rest[:last_line_start]
+            self._at_line_start = True
+        elif rest:
+            self._at_line_start = rest.endswith("\n")
+        else:
+            self._at_line_start = at_line_start
+        kept.append(rest)
+        return "".join(kept)
+
+    def flush(self, timestamp: float) -> str:
+        """Call once the output has ended
+        :returns: anything that was held back that isn't telemetry
+        """
+        held, self._held = self._held, ""
+        if held.startswith(_PREFIX) and self._parse(held[len(_PREFIX) :], timestamp):
+            return ""
+        return held
+
+    def _parse(self, item: str, timestamp: float) -> bool:
+        """:returns: False if the item isn't valid telemetry"""
+        fields = item.split()
+        try:
+            if len(fields) in (2, 3) and fields[0] == "c":
+                self._telemetry.add_to_counter(
+                    fields[1], float(fields[2]) if len(fields) == 3 else 1
+                )
+            elif len(fields) == 3 and fields[0] == "t":
+                self._telemetry.add_timer_sample(fields[1], float(fields[2]))
+            elif len(fields) in (2, 3) and fields[0] == "m":
+                self._telemetry.add_marker(
+                    XQEMUKDTelemetryMarker(
+                        fields[1],
+                        timestamp,
+                        float(fields[2]) if len(fields) == 3 else None,
+                    )
+                )
+            else:
+                self._telemetry._add_invalid_line()
+                return False
+        except ValueError:
+            self._telemetry._add_invalid_line()
+            return False
+        return True
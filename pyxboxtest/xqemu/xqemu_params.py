@@ -53,6 +53,22 @@ class XQEMURAMSize(Enum):
     RAM128m = "128M"
 
 
+@unique
+class XQEMUChannelTransport(Enum):
+    """How the KD (serial port) and QEMU monitor channels of XQEMU are
+    connected to pyxboxtest
+    """
+
+    # XQEMU listens on ports that pyxboxtest has reserved
+    TCP_PORT = "tcp_port"
+    # pyxboxtest opens listening sockets that XQEMU inherits (POSIX only).
+    # There is no race for the ports and no need to retry connecting
+    INHERITED_SOCKET = "inherited_socket"
+    # XQEMU listens on Unix sockets in a temporary directory (POSIX only).
+    # Lower latency than TCP and no ports are used (apart from FTP)
+    UNIX_SOCKET = "unix_socket"
+
+
 @dataclass(frozen=True)
 class XQEMUFirmware:
     """Contains the firmware needed to boot xqemu.
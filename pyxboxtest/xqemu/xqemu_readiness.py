@@ -0,0 +1,167 @@
+"""Waits for the communication channels of an instance of XQEMU (KD, QMP,
+forwarded ports) to become usable
+"""
+import asyncio
+from asyncio.subprocess import Process
+import subprocess
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Type, TypeVar, Union
+
+_T = TypeVar("_T")
+
+# The first retry happens almost immediately, then back off so that we don't
+# spin whilst XQEMU is still starting up
+_FIRST_RETRY_DELAY = 0.001
+_MAX_RETRY_DELAY = 0.05
+
+
+class XQEMUExitedError(RuntimeError):
+    """XQEMU exited before a channel became ready"""
+
+
+class XQEMUReadinessTimeoutError(TimeoutError):
+    """A channel did not become ready in time"""
+
+
+class XQEMUReadinessMonitor:
+    """Waits for channels to become ready whilst watching the XQEMU process
+    so that we give up as soon as it dies rather than retrying until a timeout.
+
+    Records how long after its creation each channel became ready.
+    """
+
+    def __init__(
+        self,
+        process: Optional[Union[subprocess.Popen, Process]] = None,
+        timeout: float = 15.0,
+    ):
+        """:param process: the XQEMU process, if there is one to watch
+        :param timeout: how long (in seconds) to wait for each channel
+        """
+        self._process = process
+        self._timeout = timeout
+        self._start_time = time.perf_counter()
+        self._times_to_ready: Dict[str, float] = {}
+
+    def _raise_if_exited(self, channel: str) -> None:
+        """:raises XQEMUExitedError: if XQEMU is no longer running"""
+        if self._process is None:
+            return
+        # asyncio processes have no poll() but keep returncode up to date
+        if hasattr(self._process, "poll"):
+            returncode = self._process.poll()
+        else:
+            returncode = self._process.returncode
+        if returncode is not None:
+            raise XQEMUExitedError(
+                f"XQEMU exited with code {returncode} before {channel} was ready"
+            )
+
+    def _wait_before_retry(self, delay: float) -> None:
+        """Wait for up to delay seconds, waking up early if XQEMU exits"""
+        if self._process is None or isinstance(self._process, Process):
+            time.sleep(delay)
+            return
+        try:
+            self._process.wait(delay)
+        except subprocess.TimeoutExpired:
+            pass
+
+    def wait_until_ready(
+        self,
+        channel: str,
+        try_connect: Callable[[], _T],
+        not_ready_exceptions: Tuple[Type[BaseException], ...] = (OSError,),
+    ) -> _T:
+        """Keep calling try_connect until it succeeds
+
+        :param channel: name used to record the time taken for the channel to \
+            become ready
+        :param not_ready_exceptions: exceptions that mean that the channel is \
+            not ready yet. Any other exception is raised immediately
+        :returns: whatever try_connect returns
+        :raises XQEMUExitedError: if XQEMU exits first
+        :raises XQEMUReadinessTimeoutError: if the channel is not ready in time
+        """
+        deadline = time.perf_counter() + self._timeout
+        delay = _FIRST_RETRY_DELAY
+        while True:
+            self._raise_if_exited(channel)
+            try:
+                ret = try_connect()
+            except not_ready_exceptions as error:
+                if time.perf_counter() + delay > deadline:
+                    raise XQEMUReadinessTimeoutError(
+                        f"{channel} not ready after {self._timeout} seconds"
+                    ) from error
+                self._wait_before_retry(delay)
+                delay = min(delay * 2, _MAX_RETRY_DELAY)
+            else:
+                self._times_to_ready[channel] = time.perf_counter() - self._start_time
+                return ret
+
+    async def wait_until_ready_async(
+        self,
+        channel: str,
+        try_connect: Callable[[], Awaitable[_T]],
+        not_ready_exceptions: Tuple[Type[BaseException], ...] = (OSError,),
+    ) -> _T:
+        """The same as :py:meth:`wait_until_ready` but for use with asyncio
+
+        :param try_connect: returns an awaitable that tries to connect
+        """
+        deadline = time.perf_counter() + self._timeout
+        delay = _FIRST_RETRY_DELAY
+        while True:
+            self._raise_if_exited(channel)
+            try:
+                ret = await try_connect()
+            except not_ready_exceptions as error:
+                if time.perf_counter() + delay > deadline:
+                    raise XQEMUReadinessTimeoutError(
+                        f"{channel} not ready after {self._timeout} seconds"
+                    ) from error
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, _MAX_RETRY_DELAY)
+            else:
+                self._times_to_ready[channel] = time.perf_counter() - self._start_time
+                return ret
+
+    def wait_for_kd_marker(
+        self, get_line: Callable[[float], str], marker: str
+    ) -> None:
+        """Read KD lines until one contains marker. All lines up to and
+        including that one are consumed.
+
+        The time at which it is seen is recorded as the time to ready for the \
+        channel "kd_marker"
+
+        :param get_line: returns the next line, given how long it may wait in \
+            seconds, raising a TimeoutError if it doesn't arrive in time
+        :raises XQEMUExitedError: if XQEMU exits first
+        :raises XQEMUReadinessTimeoutError: if the marker isn't seen in time
+        """
+        deadline = time.perf_counter() + self._timeout
+        while True:
+            self._raise_if_exited("kd_marker")
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout <= 0:
+                    raise TimeoutError()
+                line = get_line(timeout)
+            except TimeoutError as error:
+                raise XQEMUReadinessTimeoutError(
+                    f"KD marker {marker!r} not seen after {self._timeout} seconds"
+                ) from error
+            except EOFError:
+                self._raise_if_exited("kd_marker")
+                raise
+            if marker in line:
+                break
+        self._times_to_ready["kd_marker"] = time.perf_counter() - self._start_time
+
+    def get_times_to_ready(self) -> Dict[str, float]:
+        """:returns: the time (in seconds) from the creation of this monitor \
+            until each channel became ready
+        """
+        return dict(self._times_to_ready)
@@ -0,0 +1,221 @@
+"""A pool of booted instances of XQEMU that can be leased to tests so that
+they don't all have to pay the cost of starting XQEMU from scratch
+"""
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+import logging
+import sys
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from .xqemu_params import XQEMUChannelTransport, XQEMUFirmware, XQEMURAMSize
+from .xqemu_xbox_app_runner import XQEMUXboxAppRunner
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class _XQEMUVMPoolKey(NamedTuple):
+    """Instances of XQEMU can only be shared between tests that would have
+    started XQEMU in the same way
+    """
+
+    xqemu_binary: Optional[str]
+    firmware: XQEMUFirmware
+    ram_size: XQEMURAMSize
+    headless: bool
+    channel_transport: XQEMUChannelTransport
+
+
+class XQEMUVMPoolStats(NamedTuple):
+    """How often a booted instance of XQEMU was available when one was
+    needed
+    """
+
+    hits: int
+    misses: int
+
+
+class _XQEMUPooledAppRunner(XQEMUXboxAppRunner):
+    """An app runner that always has a DVD drive so that discs can be swapped
+    when the instance is leased to a different test
+    """
+
+    def __init__(
+        self,
+        dvd_filename: Optional[str],
+        ram_size: XQEMURAMSize,
+        force_headless: bool,
+        channel_transport: XQEMUChannelTransport,
+    ):
+        super().__init__(
+            dvd_filename=dvd_filename,
+            ram_size=ram_size,
+            force_headless=force_headless,
+            channel_transport=channel_transport,
+        )
+        if dvd_filename is None:
+            # Empty drive, a disc can be inserted later
+            self._xqemu_args += ("-drive", "index=1,media=cdrom")
+
+    def start_lease(self) -> None:
+        """Give the next test a KD log, telemetry and recording of its own"""
+        self._start_next_test()
+
+    def finish_lease(self, exc_type: Optional[type]) -> None:
+        """Save the test's KD log, telemetry and recording (if it failed)"""
+        self._finish_test(exc_type)
+
+
+class _XQEMUPooledInstance(NamedTuple):
+    """A running instance and what is needed to shut it down"""
+
+    app: _XQEMUPooledAppRunner
+    exit_stack: ExitStack
+
+
+class XQEMUVMPool:
+    """Keeps booted instances of XQEMU around so that they can be leased out
+    rather than starting XQEMU from scratch each time.
+
+    Instances are grouped by XQEMU binary, firmware, RAM size, headless mode
+    and channel transport. Only apps that run from a DVD (and don't need a
+    HDD) can use the pool, as HDD images cannot be swapped once XQEMU is
+    running. Each lease gets its own KD log, telemetry and recording.
+    """
+
+    def __init__(self, instances_per_key: int = 1):
+        """:param instances_per_key: the maximum number of idle instances kept\
+            for each way of starting XQEMU
+        """
+        if instances_per_key < 0:
+            raise ValueError("Cannot keep a negative number of instances")
+        self._instances_per_key = instances_per_key
+        self._idle_instances: Dict[
+            _XQEMUVMPoolKey, List[_XQEMUPooledInstance]
+        ] = defaultdict(list)
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def _get_key(
+        ram_size: XQEMURAMSize,
+        force_headless: bool,
+        channel_transport: Optional[XQEMUChannelTransport],
+    ) -> _XQEMUVMPoolKey:
+        global_params = XQEMUXboxAppRunner._global_params
+        if global_params is None:
+            raise RuntimeError(
+                "Trying to use the pool before the bios and mcpx rom are set!"
+                + " Are you doing something globally that should be in a fixture?"
+            )
+        return _XQEMUVMPoolKey(
+            global_params.xqemu_binary,
+            global_params.firmware,
+            ram_size,
+            force_headless or global_params.headless,
+            channel_transport or global_params.channel_transport,
+        )
+
+    @staticmethod
+    def _start(
+        key: _XQEMUVMPoolKey, dvd_filename: Optional[str]
+    ) -> _XQEMUPooledInstance:
+        """Start a new instance of XQEMU"""
+        with ExitStack() as exit_stack:
+            app = exit_stack.enter_context(
+                _XQEMUPooledAppRunner(
+                    dvd_filename, key.ram_size, key.headless, key.channel_transport
+                )
+            )
+            return _XQEMUPooledInstance(app, exit_stack.pop_all())
+
+    def prewarm(
+        self,
+        ram_size: XQEMURAMSize = XQEMURAMSize.RAM64m,
+        force_headless: bool = False,
+        channel_transport: Optional[XQEMUChannelTransport] = None,
+    ) -> None:
+        """Boot instances until there are instances_per_key idle instances
+        for this configuration
+        """
+        key = self._get_key(ram_size, force_headless, channel_transport)
+        idle_instances = self._idle_instances[key]
+        while len(idle_instances) < self._instances_per_key:
+            instance = self._start(key, None)
+            # Nothing of the test that started it belongs to the next test
+            instance.app.finish_lease(None)
+            idle_instances.append(instance)
+
+    @contextmanager
+    def lease(
+        self,
+        dvd_filename: Optional[str] = None,
+        ram_size: XQEMURAMSize = XQEMURAMSize.RAM64m,
+        force_headless: bool = False,
+        channel_transport: Optional[XQEMUChannelTransport] = None,
+    ) -> Iterator[XQEMUXboxAppRunner]:
+        """Borrow a running instance of XQEMU for the duration of the with
+        block. It is reset before it is handed out.
+
+        :param dvd_filename: disc to run, if there is one
+        :param channel_transport: defaults to the one chosen on the command \
+            line
+        """
+        key = self._get_key(ram_size, force_headless, channel_transport)
+        idle_instances = self._idle_instances[key]
+        if idle_instances:
+            self._hits += 1
+            instance = idle_instances.pop()
+            try:
+                instance.app.start_lease()
+                if dvd_filename is not None:
+                    instance.app.insert_dvd(dvd_filename)
+                instance.app.reset_xbox()
+            except BaseException:
+                instance.exit_stack.close()
+                raise
+        else:
+            self._misses += 1
+            instance = self._start(key, dvd_filename)
+
+        exc_type = None
+        try:
+            yield instance.app
+        except BaseException:
+            exc_type = sys.exc_info()[0]
+            raise
+        finally:
+            self._release(key, instance, exc_type)
+
+    def _release(
+        self,
+        key: _XQEMUVMPoolKey,
+        instance: _XQEMUPooledInstance,
+        exc_type: Optional[type],
+    ) -> None:
+        """Put an instance back in the pool if there is space for it,
+        otherwise shut it down
+        """
+        idle_instances = self._idle_instances[key]
+        app = instance.app
+        try:
+            app.finish_lease(exc_type)
+            if app.is_running() and len(idle_instances) < self._instances_per_key:
+                app.eject_dvd()
+                idle_instances.append(instance)
+                return
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception("Could not return XQEMU instance to the pool")
+        instance.exit_stack.close()
+
+    def get_stats(self) -> XQEMUVMPoolStats:
+        """:returns: the number of leases that did and did not find an idle\
+            instance
+        """
+        return XQEMUVMPoolStats(self._hits, self._misses)
+
+    def close(self) -> None:
+        """Shut down all idle instances"""
+        for idle_instances in self._idle_instances.values():
+            for instance in idle_instances:
+                instance.exit_stack.close()
+        self._idle_instances.clear()
@@ -1,27 +1,66 @@
 """All classes related to the use and control of XQEMU"""
 
+from concurrent.futures import Future
 from contextlib import AbstractContextManager
 from dataclasses import dataclass
 from ftplib import FTP
+import itertools
 import os
+import re
+import shutil
+import socket
 import subprocess
-from typing import Optional, Sequence, Tuple
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+import weakref
 
-from qmp import QEMUMonitorProtocol
+import numpy as np
+from qmp import QEMUMonitorProtocol, QMPError
 
-from .._utils import retry_every, UnusedPort
+from .._logging import INPUT_LOGGER, KD_LOGGER, XQEMU_LOGGER
+from .._utils import UnusedPort
 
 # Because pyxboxtest.xqemu imports XQEMUXboxAppRunner pytest falls over...
 # pytype: disable=pyi-error
 from ._xqemu_temporary_directories import get_temp_dirs
 from . import (
+    XQEMUChannelTransport,
     XQEMUFirmware,
     XQEMUFTPClient,
     XQEMUKDCapturer,
+    XQEMUKDHub,
     XQEMUNetworkForwardRule,
     XQEMURAMSize,
     XQEMUXboxControllerButtons,
 )
+from .xqemu_input_timeline import (
+    _DEFAULT_SPIN_TIME,
+    XQEMUInputTimeline,
+    XQEMUInputTimelineReport,
+    play_input_timeline,
+)
+from .xqemu_kd_log import _DEFAULT_MAX_BYTES, XQEMUKDLog
+from .xqemu_readiness import XQEMUReadinessMonitor
+from .screen.xqemu_frame_rate import (
+    _DEFAULT_STALL_TIME,
+    XQEMUFrameRateMeasurement,
+    measure_frame_rate,
+)
+from .screen.xqemu_frame_recorder import _DEFAULT_MAX_FRAMES, XQEMUFrameRecorder
+from .screen.xqemu_ocr import XQEMUOCRReader
+from .screen.xqemu_ppm import load_ppm
+from .screen.xqemu_screen_wait import (
+    XQEMUScreenRegion,
+    wait_for_screen_change,
+    wait_for_screen_stable,
+)
+from .screen.xqemu_template_matching import (
+    TemplateImage,
+    XQEMUTemplateMatch,
+    find_template,
+)
 
 # pytype: enable=pyi-error
 
@@ -33,14 +72,330 @@ class _XQEMUXboxAppRunnerGlobalParams:
     firmware: XQEMUFirmware
     headless: bool
     xqemu_binary: Optional[str] = "xqemu"
+    channel_transport: XQEMUChannelTransport = XQEMUChannelTransport.TCP_PORT
+    record_fps: float = 0.0
+
+
+# QEMU's name for the drive created with "-drive index=1,media=cdrom"
+_DVD_DRIVE_DEVICE = "ide0-cd1"
+
+_DEFAULT_CHECKPOINT_NAME = "pyxboxtest_checkpoint"
+
+
+def _get_global_params() -> _XQEMUXboxAppRunnerGlobalParams:
+    """:raises RuntimeError: if the pytest plugin has not set the global \
+        params yet
+    """
+    if XQEMUXboxAppRunner._global_params is None:
+        raise RuntimeError(
+            "Trying to instantiate before the bios and mcpx rom are set!"
+            + " Are you doing something globally that should be in a fixture?"
+        )
+    return XQEMUXboxAppRunner._global_params
+
+
+def _open_listening_socket() -> socket.socket:
+    """:returns: a socket that is already listening on a port chosen by the OS"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(1)
+    return sock
+
+
+class _XQEMUChannels:
+    """Reserves whatever is needed for the FTP, KD (serial) and QMP channels
+    of one instance of XQEMU and provides the matching command line arguments
+    """
+
+    def __init__(self, transport: XQEMUChannelTransport):
+        # To allow parallel test execution different instances must be using
+        # different ports. The ports stay reserved (across all processes)
+        # until XQEMU has been stopped
+        self._port_leases = [UnusedPort()]
+        self.ftp_forward_port = self._port_leases[0].get_port_number()
+        self._transport = transport
+        self._inherited_sockets: Tuple[socket.socket, ...] = tuple()
+        self._sockets_dir: Optional[str] = None
+        # Port numbers, or socket paths when using Unix sockets
+        self.kd_address: Union[int, str]
+        self.qemu_monitor_address: Union[int, str]
+
+        if transport is XQEMUChannelTransport.TCP_PORT:
+            self._port_leases += [UnusedPort(), UnusedPort()]
+            self.kd_address, self.qemu_monitor_address = (
+                port_lease.get_port_number() for port_lease in self._port_leases[1:]
+            )
+        elif transport is XQEMUChannelTransport.INHERITED_SOCKET:
+            if os.name != "posix":
+                raise ValueError("Sockets can only be inherited by XQEMU on POSIX")
+            # XQEMU inherits sockets that are already listening, so there is no
+            # window in which another process can take the ports and clients
+            # can connect straight away
+            self._inherited_sockets = (
+                _open_listening_socket(),
+                _open_listening_socket(),
+            )
+            self.kd_address, self.qemu_monitor_address = (
+                sock.getsockname()[1] for sock in self._inherited_sockets
+            )
+        elif transport is XQEMUChannelTransport.UNIX_SOCKET:
+            if os.name != "posix":
+                raise ValueError("Unix sockets are only supported on POSIX")
+            # A directory per instance so that socket names never collide,
+            # even between processes
+            self._sockets_dir = tempfile.mkdtemp(dir=get_temp_dirs().sockets_dir)
+            self.kd_address = os.path.join(self._sockets_dir, "kd.sock")
+            self.qemu_monitor_address = os.path.join(self._sockets_dir, "qmp.sock")
+        else:
+            raise ValueError(f"Unsupported transport {transport}")
+
+    def get_xqemu_args(self) -> Tuple[str, ...]:
+        """:returns: the arguments that tell XQEMU how to use the channels"""
+        ftp_args = ("-net", f"user,hostfwd=tcp::{self.ftp_forward_port}-:21")
+        if self._transport is XQEMUChannelTransport.INHERITED_SOCKET:
+            kd_fd, qemu_monitor_fd = (
+                sock.fileno() for sock in self._inherited_sockets
+            )
+            return ftp_args + (
+                "-chardev",
+                f"socket,id=kd,fd={kd_fd},server",
+                "-serial",
+                "chardev:kd",
+                "-chardev",
+                f"socket,id=qmp,fd={qemu_monitor_fd},server,nowait",
+                "-mon",
+                "chardev=qmp,mode=control",
+            )
+        if self._transport is XQEMUChannelTransport.UNIX_SOCKET:
+            return ftp_args + (
+                "-serial",
+                f"unix:{self.kd_address},server",
+                "-qmp",
+                f"unix:{self.qemu_monitor_address},server,nowait",
+            )
+        return ftp_args + (
+            "-serial",
+            # We wait for the KD capturer to connect before we do anything.
+            # This ensures that we do not lose any of the KD output
+            f"tcp::{self.kd_address},server",
+            "-qmp",
+            # We don't wait for qmp client to connect as we may not need it
+            f"tcp::{self.qemu_monitor_address},server,nowait",
+        )
+
+    def get_popen_kwargs(self) -> Dict[str, Any]:
+        """:returns: extra arguments needed when starting XQEMU"""
+        if self._inherited_sockets:
+            return {"pass_fds": tuple(sock.fileno() for sock in self._inherited_sockets)}
+        return {}
+
+    def xqemu_started(self) -> None:
+        """XQEMU has its own copies of any inherited sockets now"""
+        for sock in self._inherited_sockets:
+            sock.close()
+
+    def release(self) -> None:
+        """Free everything that was reserved, once XQEMU has stopped"""
+        self.xqemu_started()
+        for port_lease in self._port_leases:
+            port_lease.release()
+        if self._sockets_dir is not None:
+            shutil.rmtree(self._sockets_dir, ignore_errors=True)
+
+
+def _get_xqemu_args(
+    global_params: _XQEMUXboxAppRunnerGlobalParams,
+    ram_size: XQEMURAMSize,
+    headless: bool,
+    hdd_filename: Optional[str],
+    dvd_filename: Optional[str],
+    channels: _XQEMUChannels,
+) -> Tuple[str, ...]:
+    """:returns: the command used to start XQEMU"""
+    xqemu_args = (
+        (global_params.xqemu_binary, "-cpu", "pentium3", "-m", ram_size.value,)
+        + global_params.firmware.get_command_line_args()
+        + (
+            "-device",  # Is this the right controller connection code?
+            "usb-hub,port=3",
+            "-device",
+            "usb-xbox-gamepad,port=3.1",
+            "-device",
+            "lpc47m157",
+            "-net",
+            "nic,model=nvnet",
+        )
+        + channels.get_xqemu_args()
+    )
+    if headless:
+        xqemu_args += ("-display", "egl-headless")
+
+    if hdd_filename is not None:
+        xqemu_args += ("-drive", f"index=0,media=disk,file={hdd_filename}")
+    if dvd_filename is not None:
+        xqemu_args += ("-drive", f"index=1,media=cdrom,file={dvd_filename}")
+    return xqemu_args
+
+
+def _get_screenshot_path(filename: str) -> str:
+    """:returns: a unique path in the screenshots dir for a screenshot
+    :raises ValueError: if the filename is not a ppm filename without a path
+    """
+    _, file_extension = os.path.splitext(filename)
+    if file_extension.lower() != ".ppm":
+        raise ValueError("File extension must be ppm!")
+
+    if any(seperator in filename for seperator in ("/", "\\", os.sep)):
+        raise ValueError("Path to directory is not allowed!")
+
+    filename = _get_unique_filename_prefix() + filename
+
+    return os.path.join(get_temp_dirs().screenshots_dir, filename)
+
+
+# Screenshots saved since the pytest plugin last took them, so that they can
+# be compressed once the test that saved them has finished. Only kept once
+# the plugin has said it will take them, so they don't pile up otherwise
+_new_screenshots: List[str] = []
+_new_screenshots_lock = threading.Lock()
+_new_screenshots_wanted = threading.Event()
+
+
+def _start_taking_new_screenshots() -> None:
+    """Keep the paths of screenshots, :py:func:`_take_new_screenshots` must \
+        then be called regularly
+    """
+    _new_screenshots_wanted.set()
+
+
+def _add_new_screenshot(screenshot_path: str) -> None:
+    if _new_screenshots_wanted.is_set():
+        with _new_screenshots_lock:
+            _new_screenshots.append(screenshot_path)
+
+
+def _take_new_screenshots() -> List[str]:
+    """:returns: the paths of the screenshots saved since this was last called"""
+    with _new_screenshots_lock:
+        screenshots = list(_new_screenshots)
+        _new_screenshots.clear()
+    return screenshots
+
+
+# Numbers for the files that are saved, next() on a count is atomic so that
+# files saved from different threads (e.g. the frame recorder's and the
+# test's) never get the same number
+_screenshot_nums = itertools.count(1)
+# Numbered separately from screenshots so that their numbers stay the same
+_kd_log_nums = itertools.count(1)
+_recording_nums = itertools.count(1)
+_frame_nums = itertools.count(1)
 
 
 def _get_unique_filename_prefix() -> str:
-    _get_unique_filename_prefix.prefix_num += 1
-    return str(_get_unique_filename_prefix.prefix_num) + "-"
+    return f"{next(_screenshot_nums)}-"
+
+
+def _get_current_test_filename(default: str) -> str:
+    """:returns: the name of the current test if there is one, made safe to \
+        use as a filename
+    """
+    # e.g. "tests/test_app.py::test_boot[64M] (call)"
+    current_test = os.environ.get("PYTEST_CURRENT_TEST", default).rsplit(" (", 1)[0]
+    current_test = current_test.split("::", 1)[-1]
+    return re.sub(r"[^\w.-]", "_", current_test)[:100]
+
+
+def _get_kd_log_path() -> str:
+    """:returns: a unique path in the KD logs dir, named after the current \
+        test if there is one
+    """
+    filename = _get_current_test_filename("kd") + ".log"
+    return os.path.join(get_temp_dirs().kd_logs_dir, f"{next(_kd_log_nums)}-{filename}")
+
+
+def _get_recording_path() -> str:
+    """:returns: a unique path in the recordings dir, named after the current \
+        test if there is one
+    """
+    filename = _get_current_test_filename("recording") + ".png"
+    return os.path.join(
+        get_temp_dirs().recordings_dir, f"{next(_recording_nums)}-{filename}"
+    )
+
+
+def _get_frame_path() -> str:
+    """:returns: a unique path for a frame grabbed from the screen, it is only \
+        needed until the frame has been memory mapped
+    """
+    return os.path.join(get_temp_dirs().frames_dir, f"{next(_frame_nums)}.ppm")
+
+
+def _load_frame(frame_path: str) -> np.ndarray:
+    """:returns: the frame's pixels, memory mapped on POSIX where the file can \
+        be removed whilst mapped. Elsewhere (i.e. Windows) they are copied so \
+        that the map is closed before the file is removed.
+    """
+    frame = load_ppm(frame_path)
+    if os.name != "posix":
+        frame = frame.copy()  # Dropping the mapped array closes the map
+        frame.flags.writeable = False
+    return frame
+
+
+# Frames that couldn't be removed yet, they are retried with the next frame
+_unremoved_frames: List[str] = []
+_unremoved_frames_lock = threading.Lock()
+
+
+def _remove_frame(frame_path: str) -> None:
+    """Remove a frame, and any that couldn't be removed before, e.g. because \
+        another process (such as a virus scanner) had them open on Windows
+    """
+    with _unremoved_frames_lock:
+        frame_paths = [*_unremoved_frames, frame_path]
+        _unremoved_frames.clear()
+    for path in frame_paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # XQEMU failed to save it
+        except PermissionError:
+            with _unremoved_frames_lock:
+                _unremoved_frames.append(path)
+
+
+class _ThreadSafeQEMUMonitorProtocol(QEMUMonitorProtocol):
+    """Frames can be recorded from another thread whilst the test sends
+    commands, so each command and its response must not be interleaved
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._command_lock = threading.Lock()
+
+    def cmd_obj(self, qmp_cmd):
+        with self._command_lock:
+            return super().cmd_obj(qmp_cmd)
+
+
+# Runners that are recording, so that their recordings can be saved when a
+# test that uses them fails
+_recording_runners: "weakref.WeakSet[XQEMUXboxAppRunner]" = weakref.WeakSet()
+
 
+def _save_recordings() -> List[str]:
+    """Start saving the recordings of every runner that is recording, for the \
+        pytest plugin to use when a test fails
 
-_get_unique_filename_prefix.prefix_num = 0
+    :returns: the paths that the recordings are being saved to
+    """
+    recording_paths = []
+    for runner in list(_recording_runners):
+        recording_path = _get_recording_path()
+        if runner.get_frame_recorder().save_recording(recording_path) is not None:
+            recording_paths.append(recording_path)
+    return recording_paths
 
 
 class XQEMUXboxAppRunner(AbstractContextManager):
@@ -60,74 +415,83 @@ class XQEMUXboxAppRunner(AbstractContextManager):
         network_forward_rules: Optional[Tuple[XQEMUNetworkForwardRule, ...]] = None,
         ram_size: XQEMURAMSize = XQEMURAMSize.RAM64m,
         force_headless: bool = False,
+        kd_ready_marker: Optional[str] = None,
+        channel_transport: Optional[XQEMUChannelTransport] = None,
+        capture_kd_in_background: bool = False,
+        kd_hub: Optional[XQEMUKDHub] = None,
+        save_kd_log: bool = True,
+        kd_log_max_bytes: int = _DEFAULT_MAX_BYTES,
+        record_fps: Optional[float] = None,
+        record_max_frames: int = _DEFAULT_MAX_FRAMES,
     ):
         """:param force_headless: only use this if you are doing something
         fancy like using a "hidden" Xbox app to do some test setup!
+        :param kd_ready_marker: if given, entering the context waits until \
+            the app outputs a KD line containing this text. That line and all \
+            the lines before it are consumed.
+        :param channel_transport: how to connect to XQEMU's KD and QMP \
+            channels, defaults to the one chosen on the command line
+        :param capture_kd_in_background: continuously read KD output into a \
+            ring buffer of timestamped lines, see \
+            :py:class:`~pyxboxtest.xqemu.XQEMUKDCapturer`
+        :param kd_hub: capture KD output in the background using this hub, \
+            e.g. the one from the xqemu_kd_hub fixture
+        :param save_kd_log: save all the KD output to a log file named after \
+            the current test, in the pytest temp dir. A JSON report of any \
+            telemetry sent by the app is saved next to it
+        :param kd_log_max_bytes: when the KD log reaches this size it is \
+            rotated, see :py:class:`~pyxboxtest.xqemu.XQEMUKDLog`
+        :param record_fps: record the screen this many times a second, see \
+            :py:class:`~pyxboxtest.xqemu.screen.XQEMUFrameRecorder`. The \
+            recording is saved if the test fails. Defaults to the rate \
+            chosen on the command line, 0 to not record
+        :param record_max_frames: the number of distinct frames to keep
         """
-        if XQEMUXboxAppRunner._global_params is None:
-            raise RuntimeError(
-                "Trying to instantiate before the bios and mcpx rom are set!"
-                + " Are you doing something globally that should be in a fixture?"
-            )
+        global_params = _get_global_params()
 
         self._qemu_monitor_instance = None
         self._kd_capturer_instance = None
-        headless = force_headless or XQEMUXboxAppRunner._global_params.headless
-
-        # need some way of ensuring that only one process at a time can do this
-        # so as to avoid having multiple processes using the same ports
-        # with parallel test execution
-        # To allow parallel test execution different instances must be using different ports
-        self._ftp_forward_port = UnusedPort().get_port_number()
-        self._kd_forward_port = UnusedPort().get_port_number()
-        self._qemu_monitor_forward_port = UnusedPort().get_port_number()
-
-        self._xqemu_args = (
-            (
-                XQEMUXboxAppRunner._global_params.xqemu_binary,
-                "-cpu",
-                "pentium3",
-                "-m",
-                ram_size.value,
-            )
-            + XQEMUXboxAppRunner._global_params.firmware.get_command_line_args()
-            + (
-                "-device",  # Is this the right controller connection code?
-                "usb-hub,port=3",
-                "-device",
-                "usb-xbox-gamepad,port=3.1",
-                "-device",
-                "lpc47m157",
-                "-net",
-                "nic,model=nvnet",
-                "-net",
-                f"user,hostfwd=tcp::{self._ftp_forward_port}-:21",
-                "-serial",
-                # We wait for the KD capturer to connect before we do anything.
-                # This ensures that we do not lose any of the KD output
-                f"tcp::{self._kd_forward_port},server",
-                "-qmp",
-                # We don't wait for qmp client to connect as we may not need it
-                f"tcp::{self._qemu_monitor_forward_port},server,nowait",
-            )
-        )
-        if headless:
-            self._xqemu_args += ("-display", "egl-headless")
 
-        if hdd_filename is not None:
-            self._xqemu_args += ("-drive", f"index=0,media=disk,file={hdd_filename}")
-        if dvd_filename is not None:
-            self._xqemu_args += ("-drive", f"index=1,media=cdrom,file={dvd_filename}")
+        self._channels = _XQEMUChannels(
+            channel_transport or global_params.channel_transport
+        )
 
-        print("xqemu parameters: ", self._xqemu_args)
+        self._xqemu_args = _get_xqemu_args(
+            global_params,
+            ram_size,
+            force_headless or global_params.headless,
+            hdd_filename,
+            dvd_filename,
+            self._channels,
+        )
+        XQEMU_LOGGER.info("xqemu parameters: %s", self._xqemu_args)
 
         self._app = None
+        self._readiness = None
+        self._kd_ready_marker = kd_ready_marker
+        self._capture_kd_in_background = capture_kd_in_background
+        self._kd_hub = kd_hub
+        self._save_kd_log = save_kd_log
+        self._kd_log_max_bytes = kd_log_max_bytes
+        self._kd_log: Optional[XQEMUKDLog] = None
+        self._checkpoint_restore_times: List[float] = []
+        self._in_test = False
+        self._qemu_monitor_lock = threading.Lock()
+        if record_fps is None:
+            record_fps = global_params.record_fps
+        self._frame_recorder = (
+            XQEMUFrameRecorder(self.grab_frame, record_fps, record_max_frames)
+            if record_fps > 0
+            else None
+        )
 
     def get_ftp_client(
         self, username: Optional[str] = None, password: Optional[str] = None
     ) -> FTP:
         """This assumes that an FTP client is actually running in the app..."""
-        ftp_client = XQEMUFTPClient(self._ftp_forward_port)
+        ftp_client = XQEMUFTPClient(
+            self._channels.ftp_forward_port, readiness=self._readiness
+        )
         if username is not None and password is not None:
             ftp_client.login(username, password)
         return ftp_client
@@ -141,17 +505,106 @@ class XQEMUXboxAppRunner(AbstractContextManager):
         args = {"keys": [{"type": "qcode", "data": key.value} for key in buttons]}
         if hold_time is not None:
             args["hold-time"] = hold_time
-        print(args)
+        INPUT_LOGGER.info("send-key %s", args)
         self.get_qemu_monitor().command("send-key", **args)
 
+    def play_input_timeline(
+        self, timeline: XQEMUInputTimeline, spin_time: float = _DEFAULT_SPIN_TIME
+    ) -> XQEMUInputTimelineReport:
+        """Send a script of controller input with precise timing, far more \
+            reliable than sleeping between :py:meth:`press_controller_buttons` \
+            for combos. See :py:func:`~pyxboxtest.xqemu.play_input_timeline`. \
+            Recording the screen is paused whilst it plays.
+
+        :returns: how precisely the input was sent
+        """
+        qemu_monitor = self.get_qemu_monitor()  # Connected before timing starts
+        INPUT_LOGGER.info("input timeline %s", timeline.get_events())
+        # The recorder's screendumps share the QMP connection, so would delay
+        # the input
+        recorder = self._frame_recorder
+        was_recording = recorder is not None and recorder.is_recording()
+        if was_recording:
+            recorder.stop()
+        try:
+            report = play_input_timeline(qemu_monitor.command, timeline, spin_time)
+        finally:
+            if was_recording:
+                recorder.start()
+        INPUT_LOGGER.info(
+            "input timeline sent in %d commands, max jitter %.2f ms",
+            report.num_batches,
+            report.max_jitter * 1000,
+        )
+        return report
+
     def reset_xbox(self) -> None:
         """Reset the Xbox
 
         It will then load whatever software the kernel is configured to load
         on reset. It will probably reload whatever software started
         running when you first started running this instance.
+
+        If the app has reached a state that you want to return to many times
+        then :py:meth:`save_checkpoint` and :py:meth:`restore_checkpoint`
+        are far faster than rebooting.
+        """
+        INPUT_LOGGER.info(
+            "system_reset: %s", self.get_qemu_monitor().command("system_reset")
+        )
+
+    def _human_monitor_command(self, command_line: str) -> None:
+        """Run a command that is only available through the human monitor
+        :raises RuntimeError: if XQEMU reports a problem
+        """
+        output = self.get_qemu_monitor().command(
+            "human-monitor-command", **{"command-line": command_line}
+        )
+        # These commands print nothing if they succeed
+        if output:
+            raise RuntimeError(f"{command_line} failed: {output}")
+
+    def save_checkpoint(self, name: str = _DEFAULT_CHECKPOINT_NAME) -> None:
+        """Save the state of the whole VM (including the HDD) so that it can
+        be quickly restored later with :py:meth:`restore_checkpoint`.
+
+        The state is stored in the HDD image, so a qcow2 HDD image (such as
+        one from :py:meth:`XQEMUHDDTemplate.create_fresh_hdd`) is required.
+        Saving an existing checkpoint again overwrites it.
         """
-        print(self.get_qemu_monitor().command("system_reset"))
+        self._human_monitor_command(f"savevm {name}")
+
+    def restore_checkpoint(self, name: str = _DEFAULT_CHECKPOINT_NAME) -> float:
+        """Put the VM back in the state it was in when the checkpoint was
+        saved. This is much faster than resetting the Xbox.
+
+        :returns: the time that it took to restore the checkpoint in seconds
+        """
+        start_time = time.perf_counter()
+        self._human_monitor_command(f"loadvm {name}")
+        restore_time = time.perf_counter() - start_time
+        self._checkpoint_restore_times.append(restore_time)
+        return restore_time
+
+    def get_checkpoint_restore_times(self) -> Tuple[float, ...]:
+        """:returns: how long (in seconds) each call to \
+            :py:meth:`restore_checkpoint` took, in the order they were made
+        """
+        return tuple(self._checkpoint_restore_times)
+
+    def insert_dvd(self, dvd_filename: str) -> None:
+        """Put a disc in the DVD drive. Only possible if XQEMU was started
+        with a DVD drive i.e. if a DVD was given when this was created.
+
+        The Xbox will not start running the disc until it is reset.
+        """
+        self.get_qemu_monitor().command(
+            "blockdev-change-medium", device=_DVD_DRIVE_DEVICE, filename=dvd_filename
+        )
+
+    def eject_dvd(self) -> None:
+        """Remove whatever disc is in the DVD drive"""
+        self.get_qemu_monitor().command("eject", device=_DVD_DRIVE_DEVICE, force=True)
 
     def save_screenshot(self, filename: str) -> str:
         """Save a screenshot in ppm format
@@ -160,20 +613,139 @@ class XQEMUXboxAppRunner(AbstractContextManager):
             directory i.e. it must be of the form test.ppm and not \
                 dir1/test.ppm A unique prefix will be added to it to ensure \
                     its unique
-        :returns: the path to the screenshot
+        :returns: the path to the screenshot, which can be loaded with \
+            :py:func:`~pyxboxtest.xqemu.screen.load_ppm`. Once the test has \
+            finished the pytest plugin replaces it with a PNG, see \
+            :py:class:`~pyxboxtest.xqemu.screen.XQEMUScreenshotStore`
         """
-        _, file_extension = os.path.splitext(filename)
-        if file_extension.lower() != ".ppm":
-            raise ValueError("File extension must be ppm!")
+        screenshot_path = _get_screenshot_path(filename)
+        self.get_qemu_monitor().command("screendump", filename=screenshot_path)
+        _add_new_screenshot(screenshot_path)
+        return screenshot_path
 
-        if any(seperator in filename for seperator in ("/", "\\", os.sep)):
-            raise ValueError("Path to directory is not allowed!")
+    def grab_frame(self) -> np.ndarray:
+        """Get what is on screen without leaving a file behind. Much cheaper \
+            than :py:meth:`save_screenshot` for tests that watch the screen: \
+            the frame is written to a tmpfs (where there is one) and memory \
+            mapped (copied on Windows) rather than read and decoded.
 
-        filename = _get_unique_filename_prefix() + filename
+        :returns: a read only array of RGB pixels of shape (height, width, 3)
+        """
+        frame_path = _get_frame_path()
+        try:
+            self.get_qemu_monitor().command("screendump", filename=frame_path)
+            return _load_frame(frame_path)
+        finally:
+            _remove_frame(frame_path)
 
-        screenshot_path = os.path.join(get_temp_dirs().screenshots_dir, filename)
-        self.get_qemu_monitor().command("screendump", filename=screenshot_path)
-        return screenshot_path
+    def wait_for_screen_stable(
+        self,
+        stable_time: float = 0.5,
+        timeout: float = 30.0,
+        region: Optional[XQEMUScreenRegion] = None,
+        mask: Optional[np.ndarray] = None,
+        pixel_threshold: int = 0,
+        max_changed_fraction: float = 0.0,
+    ) -> np.ndarray:
+        """Wait until the screen stops changing, rather than sleeping for long \
+            enough, see :py:func:`~pyxboxtest.xqemu.screen.wait_for_screen_stable`
+
+        :returns: the settled frame
+        """
+        return wait_for_screen_stable(
+            self.grab_frame,
+            stable_time,
+            timeout,
+            region,
+            mask,
+            pixel_threshold,
+            max_changed_fraction,
+        )
+
+    def wait_for_screen_change(
+        self,
+        reference: Optional[np.ndarray] = None,
+        timeout: float = 30.0,
+        region: Optional[XQEMUScreenRegion] = None,
+        mask: Optional[np.ndarray] = None,
+        pixel_threshold: int = 0,
+        min_changed_fraction: float = 0.0,
+    ) -> np.ndarray:
+        """Wait until the screen changes, see \
+            :py:func:`~pyxboxtest.xqemu.screen.wait_for_screen_change`
+
+        :returns: the changed frame
+        """
+        return wait_for_screen_change(
+            self.grab_frame,
+            reference,
+            timeout,
+            region,
+            mask,
+            pixel_threshold,
+            min_changed_fraction,
+        )
+
+    def measure_frame_rate(
+        self, duration: float = 5.0, stall_time: float = _DEFAULT_STALL_TIME
+    ) -> XQEMUFrameRateMeasurement:
+        """Estimate how fast the app is rendering by watching the screen, see \
+            :py:func:`~pyxboxtest.xqemu.screen.measure_frame_rate`
+        """
+        return measure_frame_rate(self.grab_frame, duration, stall_time)
+
+    def find_on_screen(
+        self,
+        template_image: TemplateImage,
+        region: Optional[XQEMUScreenRegion] = None,
+        threshold: float = 0.9,
+        max_matches: Optional[int] = None,
+    ) -> List[XQEMUTemplateMatch]:
+        """Find where an image (e.g. a menu item or an icon) is on screen, see \
+            :py:func:`~pyxboxtest.xqemu.screen.find_template`
+
+        :returns: the matches, best first. Empty if it isn't on screen
+        """
+        return find_template(
+            self.grab_frame(), template_image, region, threshold, max_matches
+        )
+
+    def read_text(
+        self,
+        reader: XQEMUOCRReader,
+        names: Optional[Sequence[str]] = None,
+        timeout: Optional[float] = None,
+    ) -> Dict[str, str]:
+        """Read the text in regions of the screen, see \
+            :py:meth:`~pyxboxtest.xqemu.screen.XQEMUOCRReader.read_text`
+
+        :returns: the text in each region, by name
+        """
+        return reader.read_text(self.grab_frame(), names, timeout)
+
+    def get_frame_recorder(self) -> Optional[XQEMUFrameRecorder]:
+        """:returns: the recorder of what is on screen, if recording"""
+        return self._frame_recorder
+
+    def save_recording(self) -> Optional["Future[str]"]:
+        """Save what has been recorded as an animated PNG in the recordings \
+            dir for this test. This happens automatically if the test fails. \
+            It is encoded in the background so this returns straight away.
+
+        :returns: the path of the recording once it is saved, None if \
+            nothing has been recorded
+        """
+        if self._frame_recorder is None:
+            return None
+        return self._frame_recorder.save_recording(_get_recording_path())
+
+    def is_running(self) -> bool:
+        """:returns: True if XQEMU has been started and has not exited yet"""
+        return self._app is not None and self._app.poll() is None
+
+    def get_kd_log(self) -> Optional[XQEMUKDLog]:
+        """:returns: the log of all of the KD output, if it is being saved"""
+        return self._kd_log
 
     def get_kd_capturer(self) -> XQEMUKDCapturer:
         """Can be used to retrieve text from the serial port"""
@@ -181,31 +753,143 @@ class XQEMUXboxAppRunner(AbstractContextManager):
 
     def get_qemu_monitor(self) -> QEMUMonitorProtocol:
         """:returns: a qemu monitor that's used to communicate with XQEMU"""
-        if self._qemu_monitor_instance is None:
-            self._qemu_monitor_instance = QEMUMonitorProtocol(
-                ("", self._qemu_monitor_forward_port)
-            )
-            # If called too early it won't be able to connect first try as XQEMU is not ready yet
-            retry_every(self._qemu_monitor_instance.connect)
+        # Frames may be being recorded from another thread
+        with self._qemu_monitor_lock:
+            if self._qemu_monitor_instance is None:
+                # If called too early it won't be able to connect first try as
+                # XQEMU is not ready yet
+                def try_connect() -> QEMUMonitorProtocol:
+                    address = self._channels.qemu_monitor_address
+                    qemu_monitor = _ThreadSafeQEMUMonitorProtocol(
+                        address if isinstance(address, str) else ("", address)
+                    )
+                    try:
+                        qemu_monitor.connect()
+                    except:
+                        qemu_monitor.close()
+                        raise
+                    return qemu_monitor
+
+                self._qemu_monitor_instance = self._get_readiness().wait_until_ready(
+                    "qmp", try_connect, (OSError, QMPError)
+                )
         return self._qemu_monitor_instance
 
+    def _get_readiness(self) -> XQEMUReadinessMonitor:
+        if self._readiness is None:
+            self._readiness = XQEMUReadinessMonitor(self._app)
+        return self._readiness
+
+    def get_times_to_ready(self) -> Dict[str, float]:
+        """:returns: how long after XQEMU was started each channel (kd, qmp, \
+            ftp, kd_marker) became ready, in seconds. Useful for finding slow \
+            boots.
+        """
+        return self._get_readiness().get_times_to_ready()
+
     def __enter__(self):
-        self._app = subprocess.Popen(self._xqemu_args)
-        self._kd_capturer_instance = XQEMUKDCapturer(self._kd_forward_port)
+        self._app = subprocess.Popen(
+            self._xqemu_args, **self._channels.get_popen_kwargs()
+        )
+        try:
+            self._channels.xqemu_started()
+            self._readiness = XQEMUReadinessMonitor(self._app)
+            if self._save_kd_log:
+                self._kd_log = XQEMUKDLog(_get_kd_log_path(), self._kd_log_max_bytes)
+            self._kd_capturer_instance = XQEMUKDCapturer(
+                self._channels.kd_address,
+                self._readiness,
+                capture_in_background=self._capture_kd_in_background,
+                hub=self._kd_hub,
+                log=self._kd_log,
+            )
+            self._start_test()
+            if self._kd_ready_marker is not None:
+                self._readiness.wait_for_kd_marker(
+                    lambda timeout: self._kd_capturer_instance.get_line(
+                        timeout=timeout
+                    ),
+                    self._kd_ready_marker,
+                )
+        except BaseException:
+            if self._frame_recorder is not None:
+                _recording_runners.discard(self)
+                self._frame_recorder.stop()
+            self._in_test = False
+            if self._kd_capturer_instance is not None:
+                self._kd_capturer_instance.close()
+            if self._kd_log is not None:
+                self._kd_log.close()
+            self._stop_xqemu()
+            raise
         return self
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        print("Uncaptured KD output:")
+    def _start_test(self) -> None:
+        """Start keeping the state that belongs to the test using this \
+            instance
+        """
+        self._in_test = True
+        if self._frame_recorder is not None:
+            self._frame_recorder.start()
+            _recording_runners.add(self)
+
+    def _start_next_test(self) -> None:
+        """Hand this running instance to another test, e.g. from \
+            :py:class:`~pyxboxtest.xqemu.XQEMUVMPool`, with a KD log, \
+            telemetry and recording of its own
+        """
+        self._finish_test(None)
+        KD_LOGGER.info("KD output between tests:")
+        self._kd_capturer_instance.get_all()  # Will log it
+        if self._kd_log is not None:
+            self._kd_log.reopen(_get_kd_log_path())
+        self._kd_capturer_instance.get_telemetry().reset()
+        if self._frame_recorder is not None:
+            self._frame_recorder.clear()
+        self._start_test()
+
+    def _finish_test(self, exc_type) -> None:
+        """Save the state that belongs to the test using this instance, does \
+            nothing if it has already been saved
+        """
+        if not self._in_test:
+            return
+        self._in_test = False
+        if self._frame_recorder is not None:
+            _recording_runners.discard(self)
+            self._frame_recorder.stop()
+            if exc_type is not None:
+                self.save_recording()
+
+        KD_LOGGER.info("Uncaptured KD output:")
 
         # TODO tidy this logic up
+        telemetry = None
         try:
             self._kd_capturer_instance.get_all()  # Will log it
+            telemetry = self._kd_capturer_instance.get_telemetry()
         except Exception as e:
-            print("Error getting uncaptured KD output:", str(e))
+            KD_LOGGER.warning("Error getting uncaptured KD output: %s", e)
+
+        if self._kd_log is not None:
+            self._kd_log.flush()
+            if telemetry is not None and not telemetry.is_empty():
+                telemetry.write_report(
+                    os.path.splitext(self._kd_log.get_filename())[0]
+                    + ".telemetry.json"
+                )
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._finish_test(exc_type)
         self._kd_capturer_instance.close()
+        if self._kd_log is not None:
+            self._kd_log.close()
+        self._stop_xqemu()
+
+    def _stop_xqemu(self) -> None:
         if self._qemu_monitor_instance is not None:
             self._qemu_monitor_instance.close()
         self._app.terminate()
         # Wait so that we can be sure that we can use the HDD image elsewhere
         self._app.wait()
+        self._channels.release()
@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 from ftplib import FTP
-import json
 from time import sleep
 from typing import Any, Dict, Iterator, NamedTuple, Tuple
 
@@ -10,10 +9,10 @@ from pyxboxtest.xqemu import (
     XQEMUXboxControllerButtons,
 )
 from pyxboxtest.xqemu.hdd import XQEMUHDDTemplate
+from pyxboxtest.xqemu.screen import XQEMUOCRReader, XQEMUScreenRegion
 
 import dpath.util
-from PIL import Image
-import pytesseract
+import numpy as np
 import pytest
 
 
@@ -51,7 +50,7 @@ def test_kernel_debug(xqemu_blank_hdd_template):
 
 def kd_get_json(kd_capturer: XQEMUKDCapturer) -> Dict[str, Any]:
     """Gets the next available KD line and converts it from JSON to a dict"""
-    return json.loads(kd_capturer.get_line())
+    return kd_capturer.get_json_record(timeout=10)
 
 
 def get_default_buttons_dict() -> Dict[str, Dict[str, Any]]:
@@ -161,16 +160,27 @@ def get_buttons_dict(
     return buttons_dict
 
 
-def test_hello_world(xqemu_blank_hdd_template):
+HELLO_WORLD_TEXT_REGION = XQEMUScreenRegion(0, 0, 640, 60)
+
+
+@pytest.fixture(scope="session")
+def hello_world_text_reader() -> Iterator[XQEMUOCRReader]:
+    with XQEMUOCRReader({"top": HELLO_WORLD_TEXT_REGION}) as reader:
+        yield reader
+
+
+def test_hello_world(xqemu_blank_hdd_template, hello_world_text_reader):
     with XQEMUXboxAppRunner(
         hdd_filename=xqemu_blank_hdd_template.create_fresh_hdd(),
         dvd_filename="/home/josh/projects/nxdk/samples/hello/hello.iso",
     ) as app:
-        sleep(5)  # Ensure that the has had enough time to render fully
+        # The black boot screen is stable too, so wait for the text to be
+        # drawn before waiting for it to have rendered fully
+        black = np.zeros_like(app.grab_frame())
+        app.wait_for_screen_change(black, region=HELLO_WORLD_TEXT_REGION)
+        app.wait_for_screen_stable(region=HELLO_WORLD_TEXT_REGION)
         # There may be multiple lines by the time we read the image!
-        first_line = pytesseract.image_to_string(
-            Image.open(app.save_screenshot("test.ppm"))
-        ).split("\n")[0]
+        first_line = app.read_text(hello_world_text_reader)["top"].split("\n")[0]
         assert first_line == "Hello nxdk!"
 
 
@@ -9,7 +9,7 @@ setup(
     author="Josh Neil",
     author_email="joshneil8@gmail.com",
     # url='https://www.python.org/sigs/distutils-sig/',
-    install_requires=["overrides", "pytest", "qmp"],
+    install_requires=["numpy", "overrides", "pytest", "qmp"],
     packages=["pyxboxtest"],
     dependency_links=[],
 )
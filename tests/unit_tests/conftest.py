@@ -17,4 +17,7 @@ def mocked_socket(mocker):
 @pytest.fixture
 def mocked_subprocess_popen(mocker):
     """We don't really want to spawn new processes"""
-    return mocker.patch("subprocess.Popen")
+    mocked_popen = mocker.patch("subprocess.Popen")
+    # The "process" is still running
+    mocked_popen.return_value.poll.return_value = None
+    return mocked_popen
@@ -0,0 +1,140 @@
+"""Test :py:mod:`pyxboxtest._logging`"""
+import logging
+from typing import NamedTuple
+
+import pytest
+
+from pyxboxtest._logging import (
+    INPUT_LOGGER,
+    KD_LOGGER,
+    XQEMU_LOGGER,
+    XQEMULoggingSetup,
+    XQEMULogRateLimitFilter,
+)
+from pyxboxtest.pytest_plugin import _parse_log_levels
+
+
+# Grouped into classes as a way to organise the tests
+# pylint: disable=no-self-use
+
+
+def _make_record(name: str) -> logging.LogRecord:
+    return logging.LogRecord(name, logging.INFO, __file__, 0, "message", (), None)
+
+
+@pytest.fixture(scope="function")
+def mocked_monotonic(mocker):
+    """Time only moves when the test says so"""
+    return mocker.patch("time.monotonic", return_value=100.0)
+
+
+class TestRateLimitFilter:
+    """Test the token bucket used to rate limit each channel"""
+
+    def test_burst_then_drop(self, mocked_monotonic):  # pylint: disable=unused-argument
+        """Records beyond the burst are dropped and counted"""
+        rate_limit_filter = XQEMULogRateLimitFilter(10)
+        allowed = [
+            rate_limit_filter.filter(_make_record("pyxboxtest.kd")) for _ in range(15)
+        ]
+        assert allowed == [True] * 10 + [False] * 5
+        assert rate_limit_filter.get_num_dropped() == {"pyxboxtest.kd": 5}
+
+    def test_refills_over_time(self, mocked_monotonic):
+        """Records are allowed again once time has passed"""
+        rate_limit_filter = XQEMULogRateLimitFilter(10, burst=1)
+        assert rate_limit_filter.filter(_make_record("pyxboxtest.kd"))
+        assert not rate_limit_filter.filter(_make_record("pyxboxtest.kd"))
+        mocked_monotonic.return_value += 0.2
+        assert rate_limit_filter.filter(_make_record("pyxboxtest.kd"))
+
+    def test_loggers_limited_separately(
+        self, mocked_monotonic
+    ):  # pylint: disable=unused-argument
+        """A chatty channel can't use up another channel's allowance"""
+        rate_limit_filter = XQEMULogRateLimitFilter(1)
+        assert rate_limit_filter.filter(_make_record("pyxboxtest.kd"))
+        assert not rate_limit_filter.filter(_make_record("pyxboxtest.kd"))
+        assert rate_limit_filter.filter(_make_record("pyxboxtest.input"))
+
+    def test_invalid_rate(self):
+        with pytest.raises(ValueError):
+            XQEMULogRateLimitFilter(0)
+
+
+class TestLoggingSetup:
+    """Test configuring and restoring pyxboxtest's channels"""
+
+    def test_levels_restored(self):
+        """Levels are set for each channel and put back when closed"""
+        original_levels = (KD_LOGGER.level, INPUT_LOGGER.level, XQEMU_LOGGER.level)
+        setup = XQEMULoggingSetup({"kd": "warning", "input": "DEBUG"})
+        try:
+            assert KD_LOGGER.level == logging.WARNING
+            assert INPUT_LOGGER.level == logging.DEBUG
+        finally:
+            setup.close()
+        assert (
+            KD_LOGGER.level,
+            INPUT_LOGGER.level,
+            XQEMU_LOGGER.level,
+        ) == original_levels
+
+    def test_unknown_channel(self):
+        with pytest.raises(ValueError):
+            XQEMULoggingSetup({"video": "INFO"})
+
+    def test_rate_limit_applied(self, mocked_monotonic, caplog):
+        """Records over the limit never reach the handlers"""
+        # pylint: disable=unused-argument
+        setup = XQEMULoggingSetup({"pyxboxtest": "INFO"}, max_records_per_second=2)
+        try:
+            with caplog.at_level(logging.INFO, logger="pyxboxtest"):
+                for i in range(5):
+                    KD_LOGGER.info("line %d", i)
+            assert [record.getMessage() for record in caplog.records] == [
+                "line 0",
+                "line 1",
+            ]
+            assert setup.get_num_dropped() == {"pyxboxtest.kd": 3}
+        finally:
+            setup.close()
+        assert setup.rate_limit_filter not in KD_LOGGER.filters
+
+    def test_log_file(self, tmp_path, caplog):
+        """Records go to the file (not pytest) and are all written on close"""
+        log_filename = tmp_path / "pyxboxtest.log"
+        setup = XQEMULoggingSetup({"pyxboxtest": "INFO"}, None, str(log_filename))
+        try:
+            for i in range(100):
+                KD_LOGGER.info("line %d", i)
+            INPUT_LOGGER.debug("not logged")
+        finally:
+            setup.close()
+        lines = log_filename.read_text().splitlines()
+        assert len(lines) == 100
+        assert lines[0].endswith("pyxboxtest.kd INFO line 0")
+        assert lines[-1].endswith("line 99")
+        assert not caplog.records
+        assert logging.getLogger("pyxboxtest").propagate
+
+
+class ParseLogLevelsParams(NamedTuple):
+    log_levels: list
+    expected: dict
+
+
+@pytest.mark.parametrize(
+    "params",
+    (
+        ParseLogLevelsParams([], {"pyxboxtest": "INFO"}),
+        ParseLogLevelsParams(["DEBUG"], {"pyxboxtest": "DEBUG"}),
+        ParseLogLevelsParams(
+            ["kd=WARNING", "input=DEBUG"],
+            {"pyxboxtest": "INFO", "kd": "WARNING", "input": "DEBUG"},
+        ),
+    ),
+)
+def test_parse_log_levels(params: ParseLogLevelsParams):
+    """Test turning --xqemu-log-level options into levels for each channel"""
+    assert _parse_log_levels(params.log_levels) == params.expected
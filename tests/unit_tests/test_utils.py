@@ -1,9 +1,13 @@
 """Test the various utilities in :py:mod:`pyxboxtest._utils`"""
+import os
+import subprocess
+import sys
 import time
 
 from mock import Mock
 import pytest
 
+from pyxboxtest import _utils
 from pyxboxtest._utils import (
     retry_every,
     UnusedPort,
@@ -127,6 +131,107 @@ class TestUnusedPorts:
         ), "All the ports are integers"
 
 
+class TestPortLeases:
+    """tests for the lease files that stop
+    :py:class:`~pyxboxtest.utils.UnusedPorts` giving the same port to
+    different processes
+    """
+
+    @pytest.fixture(autouse=True)
+    def lease_dir(self, tmp_path, monkeypatch) -> str:
+        """Don't interfere with leases held by anything else"""
+        monkeypatch.setattr(_utils, "_PORT_LEASE_DIR", str(tmp_path))
+        return str(tmp_path)
+
+    @pytest.mark.skipif(not hasattr(os, "getuid"), reason="Needs user ids")
+    def test_lease_dir_per_user(self, mocker):
+        """Users on a shared machine can't lock each other's lease files"""
+        mocker.patch("os.getuid", return_value=1000)
+        first_user_dir = _utils._get_port_lease_dir()
+        mocker.patch("os.getuid", return_value=1001)
+        assert _utils._get_port_lease_dir() != first_user_dir
+
+    def test_release(self, lease_dir: str):
+        """Ensure that releasing a port removes its lease file, and that it
+        is safe to release more than once
+        """
+        with UnusedPort() as unused_port:
+            lease_path = os.path.join(
+                lease_dir, f"{unused_port.get_port_number()}.lease"
+            )
+            assert os.path.isfile(lease_path), "lease taken"
+        assert not os.path.exists(lease_path), "lease released"
+        unused_port.release()
+
+    @pytest.mark.parametrize("port", (1234, 5678))
+    def test_lease_not_given_twice(self, port: int):
+        """Ensure that a port leased by a live process can't be leased again"""
+        assert _utils._try_to_lease_port(port), "first lease succeeds"
+        assert not _utils._try_to_lease_port(port), "second lease fails"
+        _utils._release_port_lease(port)
+        assert _utils._try_to_lease_port(port), "free once released"
+        _utils._release_port_lease(port)
+
+    def test_stale_lease_taken_over(self, lease_dir: str):
+        """Ensure that a lease left behind by a process that has died is
+        taken over
+        """
+        with open(os.path.join(lease_dir, "4321.lease"), "w") as lease_file:
+            lease_file.write("4321")
+        assert _utils._try_to_lease_port(4321), "stale lease taken over"
+        _utils._release_port_lease(4321)
+
+    def test_lease_held_by_other_process(self, lease_dir: str):
+        """Ensure that a lease held by another process can't be taken until \
+            that process exits, however it exits
+        """
+        holder = subprocess.Popen(
+            (
+                sys.executable,
+                "-c",
+                "import sys; from pyxboxtest import _utils; "
+                + f"_utils._PORT_LEASE_DIR = {lease_dir!r}; "
+                + "print(_utils._try_to_lease_port(1357), flush=True); "
+                + "sys.stdin.read()",
+            ),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.dirname(_utils.__file__)),
+        )
+        try:
+            assert holder.stdout.readline().strip() == b"True", "held elsewhere"
+            assert not _utils._try_to_lease_port(1357), "not given twice"
+        finally:
+            holder.kill()
+            holder.wait()
+        assert _utils._try_to_lease_port(1357), "free once the holder has died"
+        _utils._release_port_lease(1357)
+
+    def test_released_whilst_being_taken(self, mocker):
+        """Ensure that a lease released (and its file removed) between \
+            another process opening the file and locking it isn't taken, as \
+            that would be a lease on a file that no longer exists
+        """
+        assert _utils._try_to_lease_port(2468)
+        try_to_lock = _utils._try_to_lock
+
+        def release_then_lock(fd: int) -> bool:
+            _utils._release_port_lease(2468)
+            return try_to_lock(fd)
+
+        mocker.patch.object(_utils, "_try_to_lock", side_effect=release_then_lock)
+        assert not _utils._try_to_lease_port(2468)
+
+    def test_collisions_counted(self, mocker):
+        """Ensure that ports reserved elsewhere are skipped and counted"""
+        num_collisions = UnusedPort.get_num_collisions()
+        mocker.patch(
+            "pyxboxtest._utils._try_to_lease_port", side_effect=[False, False, True]
+        )
+        UnusedPort().release()
+        assert UnusedPort.get_num_collisions() == num_collisions + 2
+
+
 @pytest.mark.parametrize(
     "filepath", ("/C/test/file.txt", "/E/file.txt", "/G/dir1/dir2/file.ext")
 )
@@ -0,0 +1 @@
+"""Tests for :py:mod:`pyxboxtest.xqemu.screen`"""
@@ -0,0 +1,88 @@
+"""Tests for estimating the frame rate from the screen"""
+from typing import NamedTuple, Sequence, Tuple
+
+import numpy as np
+import pytest
+
+from pyxboxtest.xqemu.screen import XQEMUFrameStall, measure_frame_rate
+
+
+class FakeScreen:
+    """An app rendering at a fixed rate, except whilst stalled. Each sample \
+        takes some time, like a screendump
+    """
+
+    def __init__(
+        self, fps: float, sample_time: float, stalls: Sequence[Tuple[float, float]]
+    ):
+        self.now = 0.0
+        self._fps = fps
+        self._sample_time = sample_time
+        self._stalls = stalls
+
+    def perf_counter(self) -> float:
+        return self.now
+
+    def grab_frame(self) -> np.ndarray:
+        self.now += self._sample_time
+        render_time = self.now
+        for start, end in self._stalls:
+            if start <= render_time < end:
+                render_time = start
+        return np.full((2, 2, 3), int(render_time * self._fps) % 256, np.uint8)
+
+
+class FrameRateParams(NamedTuple):
+    fps: float
+    sample_time: float
+    stalls: Tuple[Tuple[float, float], ...]
+    expected_fps: float
+    expected_stalls: Tuple[XQEMUFrameStall, ...]
+    is_sample_limited: bool
+
+
+@pytest.mark.parametrize(
+    "params",
+    (
+        FrameRateParams(30, 0.004, (), 30, (), False),
+        FrameRateParams(
+            60, 0.002, ((0.5, 0.75),), 45, (XQEMUFrameStall(0.5, 0.25),), False
+        ),
+        # Sampling is too slow to see every frame
+        FrameRateParams(60, 0.025, (), 40, (), True),
+        # Nothing changes
+        FrameRateParams(0, 0.01, (), 0, (XQEMUFrameStall(0, 1),), False),
+    ),
+)
+def test_measure_frame_rate(mocker, params: FrameRateParams):
+    screen = FakeScreen(params.fps, params.sample_time, params.stalls)
+    mocker.patch("time.perf_counter", screen.perf_counter)
+    measurement = measure_frame_rate(screen.grab_frame, 1, stall_time=0.1)
+    assert measurement.duration == pytest.approx(1, abs=params.sample_time)
+    assert measurement.num_samples == pytest.approx(1 / params.sample_time, abs=2)
+    assert measurement.fps == pytest.approx(params.expected_fps, abs=1)
+    assert measurement.sample_rate == pytest.approx(1 / params.sample_time, rel=0.02)
+    assert len(measurement.stalls) == len(params.expected_stalls)
+    for stall, expected_stall in zip(measurement.stalls, params.expected_stalls):
+        assert stall.start_time == pytest.approx(expected_stall.start_time, abs=0.03)
+        assert stall.duration == pytest.approx(expected_stall.duration, abs=0.03)
+    assert measurement.is_sample_limited == params.is_sample_limited
+
+
+def test_frame_time_statistics(mocker):
+    """Ensure that uneven frame times show up in the variance"""
+    screen = FakeScreen(0, 0.01, ())
+    mocker.patch("time.perf_counter", screen.perf_counter)
+    frame_values = iter([0] * 5 + [1] * 10 + [2] * 30 + [3] * 10 + [4] * 100)
+
+    def grab_frame() -> np.ndarray:
+        screen.now += 0.01
+        return np.full((2, 2, 3), next(frame_values), np.uint8)
+
+    measurement = measure_frame_rate(grab_frame, 0.6)
+    assert measurement.num_frames == 4
+    assert measurement.mean_frame_time == pytest.approx(np.mean([0.1, 0.3, 0.1]))
+    assert measurement.max_frame_time == pytest.approx(0.3)
+    assert measurement.frame_time_variance == pytest.approx(
+        np.var([0.1, 0.3, 0.1]), abs=1e-6
+    )
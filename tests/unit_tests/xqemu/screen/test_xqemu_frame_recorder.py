@@ -0,0 +1,74 @@
+"""Tests for recording the screen in the background"""
+import time
+
+import numpy as np
+import pytest
+
+from pyxboxtest.xqemu.screen import XQEMUFrameRecorder, load_png
+
+
+def make_frame(value: int, size: int = 4) -> np.ndarray:
+    return np.full((size, size, 3), value, dtype=np.uint8)
+
+
+def test_sample(mocker):
+    """Identical consecutive frames are only kept once, the oldest are dropped"""
+    frames = [make_frame(value) for value in (1, 1, 2, 2, 2, 1, 3)]
+    recorder = XQEMUFrameRecorder(
+        mocker.Mock(side_effect=frames), fps=10, max_frames=3
+    )
+    times = mocker.patch("time.perf_counter")
+    for sample_time in range(len(frames)):
+        times.return_value = float(sample_time)
+        recorder._sample()
+
+    assert recorder.get_num_samples() == 7
+    recorded = recorder.get_frames()
+    assert [frame.pixels[0, 0, 0] for frame in recorded] == [2, 1, 3]
+    assert [frame.start_time for frame in recorded] == [2, 5, 6]
+    assert [frame.duration for frame in recorded] == pytest.approx([3, 1, 0.1])
+    assert not recorded[0].pixels.flags.writeable
+
+
+def test_record_in_background(mocker):
+    """Ensure that sampling continues past errors until stopped"""
+    grab_frame = mocker.Mock(
+        side_effect=[RuntimeError("Not ready")] + [make_frame(7)] * 1000
+    )
+    recorder = XQEMUFrameRecorder(grab_frame, fps=1000)
+    recorder.start()
+    assert recorder.is_recording()
+    deadline = time.perf_counter() + 10
+    while recorder.get_num_samples() < 3 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    recorder.stop()
+    assert not recorder.is_recording()
+    num_samples = recorder.get_num_samples()
+    assert num_samples >= 3
+    assert len(recorder.get_frames()) == 1
+    time.sleep(0.05)
+    assert recorder.get_num_samples() == num_samples, "stopped sampling"
+
+
+def test_save_recording(tmp_path, mocker):
+    """Ensure that the recording is saved as an animated PNG in the background, \
+        even if the screen's resolution changed
+    """
+    frames = [make_frame(1), make_frame(2, size=6), make_frame(3)]
+    recorder = XQEMUFrameRecorder(mocker.Mock(side_effect=frames))
+    assert recorder.save_recording(str(tmp_path / "empty.png")) is None
+    for _ in frames:
+        recorder._sample()
+
+    filename = str(tmp_path / "recording.png")
+    assert recorder.save_recording(filename).result(10) == filename
+    first_frame = load_png(filename)
+    assert first_frame.shape == (6, 6, 3)
+    assert np.array_equal(first_frame[:4, :4], make_frame(1))
+    assert not first_frame[4:].any() and not first_frame[:, 4:].any()
+
+
+@pytest.mark.parametrize("fps,max_frames", ((0, 10), (5, 0)))
+def test_invalid(fps: float, max_frames: int):
+    with pytest.raises(ValueError):
+        XQEMUFrameRecorder(lambda: make_frame(0), fps, max_frames)
@@ -0,0 +1,191 @@
+"""Tests for comparing frames with golden images"""
+import json
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+from pyxboxtest.xqemu.screen import (
+    XQEMUGoldenImageMismatchError,
+    XQEMUGoldenImageMissingError,
+    XQEMUGoldenImageStore,
+    XQEMUScreenRegion,
+    get_hash_distance,
+    get_perceptual_hash,
+    get_ssim,
+    load_png,
+)
+from pyxboxtest.xqemu.screen.xqemu_golden_images import _get_digest
+
+
+def make_frame(seed: int = 0) -> np.ndarray:
+    """A frame with some structure, like a menu"""
+    frame = np.full((120, 160, 3), 30, dtype=np.uint8)
+    rng = np.random.default_rng(seed)
+    for _ in range(6):
+        y, x = rng.integers(0, 100), rng.integers(0, 140)
+        frame[y : y + 20, x : x + 20] = rng.integers(0, 256, 3)
+    return frame
+
+
+@pytest.fixture
+def store(tmp_path) -> XQEMUGoldenImageStore:
+    os.mkdir(tmp_path / "diffs")
+    return XQEMUGoldenImageStore(str(tmp_path / "goldens"), str(tmp_path / "diffs"))
+
+
+def test_perceptual_hash():
+    """Similar images have similar hashes, different ones don't"""
+    frame = make_frame()
+    noisy = frame.copy()
+    noisy[::7, ::5] += 3
+    assert get_hash_distance(get_perceptual_hash(frame), get_perceptual_hash(noisy)) <= 2
+    assert (
+        get_hash_distance(get_perceptual_hash(frame), get_perceptual_hash(make_frame(1)))
+        > 12
+    )
+
+
+def test_perceptual_hash_small_region():
+    assert 0 <= get_perceptual_hash(np.zeros((3, 5, 3), np.uint8)) < 2 ** 64
+
+
+def test_ssim():
+    frame = make_frame()
+    assert get_ssim(frame, frame) == pytest.approx(1)
+    assert get_ssim(frame, make_frame(1)) < 0.9
+
+
+def test_goldens_deduplicated(tmp_path, store: XQEMUGoldenImageStore):
+    """Ensure that the same image used by two goldens is only stored once"""
+    store.save_golden("menu", make_frame())
+    store.save_golden("menu_again", make_frame())
+    store.save_golden("other", make_frame(1))
+    blobs = [
+        filename
+        for _, _, filenames in os.walk(tmp_path / "goldens" / "blobs")
+        for filename in filenames
+    ]
+    assert len(blobs) == 2
+    with open(tmp_path / "goldens" / "index.json") as index_file:
+        index = json.load(index_file)
+    assert index["menu"]["digest"] == index["menu_again"]["digest"]
+    assert np.array_equal(store.get_golden("other"), make_frame(1))
+
+
+def test_digest_keeps_precision():
+    """Frames that differ only below 8 bits still have different digests"""
+    frame = np.full((4, 4, 3), 0x1200, dtype=np.uint16)
+    finer = frame + 1
+    assert _get_digest(frame) != _get_digest(finer)
+    assert _get_digest(frame) == _get_digest(frame.astype(">u2"))
+    assert _get_digest(frame) != _get_digest(np.zeros((4, 4, 6), dtype=np.uint8))
+
+
+def _save_goldens(goldens_dir: str, diffs_dir: str, worker: int) -> None:
+    store = XQEMUGoldenImageStore(goldens_dir, diffs_dir)
+    for index in range(5):
+        store.save_golden(f"worker{worker}_{index}", make_frame(index))
+
+
+def test_goldens_saved_by_processes(tmp_path):
+    """Ensure that processes saving goldens at once keep each other's"""
+    os.mkdir(tmp_path / "diffs")
+    goldens_dir, diffs_dir = str(tmp_path / "goldens"), str(tmp_path / "diffs")
+    XQEMUGoldenImageStore(goldens_dir, diffs_dir)
+    processes = [
+        multiprocessing.Process(
+            target=_save_goldens, args=(goldens_dir, diffs_dir, worker)
+        )
+        for worker in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    with open(tmp_path / "goldens" / "index.json") as index_file:
+        index = json.load(index_file)
+    assert len(index) == 20
+
+
+def test_identical_frame_not_decoded(store: XQEMUGoldenImageStore, mocker):
+    """Identical frames are matched by hash without loading the golden"""
+    store.save_golden("menu", make_frame())
+    get_golden = mocker.spy(store, "get_golden")
+    store.assert_matches(make_frame(), "menu")
+    get_golden.assert_not_called()
+
+
+def test_close_frame_matches(store: XQEMUGoldenImageStore):
+    store.save_golden("menu", make_frame())
+    frame = make_frame()
+    frame[0, 0] += 2
+    store.assert_matches(frame, "menu", pixel_threshold=2)
+    comparison = store.compare(frame, "menu", max_changed_fraction=0.001)
+    assert comparison.matched
+    assert comparison.changed_fraction == pytest.approx(1 / (120 * 160))
+    store.assert_matches(frame, "menu", min_ssim=0.99)
+
+
+def test_mismatch(tmp_path, store: XQEMUGoldenImageStore):
+    """Ensure that a diff image is saved when a frame doesn't match"""
+    store.save_golden("menu", make_frame())
+    frame = make_frame()
+    frame[10:20, 10:20] = 255
+    with pytest.raises(XQEMUGoldenImageMismatchError, match="menu.diff.png"):
+        store.assert_matches(frame, "menu")
+    (diff_filename,) = os.listdir(tmp_path / "diffs")
+    diff = load_png(str(tmp_path / "diffs" / diff_filename))
+    assert diff.shape == (120, 160 * 3, 3)
+    assert tuple(diff[15, 320 + 15]) == (255, 0, 0)
+
+
+def test_very_different_frame_compared(store: XQEMUGoldenImageStore):
+    store.save_golden("menu", make_frame())
+    comparison = store.compare(make_frame(1), "menu", pixel_threshold=5)
+    assert not comparison.matched
+    assert comparison.changed_fraction > 0.1
+
+
+@pytest.mark.parametrize("level", (0, 128))
+def test_flat_golden_compared(store: XQEMUGoldenImageStore, level: int):
+    """The perceptual hash of a flat image is noise, so the pixels decide"""
+    golden = np.full((120, 160, 3), level, dtype=np.uint8)
+    store.save_golden("blank", golden)
+    frame = golden.copy()
+    frame[60, 80, 1] += 1
+    comparison = store.compare(frame, "blank", pixel_threshold=5)
+    assert comparison.matched
+    assert comparison.changed_fraction == 0
+
+
+def test_close_hash_accepted(store: XQEMUGoldenImageStore, mocker):
+    """Frames with close perceptual hashes can match without being compared"""
+    store.save_golden("menu", make_frame())
+    get_golden = mocker.spy(store, "get_golden")
+    frame = make_frame()
+    frame[0, 0] += 2
+    comparison = store.compare(frame, "menu", max_hash_distance=4)
+    assert comparison.matched and comparison.changed_fraction is None
+    get_golden.assert_not_called()
+    assert not store.compare(make_frame(1), "menu", max_hash_distance=4).matched
+
+
+def test_missing(store: XQEMUGoldenImageStore):
+    with pytest.raises(XQEMUGoldenImageMissingError):
+        store.assert_matches(make_frame(), "menu")
+
+
+def test_update_mode(tmp_path):
+    """Missing and mismatched goldens are saved rather than failing"""
+    store = XQEMUGoldenImageStore(str(tmp_path), str(tmp_path), update=True)
+    region = XQEMUScreenRegion(10, 20, 30, 40)
+    store.assert_matches(make_frame(), "menu", region)
+    store.assert_matches(make_frame(1), "menu", region)
+    assert np.array_equal(store.get_golden("menu"), make_frame(1)[20:60, 10:40])
+    # Other stores see the update
+    assert XQEMUGoldenImageStore(str(tmp_path), str(tmp_path)).compare(
+        make_frame(1), "menu", region
+    ).matched
@@ -0,0 +1,121 @@
+"""Tests for reading text from the screen"""
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from pyxboxtest.xqemu.screen import (
+    XQEMUOCRCacheInfo,
+    XQEMUOCRReader,
+    XQEMUScreenRegion,
+    preprocess_for_ocr,
+    tesseract_ocr,
+)
+
+REGIONS = {
+    "title": XQEMUScreenRegion(0, 0, 20, 10),
+    "status": XQEMUScreenRegion(0, 10, 20, 10),
+}
+
+
+def describe_text(pixels: np.ndarray) -> str:
+    """Stands in for OCR: the amount of text and the process that read it"""
+    return f"{np.count_nonzero(pixels == 0)} {os.getpid()}"
+
+
+def make_frame(title_pixels: int = 3, status_pixels: int = 5) -> np.ndarray:
+    """Light text on a dark background, like most Xbox menus"""
+    frame = np.full((20, 20, 3), 20, dtype=np.uint8)
+    frame[2, 2 : 2 + title_pixels] = 230
+    frame[12, 2 : 2 + status_pixels] = 230
+    return frame
+
+
+def test_preprocess_for_ocr():
+    """Text becomes black on white, whichever way round it was"""
+    pixels = make_frame()[:10]
+    binary = preprocess_for_ocr(pixels)
+    assert binary.dtype == np.uint8 and binary.shape == (26, 36)
+    assert np.count_nonzero(binary == 0) == 3
+    assert np.array_equal(np.nonzero(binary == 0), ([10] * 3, [10, 11, 12]))
+    assert np.array_equal(preprocess_for_ocr(255 - pixels), binary)
+
+    scaled = preprocess_for_ocr(pixels, scale=2)
+    assert scaled.shape == (36, 56)
+    assert np.count_nonzero(scaled == 0) == 12
+
+    # A fixed threshold that the text doesn't pass leaves nothing to read
+    assert not np.count_nonzero(preprocess_for_ocr(pixels, threshold=240) == 0)
+
+
+def test_read_text():
+    """Ensure that each region is read and reading it again is cached"""
+    with ThreadPoolExecutor() as executor:
+        reader = XQEMUOCRReader(
+            REGIONS, scale=1, ocr_function=describe_text, executor=executor
+        )
+        pid = os.getpid()
+        assert reader.read_text(make_frame()) == {
+            "title": f"3 {pid}",
+            "status": f"5 {pid}",
+        }
+        assert reader.get_cache_info() == XQEMUOCRCacheInfo(0, 2, 2)
+
+        # Only the region that changed is read again
+        assert reader.read_text(make_frame(status_pixels=7)) == {
+            "title": f"3 {pid}",
+            "status": f"7 {pid}",
+        }
+        assert reader.get_cache_info() == XQEMUOCRCacheInfo(1, 3, 3)
+        assert reader.read_text(make_frame(), ("status",)) == {"status": f"5 {pid}"}
+        assert reader.get_cache_info() == XQEMUOCRCacheInfo(2, 3, 3)
+
+        with pytest.raises(KeyError):
+            reader.read_text(make_frame(), ("missing",))
+
+
+def test_read_text_cache_eviction(mocker):
+    """The least recently read results are dropped and failures are retried"""
+    executor = mocker.Mock()
+    futures = []
+
+    def submit(*_) -> Future:
+        futures.append(Future())
+        return futures[-1]
+
+    executor.submit.side_effect = submit
+    reader = XQEMUOCRReader(REGIONS, executor=executor, cache_size=2)
+    first = reader.read_text_async(make_frame(1, 1), ("title",))["title"]
+    # Reads of the same pixels share the result, even before it is ready
+    assert reader.read_text_async(make_frame(1, 9), ("title",))["title"] is first
+    reader.read_text_async(make_frame(2, 1), ("title",))
+    reader.read_text_async(make_frame(1, 1), ("title",))
+    reader.read_text_async(make_frame(3, 1), ("title",))
+    assert executor.submit.call_count == 3
+    reader.read_text_async(make_frame(2, 1), ("title",))
+    assert executor.submit.call_count == 4
+
+    futures[-1].set_exception(RuntimeError("OCR failed"))
+    reader.read_text_async(make_frame(2, 1), ("title",))
+    assert executor.submit.call_count == 5
+    reader.close()
+    executor.shutdown.assert_not_called()
+
+
+def test_read_text_in_processes():
+    """By default OCR runs in other processes, not blocking the test"""
+    with XQEMUOCRReader(REGIONS, ocr_function=describe_text) as reader:
+        futures = reader.read_text_async(make_frame())
+        assert isinstance(futures["title"], Future)
+        text = {name: future.result(30) for name, future in futures.items()}
+    assert text["title"].startswith("12 ")
+    assert text["title"].split()[1] != str(os.getpid())
+
+
+def test_tesseract_ocr_missing(mocker):
+    """Ensure that a missing optional dependency is explained"""
+    mocker.patch.dict(sys.modules, {"pytesseract": None})
+    with pytest.raises(RuntimeError, match="pip install pytesseract"):
+        tesseract_ocr(np.zeros((10, 10), dtype=np.uint8))
@@ -0,0 +1,174 @@
+"""Tests for the PNG encoder and decoder"""
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+from pyxboxtest.xqemu.screen import (
+    XQEMUPNGFormatError,
+    decode_png,
+    encode_apng,
+    encode_png,
+    load_png,
+    save_apng,
+    save_png,
+)
+
+
+def random_pixels(shape) -> np.ndarray:
+    return np.random.default_rng(19).integers(0, 256, shape, dtype=np.uint8)
+
+
+@pytest.mark.parametrize("shape", ((5, 7, 3), (1, 1, 4), (3, 2, 1), (4, 4, 2), (6, 3)))
+def test_round_trip(shape):
+    pixels = random_pixels(shape)
+    decoded = decode_png(encode_png(pixels))
+    assert np.array_equal(decoded.reshape(pixels.shape), pixels)
+
+
+def test_save_and_load(tmp_path):
+    pixels = random_pixels((10, 10, 3))
+    save_png(str(tmp_path / "frame.png"), pixels)
+    assert np.array_equal(load_png(str(tmp_path / "frame.png")), pixels)
+
+
+def make_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(chunk_type + data)
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def paeth(left: int, above: int, upper_left: int) -> int:
+    estimate = left + above - upper_left
+    distance_left = abs(estimate - left)
+    distance_above = abs(estimate - above)
+    distance_upper_left = abs(estimate - upper_left)
+    if distance_left <= distance_above and distance_left <= distance_upper_left:
+        return left
+    if distance_above <= distance_upper_left:
+        return above
+    return upper_left
+
+
+def filter_row(row: bytes, previous: bytes, filter_type: int, bpp: int) -> bytes:
+    """Straightforward implementation of the PNG filters from the spec"""
+    filtered = bytearray()
+    for i, value in enumerate(row):
+        left = row[i - bpp] if i >= bpp else 0
+        upper_left = previous[i - bpp] if i >= bpp else 0
+        predictor = (
+            0,
+            left,
+            previous[i],
+            (left + previous[i]) // 2,
+            paeth(left, previous[i], upper_left),
+        )[filter_type]
+        filtered.append((value - predictor) % 256)
+    return bytes(filtered)
+
+
+def test_decode_all_filters():
+    """Ensure that PNGs from other encoders, which use every filter, decode"""
+    pixels = random_pixels((10, 4, 3))
+    raw = bytearray()
+    previous = bytes(12)
+    for row_number, row in enumerate(pixels):
+        filter_type = row_number % 5
+        raw.append(filter_type)
+        raw += filter_row(row.tobytes(), previous, filter_type, 3)
+        previous = row.tobytes()
+
+    png = (
+        b"\x89PNG\r\n\x1a\n"
+        + make_chunk(b"IHDR", struct.pack(">IIBBBBB", 4, 10, 8, 2, 0, 0, 0))
+        + make_chunk(b"IDAT", zlib.compress(bytes(raw)))
+        + make_chunk(b"IEND", b"")
+    )
+    assert np.array_equal(decode_png(png), pixels)
+
+
+@pytest.mark.parametrize(
+    "data",
+    (
+        b"not a png",
+        b"\x89PNG\r\n\x1a\n",
+        encode_png(np.zeros((2, 2, 3), np.uint8))[:-30],
+    ),
+)
+def test_invalid(data: bytes):
+    with pytest.raises(XQEMUPNGFormatError):
+        decode_png(data)
+
+
+def test_unsupported_pixels():
+    with pytest.raises(ValueError):
+        encode_png(np.zeros((2, 2, 3), np.uint16))
+
+
+def read_chunks(data: bytes):
+    position = 8
+    while position < len(data):
+        length, chunk_type = struct.unpack_from(">I4s", data, position)
+        yield chunk_type, data[position + 8 : position + 8 + length]
+        position += 12 + length
+
+
+def play_apng(data: bytes):
+    """Composite each frame of an animated PNG like a viewer would
+    :returns: the frames and their delays in seconds
+    """
+    canvas = decode_png(data).copy()
+    frames, delays = [], []
+    sequence_nums = []
+    animation_controls, frame_controls = [], []
+    for chunk_type, chunk_data in read_chunks(data):
+        if chunk_type == b"acTL":
+            animation_controls.append(struct.unpack(">II", chunk_data))
+        elif chunk_type == b"fcTL":
+            frame_controls.append(struct.unpack(">IIIIIHHBB", chunk_data))
+            sequence_nums.append(frame_controls[-1][0])
+        elif chunk_type in (b"IDAT", b"fdAT"):
+            _, width, height, x, y, delay, delay_denominator, dispose, blend = (
+                frame_controls[-1]
+            )
+            assert (dispose, blend) == (0, 0)
+            if chunk_type == b"fdAT":
+                sequence_nums.append(struct.unpack(">I", chunk_data[:4])[0])
+                # Decoded as a PNG of its own
+                part = decode_png(
+                    b"\x89PNG\r\n\x1a\n"
+                    + make_chunk(
+                        b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+                    )
+                    + make_chunk(b"IDAT", chunk_data[4:])
+                )
+                canvas[y : y + height, x : x + width] = part
+            frames.append(canvas.copy())
+            delays.append(delay / delay_denominator)
+    # The number of frames, played forever
+    assert animation_controls == [(len(frames), 0)]
+    assert sequence_nums == list(range(len(sequence_nums)))
+    return frames, delays
+
+
+def test_apng(tmp_path):
+    """Ensure that every frame plays back exactly, only storing what changed"""
+    first = random_pixels((20, 30, 3))
+    second = first.copy()
+    second[5:8, 10:20] = 0
+    frames = [first, second, second, first]
+    data = encode_apng(frames, [0.1, 0.25, 100, 0.0001])
+    played, delays = play_apng(data)
+    assert all(np.array_equal(*pair) for pair in zip(played, frames))
+    assert delays == [0.1, 0.25, 65.535, 0.001]
+    assert len(data) < len(encode_png(first)) * 2
+    # Viewers that don't understand animations show the first frame
+    assert np.array_equal(decode_png(data), first)
+
+    save_apng(str(tmp_path / "recording.png"), frames, [0.1] * 4)
+    assert np.array_equal(load_png(str(tmp_path / "recording.png")), first)
+
+    with pytest.raises(ValueError):
+        encode_apng([first, first[1:]], [0.1, 0.1])
+    with pytest.raises(ValueError):
+        encode_apng([first], [])
@@ -0,0 +1,93 @@
+"""Tests for reading PPM images"""
+from typing import NamedTuple
+
+import numpy as np
+import pytest
+
+from pyxboxtest.xqemu.screen import XQEMUPPMFormatError, load_ppm, load_ppms
+
+
+def write_ppm(filename: str, pixels: np.ndarray, header: bytes = b"") -> None:
+    """Save pixels of shape (height, width, 3) in the format used by QEMU"""
+    height, width, _ = pixels.shape
+    with open(filename, "wb") as ppm_file:
+        ppm_file.write(header or b"P6\n%d %d\n255\n" % (width, height))
+        ppm_file.write(pixels.astype(np.uint8).tobytes())
+
+
+def testload_ppm(tmp_path):
+    """Ensure that the pixels are read correctly and can't be changed"""
+    pixels = np.arange(4 * 3 * 3, dtype=np.uint8).reshape(4, 3, 3)
+    write_ppm(str(tmp_path / "frame.ppm"), pixels)
+    frame = load_ppm(str(tmp_path / "frame.ppm"))
+    assert np.array_equal(frame, pixels)
+    assert not frame.flags.writeable
+
+
+def testload_ppm_after_file_removed(tmp_path):
+    """Ensure that the pixels stay valid once the file is gone"""
+    pixels = np.full((2, 2, 3), 7, dtype=np.uint8)
+    write_ppm(str(tmp_path / "frame.ppm"), pixels)
+    frame = load_ppm(str(tmp_path / "frame.ppm"))
+    (tmp_path / "frame.ppm").unlink()
+    assert np.array_equal(frame, pixels)
+
+
+def test_header_with_comments(tmp_path):
+    pixels = np.zeros((1, 2, 3), dtype=np.uint8)
+    write_ppm(
+        str(tmp_path / "frame.ppm"), pixels, b"P6 # made by QEMU\n2\t1\n# max\n255 "
+    )
+    assert load_ppm(str(tmp_path / "frame.ppm")).shape == (1, 2, 3)
+
+
+def test_16_bit(tmp_path):
+    (tmp_path / "frame.ppm").write_bytes(b"P6 1 1 65535\n" + bytes(range(6)))
+    frame = load_ppm(str(tmp_path / "frame.ppm"))
+    assert frame.tolist() == [[[0x0001, 0x0203, 0x0405]]]
+
+
+class InvalidParams(NamedTuple):
+    contents: bytes
+
+
+@pytest.mark.parametrize(
+    "params",
+    (
+        InvalidParams(b""),
+        InvalidParams(b"P5\n1 1\n255\n\0"),
+        InvalidParams(b"P6\n1 1\n255"),
+        InvalidParams(b"P6\n1 x\n255\n\0\0\0"),
+        InvalidParams(b"P6\n0 1\n255\n"),
+        InvalidParams(b"P6\n2 2\n255\n\0\0\0"),
+        InvalidParams(b"P6 # no end to this comment"),
+    ),
+)
+def test_invalid(tmp_path, params: InvalidParams):
+    (tmp_path / "frame.ppm").write_bytes(params.contents)
+    with pytest.raises(XQEMUPPMFormatError):
+        load_ppm(str(tmp_path / "frame.ppm"))
+
+
+def test_load_ppms(tmp_path):
+    """Ensure that a sequence of images is loaded into one array"""
+    filenames = []
+    for i in range(5):
+        filenames.append(str(tmp_path / f"{i}.ppm"))
+        write_ppm(filenames[-1], np.full((3, 4, 3), i))
+    frames = load_ppms(filenames)
+    assert frames.shape == (5, 3, 4, 3)
+    assert frames.reshape(5, -1).max(axis=1).tolist() == list(range(5))
+
+
+@pytest.mark.parametrize("shape", ((3, 5, 3), (4, 4, 3)))
+def test_load_ppms_different_sizes(tmp_path, shape):
+    write_ppm(str(tmp_path / "0.ppm"), np.zeros((4, 5, 3)))
+    write_ppm(str(tmp_path / "1.ppm"), np.zeros(shape))
+    with pytest.raises(ValueError):
+        load_ppms((str(tmp_path / "0.ppm"), str(tmp_path / "1.ppm")))
+
+
+def test_load_no_ppms():
+    with pytest.raises(ValueError):
+        load_ppms(())
@@ -0,0 +1,149 @@
+"""Tests for waiting for the screen to settle or change"""
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+import pytest
+
+from pyxboxtest.xqemu.screen import (
+    XQEMUScreenRegion,
+    XQEMUScreenTimeoutError,
+    get_changed_fraction,
+    wait_for_screen_change,
+    wait_for_screen_stable,
+)
+
+
+class FakeClock:
+    """Time only passes when something sleeps"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps: List[float] = []
+
+    def perf_counter(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_clock(mocker) -> FakeClock:
+    clock = FakeClock()
+    mocker.patch("time.perf_counter", clock.perf_counter)
+    mocker.patch("time.sleep", clock.sleep)
+    return clock
+
+
+def make_frame(value: int = 0) -> np.ndarray:
+    return np.full((4, 6, 3), value, dtype=np.uint8)
+
+
+class ChangedFractionParams(NamedTuple):
+    changed_pixels: tuple
+    region: Optional[XQEMUScreenRegion]
+    pixel_threshold: int
+    expected: float
+
+
+@pytest.mark.parametrize(
+    "params",
+    (
+        ChangedFractionParams((), None, 0, 0.0),
+        ChangedFractionParams(((0, 0),), None, 0, 1 / 24),
+        ChangedFractionParams(((0, 0), (3, 5)), None, 0, 2 / 24),
+        # The change is smaller than the threshold
+        ChangedFractionParams(((0, 0),), None, 10, 0.0),
+        ChangedFractionParams(((0, 0),), XQEMUScreenRegion(0, 0, 2, 2), 0, 1 / 4),
+        ChangedFractionParams(((3, 5),), XQEMUScreenRegion(0, 0, 2, 2), 0, 0.0),
+    ),
+)
+def test_get_changed_fraction(params: ChangedFractionParams):
+    reference = make_frame(100)
+    frame = reference.copy()
+    for row, column in params.changed_pixels:
+        # Darker, to make sure that the difference doesn't wrap around
+        frame[row, column, 1] = 95
+    assert get_changed_fraction(
+        frame, reference, params.region, pixel_threshold=params.pixel_threshold
+    ) == pytest.approx(params.expected)
+
+
+def test_get_changed_fraction_mask():
+    reference = make_frame()
+    frame = make_frame()
+    frame[0, 0] = 255
+    mask = np.zeros((4, 6), dtype=bool)
+    mask[1:, :] = True
+    assert get_changed_fraction(frame, reference, mask=mask) == 0.0
+    mask[0, 0] = True
+    assert get_changed_fraction(frame, reference, mask=mask) == 1 / 19
+
+
+def test_different_sizes_changed():
+    assert get_changed_fraction(make_frame(), np.zeros((2, 2, 3), np.uint8)) == 1.0
+
+
+def test_wait_for_screen_stable(fake_clock: FakeClock):
+    """Ensure that the screen has to stay the same for the stable time"""
+
+    def grab_frame() -> np.ndarray:
+        # Changes every 0.1 seconds for the first second
+        return make_frame(min(int(fake_clock.now * 10), 10))
+
+    frame = wait_for_screen_stable(grab_frame, stable_time=0.5)
+    assert frame[0, 0, 0] == 10
+    assert 1.5 <= fake_clock.now < 1.6
+
+
+def test_wait_for_screen_stable_ignores_masked_changes(fake_clock: FakeClock):
+    def grab_frame() -> np.ndarray:
+        frame = make_frame()
+        frame[0, 0] = int(fake_clock.now * 100) % 256  # e.g. a clock on screen
+        return frame
+
+    mask = np.ones((4, 6), dtype=bool)
+    mask[0, 0] = False
+    wait_for_screen_stable(grab_frame, stable_time=0.5, mask=mask)
+    assert fake_clock.now == pytest.approx(0.5)
+
+
+def test_wait_for_screen_stable_backs_off(fake_clock: FakeClock):
+    """Ensure that the screen is sampled less often whilst it isn't changing"""
+    wait_for_screen_stable(make_frame, stable_time=2)
+    assert fake_clock.sleeps[:3] == pytest.approx([0.02, 0.04, 0.08])
+    assert max(fake_clock.sleeps) == 0.5
+
+
+def test_wait_for_screen_stable_timeout(fake_clock: FakeClock):
+    def grab_frame() -> np.ndarray:
+        return make_frame(int(fake_clock.now * 10) % 256)
+
+    with pytest.raises(XQEMUScreenTimeoutError):
+        wait_for_screen_stable(grab_frame, timeout=3)
+    assert fake_clock.now == pytest.approx(3)
+
+
+def test_wait_for_screen_change(fake_clock: FakeClock):
+    def grab_frame() -> np.ndarray:
+        frame = make_frame()
+        if fake_clock.now >= 2:
+            frame[:2] = 200
+        return frame
+
+    frame = wait_for_screen_change(grab_frame, min_changed_fraction=0.25)
+    assert frame[0, 0, 0] == 200
+    assert 2 <= fake_clock.now < 2.5
+
+
+def test_wait_for_screen_change_reference(fake_clock: FakeClock):
+    """A change that happened before waiting isn't missed"""
+    wait_for_screen_change(make_frame, reference=make_frame(1))
+    assert fake_clock.now == 0
+
+
+def test_wait_for_screen_change_timeout(fake_clock: FakeClock):
+    with pytest.raises(XQEMUScreenTimeoutError):
+        wait_for_screen_change(make_frame, timeout=1)
+    assert fake_clock.now == pytest.approx(1)
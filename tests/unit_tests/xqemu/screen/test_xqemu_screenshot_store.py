@@ -0,0 +1,57 @@
+"""Tests for compressing and deduplicating screenshots"""
+import json
+import os
+
+import numpy as np
+
+from pyxboxtest.xqemu.screen import (
+    XQEMUScreenshotStore,
+    XQEMUScreenshotStoreStats,
+    load_png,
+)
+
+from .test_xqemu_ppm import write_ppm
+
+
+def test_store(tmp_path):
+    """Identical screenshots are stored once, each test's are indexed"""
+    menu = np.zeros((30, 40, 3), dtype=np.uint8)
+    menu[10:20, 5:35] = (200, 100, 0)
+    game = np.random.default_rng(23).integers(0, 256, (30, 40, 3), dtype=np.uint8)
+    screenshots = (("1-menu.ppm", menu), ("2-menu.ppm", menu), ("3-game.ppm", game))
+    for filename, pixels in screenshots:
+        write_ppm(str(tmp_path / filename), pixels)
+    (tmp_path / "4-empty.ppm").touch()
+
+    store = XQEMUScreenshotStore(str(tmp_path))
+    menu_blobs = [
+        store.add(str(tmp_path / filename), "test_menu").result(10)
+        for filename in ("1-menu.ppm", "2-menu.ppm")
+    ]
+    game_blob = store.add(str(tmp_path / "3-game.ppm"), "test_game").result(10)
+    assert store.add(str(tmp_path / "4-empty.ppm"), "test_game").result(10) is None
+    assert store.add(str(tmp_path / "missing.ppm"), "test_game").result(10) is None
+    store.close()
+
+    assert menu_blobs[0] == menu_blobs[1] != game_blob
+    assert np.array_equal(load_png(str(tmp_path / menu_blobs[0])), menu)
+    assert np.array_equal(load_png(str(tmp_path / game_blob)), game)
+    assert sorted(os.listdir(tmp_path)) == ["4-empty.ppm", "blobs", "index.json"]
+
+    raw_bytes = 3 * (len(b"P6\n40 30\n255\n") + menu.size)
+    stored_bytes = os.path.getsize(tmp_path / menu_blobs[0]) + os.path.getsize(
+        tmp_path / game_blob
+    )
+    assert store.get_stats() == XQEMUScreenshotStoreStats(
+        3, 2, raw_bytes, stored_bytes
+    )
+    assert stored_bytes < raw_bytes
+
+    with open(tmp_path / "index.json") as index_file:
+        assert json.load(index_file) == {
+            "test_menu": [
+                {"screenshot": "1-menu.ppm", "blob": menu_blobs[0]},
+                {"screenshot": "2-menu.ppm", "blob": menu_blobs[0]},
+            ],
+            "test_game": [{"screenshot": "3-game.ppm", "blob": game_blob}],
+        }
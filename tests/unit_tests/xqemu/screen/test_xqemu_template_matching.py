@@ -0,0 +1,138 @@
+"""Tests for finding templates on screen"""
+from typing import NamedTuple
+
+import numpy as np
+import pytest
+
+from pyxboxtest.xqemu.screen import (
+    XQEMUScreenRegion,
+    XQEMUTemplateMatch,
+    find_template,
+    save_png,
+)
+from pyxboxtest.xqemu.screen import xqemu_template_matching
+
+
+def make_background() -> np.ndarray:
+    rng = np.random.default_rng(1)
+    # Smooth, so that it doesn't look like the template at any level
+    background = np.repeat(np.repeat(rng.integers(0, 80, (60, 80, 3)), 4, 0), 4, 1)
+    return background.astype(np.uint8)
+
+
+def make_template() -> np.ndarray:
+    template = np.zeros((24, 40, 3), dtype=np.uint8)
+    template[:, :, 0] = 200
+    template[4:20, 4:12] = 255
+    template[8:16, 16:36, 1] = 180
+    return template
+
+
+class FindParams(NamedTuple):
+    x: int
+    y: int
+    max_levels: int
+
+
+@pytest.mark.parametrize(
+    "params",
+    (
+        FindParams(0, 0, 4),
+        FindParams(101, 37, 4),
+        FindParams(280, 216, 4),
+        FindParams(33, 150, 1),
+        FindParams(255, 7, 2),
+    ),
+)
+def test_find_template(params: FindParams):
+    """Ensure that the template is found exactly wherever it is"""
+    frame = make_background()
+    template = make_template()
+    frame[params.y : params.y + 24, params.x : params.x + 40] = template
+    matches = find_template(frame, template, max_levels=params.max_levels)
+    assert len(matches) == 1
+    assert matches[0][:4] == (params.x, params.y, 40, 24)
+    assert matches[0].score == pytest.approx(1)
+
+
+def test_find_template_multiple_and_region():
+    """Ensure that every copy is found, best first, and regions are searched \
+        in frame coordinates
+    """
+    frame = make_background()
+    template = make_template()
+    frame[20:44, 30:70] = template
+    # A dimmer copy doesn't match as well
+    frame[150:174, 200:240] = template // 2 + 20
+    matches = find_template(frame, template, threshold=0.5)
+    assert [match[:2] for match in matches] == [(30, 20), (200, 150)]
+    assert matches[0].score > matches[1].score
+    assert find_template(frame, template, threshold=0.5, max_matches=1) == [
+        matches[0]
+    ]
+
+    region_matches = find_template(
+        frame, template, XQEMUScreenRegion(150, 100, 150, 100), threshold=0.5
+    )
+    assert [match[:2] for match in region_matches] == [(200, 150)]
+
+
+def test_find_template_missing():
+    """Nothing is found if the template isn't there or doesn't fit"""
+    template = make_template()
+    assert not find_template(make_background(), template)
+    assert not find_template(np.zeros((10, 10, 3), dtype=np.uint8), template)
+    with pytest.raises(ValueError):
+        find_template(make_background(), np.zeros((8, 8, 3), dtype=np.uint8))
+
+
+def test_find_template_refinement_stops(mocker):
+    """A candidate that can't be refined at full resolution is dropped rather \
+        than reported with a coarser level's position
+    """
+    frame = make_background()
+    # Big enough to be refined at more than one level
+    template = np.repeat(np.repeat(make_template(), 2, 0), 2, 1)
+    frame[50:98, 60:140] = template
+    refine = xqemu_template_matching._refine
+
+    def refine_until_full_resolution(image: np.ndarray, *args):
+        return None if image.shape == frame.shape[:2] else refine(image, *args)
+
+    mocker.patch.object(
+        xqemu_template_matching, "_refine", side_effect=refine_until_full_resolution
+    )
+    assert not find_template(frame, template)
+
+
+def test_template_cache(tmp_path, mocker):
+    """Ensure that templates are only prepared once, whether they are arrays \
+        or files
+    """
+    mocker.patch.object(
+        xqemu_template_matching,
+        "_template_cache",
+        xqemu_template_matching._TemplateCache(max_size=2),
+    )
+    pyramid_spy = mocker.spy(xqemu_template_matching, "_TemplatePyramid")
+    frame = make_background()
+    template = make_template()
+    frame[50:74, 60:100] = template
+    template_filename = str(tmp_path / "template.png")
+    save_png(template_filename, template)
+
+    expected = [XQEMUTemplateMatch(60, 50, 40, 24, pytest.approx(1))]
+    for _ in range(3):
+        assert find_template(frame, template.copy()) == expected
+        assert find_template(frame, template_filename) == expected
+    assert pyramid_spy.call_count == 2
+
+    # The least recently used template is dropped
+    find_template(frame, template[:, ::-1].copy())
+    find_template(frame, template_filename)
+    assert pyramid_spy.call_count == 3
+    find_template(frame, template)
+    assert pyramid_spy.call_count == 4
+
+    with pytest.raises(ValueError):
+        find_template(frame, __file__)
@@ -0,0 +1,256 @@
+"""Tests for :py:class:`~pyxboxtest.xqemu.AsyncXQEMUXboxAppRunner` and the
+asyncio clients that it uses
+"""
+import asyncio
+import itertools
+import json
+import threading
+from typing import Any, Dict, List, Tuple
+
+from mock import AsyncMock, Mock
+import pytest
+
+from pyxboxtest.xqemu import (
+    AsyncQEMUMonitorProtocol,
+    AsyncXQEMUKDCapturer,
+    AsyncXQEMUXboxAppRunner,
+    XQEMURAMSize,
+    XQEMUXboxAppRunner,
+    XQEMUXboxControllerButtons,
+)
+from pyxboxtest.xqemu.xqemu_xbox_app_runner import (
+    _XQEMUXboxAppRunnerGlobalParams,
+    _take_new_screenshots,
+)
+
+
+async def _start_kd_server(kd_strs: Tuple[str, ...]) -> Tuple[asyncio.Server, int]:
+    """Emulate the socket that xqemu creates for forwarding KD output
+    :returns: the server and the port it is listening on
+    """
+
+    async def send_kd_strs(_, writer: asyncio.StreamWriter):
+        for kd_str in kd_strs:
+            writer.write(kd_str.encode())
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(send_kd_strs, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+@pytest.mark.parametrize(
+    "chunks_to_send",
+    (
+        ("first", "test\n", "asdasdasd\n"),
+        ("second test\nasdasdasd", "\n"),
+        ("l", "i", "n", "e", "\n"),
+    ),
+)
+def test_kd_get_line(chunks_to_send: Tuple[str, ...]):
+    """Ensure that whole lines are returned however they are sent"""
+
+    async def get_lines() -> List[str]:
+        server, port = await _start_kd_server(chunks_to_send)
+        async with server:
+            kd_capturer = await AsyncXQEMUKDCapturer.connect(port)
+            lines = [
+                await kd_capturer.get_line()
+                for _ in range("".join(chunks_to_send).count("\n"))
+            ]
+            kd_capturer.close()
+            return lines
+
+    expected_lines = [
+        line + "\n" for line in "".join(chunks_to_send)[:-1].split("\n")
+    ]
+    assert asyncio.run(get_lines()) == expected_lines
+
+
+@pytest.mark.parametrize("data_to_send", ("test", "a" * 10000), ids=("short", "long"))
+def test_kd_get_all(data_to_send: str):
+    """Ensure that all available data is returned"""
+
+    async def get_all() -> str:
+        server, port = await _start_kd_server((data_to_send,))
+        async with server:
+            kd_capturer = await AsyncXQEMUKDCapturer.connect(port)
+            data = await kd_capturer.get_all(wait_time=0.5)
+            kd_capturer.close()
+            return data
+
+    assert asyncio.run(get_all()) == data_to_send
+
+
+@pytest.mark.skipif(not hasattr(asyncio, "start_unix_server"), reason="no Unix sockets")
+def test_kd_unix_socket(tmp_path):
+    """Ensure that KD output can be captured from a Unix socket"""
+    socket_path = str(tmp_path / "kd.sock")
+
+    async def get_line() -> str:
+        async def send_line(_, writer: asyncio.StreamWriter):
+            writer.write(b"over a unix socket\n")
+            await writer.drain()
+            writer.close()
+
+        async with await asyncio.start_unix_server(send_line, socket_path):
+            kd_capturer = await AsyncXQEMUKDCapturer.connect(socket_path)
+            line = await kd_capturer.get_line()
+            kd_capturer.close()
+            return line
+
+    assert asyncio.run(get_line()) == "over a unix socket\n"
+
+
+async def _start_qmp_server(
+    responses: Tuple[Tuple[Dict[str, Any], ...], ...], received: List[Dict[str, Any]]
+) -> Tuple[asyncio.Server, int]:
+    """Emulate XQEMU's QMP socket. Responds to each command with the next
+    messages in responses and stores the commands in received
+    """
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(b'{"QMP": {"version": {}, "capabilities": []}}\r\n')
+        for messages in (({"return": {}},),) + responses:
+            data = (await reader.read(4096)).decode()
+            received.append(json.JSONDecoder().raw_decode(data)[0])
+            for message in messages:
+                writer.write(json.dumps(message).encode() + b"\r\n")
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def test_qmp_command_skips_events():
+    """Ensure that commands are sent correctly and that events are stored
+    rather than being mistaken for responses
+    """
+    received: List[Dict[str, Any]] = []
+
+    async def run_command():
+        server, port = await _start_qmp_server(
+            (({"event": "RESET"}, {"return": "done"}),), received
+        )
+        async with server:
+            qemu_monitor = await AsyncQEMUMonitorProtocol.connect(port)
+            ret = await qemu_monitor.command("system_reset")
+            events = qemu_monitor.get_events()
+            qemu_monitor.close()
+            return ret, events
+
+    ret, events = asyncio.run(run_command())
+    assert ret == "done"
+    assert events == [{"event": "RESET"}]
+    assert received == [{"execute": "qmp_capabilities"}, {"execute": "system_reset"}]
+
+
+@pytest.fixture
+def mocked_async_dependencies(mocker, mocked_unused_port_numbers):
+    """Don't start XQEMU or connect to it"""
+    process = Mock(spec=asyncio.subprocess.Process)
+    process.returncode = None
+    process.wait = AsyncMock()
+    create_subprocess_exec = mocker.patch(
+        "asyncio.create_subprocess_exec", AsyncMock(return_value=process)
+    )
+    mocker.patch(
+        "pyxboxtest.xqemu.xqemu_async_xbox_app_runner.AsyncXQEMUKDCapturer.connect",
+        AsyncMock(return_value=AsyncMock(close=Mock())),
+    )
+    qemu_monitor = AsyncMock(close=Mock())
+    mocker.patch(
+        "pyxboxtest.xqemu.xqemu_async_xbox_app_runner.AsyncQEMUMonitorProtocol.connect",
+        AsyncMock(return_value=qemu_monitor),
+    )
+    return create_subprocess_exec, process, qemu_monitor
+
+
+@pytest.fixture
+def mocked_unused_port_numbers(mocker) -> Tuple[int, ...]:
+    """Control the ports that are used"""
+    ports = (11, 22, 33)
+    unused_port = mocker.patch("pyxboxtest.xqemu.xqemu_xbox_app_runner.UnusedPort")
+    unused_port.return_value.get_port_number.side_effect = ports
+    return ports
+
+
+@pytest.mark.parametrize("ram_size", tuple(XQEMURAMSize))
+def test_runner_starts_and_stops_xqemu(mocked_async_dependencies, ram_size):
+    """Ensure that XQEMU is started with the same parameters as the blocking
+    runner and that it is stopped at the end
+    """
+    create_subprocess_exec, process, _ = mocked_async_dependencies
+    firmware = Mock()
+    firmware.get_command_line_args.return_value = ("firmware",)
+    XQEMUXboxAppRunner._global_params = _XQEMUXboxAppRunnerGlobalParams(
+        firmware, True
+    )
+
+    async def run_app():
+        async with AsyncXQEMUXboxAppRunner(dvd_filename="test.iso", ram_size=ram_size):
+            pass
+
+    asyncio.run(run_app())
+    xqemu_args = create_subprocess_exec.call_args.args
+    assert xqemu_args[:5] == ("xqemu", "-cpu", "pentium3", "-m", ram_size.value)
+    assert "tcp::22,server" in xqemu_args, "KD port used"
+    assert "tcp::33,server,nowait" in xqemu_args, "QMP port used"
+    assert "index=1,media=cdrom,file=test.iso" in xqemu_args
+    process.terminate.assert_called_once_with()
+    process.wait.assert_awaited_once_with()
+
+
+def test_runner_press_controller_buttons(mocked_async_dependencies):
+    """Ensure that controller input is sent through QMP"""
+    _, _, qemu_monitor = mocked_async_dependencies
+    firmware = Mock()
+    firmware.get_command_line_args.return_value = tuple()
+    XQEMUXboxAppRunner._global_params = _XQEMUXboxAppRunnerGlobalParams(
+        firmware, True
+    )
+
+    async def press_buttons():
+        async with AsyncXQEMUXboxAppRunner() as app:
+            await app.press_controller_buttons((XQEMUXboxControllerButtons.A,), 10)
+
+    asyncio.run(press_buttons())
+    qemu_monitor.command.assert_awaited_once_with(
+        "send-key",
+        keys=[{"type": "qcode", "data": XQEMUXboxControllerButtons.A.value}],
+        **{"hold-time": 10},
+    )
+
+
+def test_runner_save_screenshot(mocker, mocked_async_dependencies):
+    """Ensure that screenshots are registered to be compressed like the \
+        blocking runner's
+    """
+    _, _, qemu_monitor = mocked_async_dependencies
+    wanted = threading.Event()
+    wanted.set()
+    mocker.patch(
+        "pyxboxtest.xqemu.xqemu_xbox_app_runner._new_screenshots_wanted", wanted
+    )
+    # Leave the numbering of the blocking runner's tests alone
+    mocker.patch(
+        "pyxboxtest.xqemu.xqemu_xbox_app_runner._screenshot_nums", itertools.count(1)
+    )
+    firmware = Mock()
+    firmware.get_command_line_args.return_value = tuple()
+    XQEMUXboxAppRunner._global_params = _XQEMUXboxAppRunnerGlobalParams(
+        firmware, True
+    )
+    _take_new_screenshots()
+
+    async def save_screenshot() -> str:
+        async with AsyncXQEMUXboxAppRunner() as app:
+            return await app.save_screenshot("menu.ppm")
+
+    screenshot_path = asyncio.run(save_screenshot())
+    qemu_monitor.command.assert_awaited_once_with(
+        "screendump", filename=screenshot_path
+    )
+    assert _take_new_screenshots() == [screenshot_path]
+
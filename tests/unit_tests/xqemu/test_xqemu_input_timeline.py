@@ -0,0 +1,130 @@
+"""Tests for :py:class:`~pyxboxtest.xqemu.XQEMUInputTimeline`"""
+from typing import List, NamedTuple
+
+import pytest
+
+from pyxboxtest.xqemu import (
+    XQEMUInputBatch,
+    XQEMUInputTimeline,
+    XQEMUXboxControllerButtons,
+    play_input_timeline,
+)
+
+A = XQEMUXboxControllerButtons.A
+B = XQEMUXboxControllerButtons.B
+DPAD_DOWN = XQEMUXboxControllerButtons.DPAD_DOWN
+
+
+def key_event(button: XQEMUXboxControllerButtons, down: bool) -> dict:
+    return {
+        "type": "key",
+        "data": {"down": down, "key": {"type": "qcode", "data": button.value}},
+    }
+
+
+def test_compile():
+    """Events at the same time are batched, releases first"""
+    timeline = (
+        XQEMUInputTimeline()
+        .hold(0, 0.1, DPAD_DOWN)
+        .hold(0.1, 0.05, A, B)
+        .press(0.2, A)
+        .release(0.25, A)
+    )
+    assert timeline.compile() == (
+        XQEMUInputBatch(0, (key_event(DPAD_DOWN, True),)),
+        XQEMUInputBatch(
+            0.1,
+            (key_event(DPAD_DOWN, False), key_event(A, True), key_event(B, True)),
+        ),
+        XQEMUInputBatch(0.15, (key_event(A, False), key_event(B, False))),
+        XQEMUInputBatch(0.2, (key_event(A, True),)),
+        XQEMUInputBatch(0.25, (key_event(A, False),)),
+    )
+    assert len(timeline.get_events()) == 8
+
+
+class InvalidTimelineParams(NamedTuple):
+    timeline: XQEMUInputTimeline
+    message: str
+
+
+@pytest.mark.parametrize(
+    "params",
+    (
+        InvalidTimelineParams(XQEMUInputTimeline().press(0, A), "never released: A"),
+        InvalidTimelineParams(
+            XQEMUInputTimeline().press(0, A).press(0.1, A).release(0.2, A),
+            "A is already pressed at 0.1s",
+        ),
+        InvalidTimelineParams(
+            XQEMUInputTimeline().release(0, B), "B is already released at 0s"
+        ),
+        InvalidTimelineParams(
+            XQEMUInputTimeline().hold(0, 0.1, A).hold(0.1, 0.1, A),
+            "A is released and pressed again at the same time, 0.1s",
+        ),
+    ),
+)
+def test_compile_invalid(params: InvalidTimelineParams):
+    with pytest.raises(ValueError, match=params.message):
+        params.timeline.compile()
+
+
+@pytest.mark.parametrize("time_offset,duration", ((-1, 0.1), (0, 0)))
+def test_invalid_times(time_offset: float, duration: float):
+    with pytest.raises(ValueError):
+        XQEMUInputTimeline().hold(time_offset, duration, A)
+
+
+class FakeClock:
+    """Time passes a little on every read, like a real clock, and jumps \
+        forward when something sleeps
+    """
+
+    def __init__(self, sleep_overshoot: float):
+        self.now = 100.0
+        self.sleep_overshoot = sleep_overshoot
+        self.sleeps: List[float] = []
+
+    def perf_counter(self) -> float:
+        self.now += 0.0001
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds + self.sleep_overshoot
+
+
+@pytest.mark.parametrize("sleep_overshoot", (0, 0.0015))
+def test_play_input_timeline(mocker, sleep_overshoot: float):
+    """Ensure that each batch is sent on time and the lateness is reported"""
+    clock = FakeClock(sleep_overshoot)
+    mocker.patch("time.perf_counter", clock.perf_counter)
+    mocker.patch("time.sleep", clock.sleep)
+    sent = []
+
+    def command(name: str, **kwargs) -> dict:
+        sent.append((clock.now, name, kwargs))
+        clock.now += 0.004  # XQEMU's response time
+        return {}
+
+    timeline = XQEMUInputTimeline().hold(0, 0.1, A).hold(0.102, 0.5, B)
+    report = play_input_timeline(command, timeline)
+
+    batches = timeline.compile()
+    assert [(name, kwargs) for _, name, kwargs in sent] == [
+        ("input-send-event", {"events": list(batch.events)}) for batch in batches
+    ]
+    start_time = sent[0][0]
+    # The sleeps stop short so overshooting them doesn't make commands late
+    for index in (0, 1, 3):
+        send_time = sent[index][0] - start_time
+        assert send_time == pytest.approx(batches[index].time, abs=0.0005)
+    assert report.num_batches == 4 and report.num_events == 4
+    assert len(report.lateness) == 4
+    # The press of B had to wait for the response to the release of A
+    assert report.lateness[2] == pytest.approx(0.002, abs=0.001)
+    assert report.max_jitter == max(report.lateness)
+    assert report.max_round_trip == pytest.approx(0.004, abs=0.0005)
+    assert all(sleep < 0.5 for sleep in clock.sleeps)
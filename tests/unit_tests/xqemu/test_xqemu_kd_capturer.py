@@ -1,13 +1,22 @@
 """Tests for :py:class:`~pyxboxtest.xqemu.XQEMUKDCapturer`"""
 from contextlib import contextmanager
 from multiprocessing import Process
+import re
 import socket
+import struct
 from time import sleep
-from typing import Iterator, Tuple
+from typing import Iterator, Optional, Tuple
 
 import pytest
 
-from pyxboxtest.xqemu import XQEMUKDCapturer
+from pyxboxtest.xqemu import (
+    XQEMUKDCapturer,
+    XQEMUKDExpectTimeoutError,
+    XQEMUKDHub,
+    XQEMUKDLog,
+    XQEMUKDMatch,
+    XQEMUKDRecordTimeoutError,
+)
 from pyxboxtest._utils import UnusedPort
 
 
@@ -129,7 +138,7 @@ def test_get_num_chars(data_to_send: str, num_chars_to_receive: int):
 
 
 @pytest.mark.parametrize(
-    "data_to_send,", ("test", "test\n\n\asdadasd", "".join("a" for _ in range(10000)),),
+    "data_to_send", ("test", "test\n\n\asdadasd", "".join("a" for _ in range(10000)),),
 )
 def test_get_all_data_available(data_to_send: str):
     """Ensure that we can correctly retrieve all data that is currently
@@ -153,3 +162,278 @@ def test_get_all_no_data_available():
         assert (
             xqemu_kd_capturer.get_all() == ""
         ), "we did not block and captured something"
+
+
+@contextmanager
+def unix_kd_connection(
+    tmp_path, capture_in_background: bool = False, hub: Optional[XQEMUKDHub] = None
+) -> Iterator[Tuple[XQEMUKDCapturer, socket.socket]]:
+    """Context manager for an XQEMUKDCapturer connected to a Unix socket and
+    the server side of that connection, so that tests control exactly which
+    bytes are sent and when
+    """
+    socket_path = str(tmp_path / "kd.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(socket_path)
+        server.listen(1)
+        xqemu_kd_capturer = XQEMUKDCapturer(
+            socket_path, capture_in_background=capture_in_background, hub=hub
+        )
+        conn, _ = server.accept()
+        try:
+            with conn:
+                yield xqemu_kd_capturer, conn
+        finally:
+            xqemu_kd_capturer.close()
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+def test_unix_socket(tmp_path):
+    """Ensure that KD output can be captured from a Unix socket"""
+    with unix_kd_connection(tmp_path) as (xqemu_kd_capturer, conn):
+        conn.sendall(b"over a unix socket\n")
+        assert xqemu_kd_capturer.get_line() == "over a unix socket\n"
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+def test_multi_byte_character_split_across_reads(tmp_path):
+    """Ensure that a UTF-8 character is not corrupted when its bytes arrive
+    separately
+    """
+    encoded = "caf\u00e9\n".encode("utf-8")
+    with unix_kd_connection(tmp_path) as (xqemu_kd_capturer, conn):
+        conn.sendall(encoded[:-2])
+        sleep(0.1)
+        assert xqemu_kd_capturer.get_all("utf-8") == "caf", "partial char held"
+        conn.sendall(encoded[-2:])
+        assert xqemu_kd_capturer.get_line(encoding="utf-8") == "\u00e9\n"
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+def test_many_lines_from_one_read(tmp_path):
+    """Ensure that lines that arrive together are returned one at a time and
+    that nothing is lost when switching to get_all
+    """
+    with unix_kd_connection(tmp_path) as (xqemu_kd_capturer, conn):
+        conn.sendall(b"".join(b"line %d\n" % i for i in range(1000)) + b"rest")
+        for i in range(1000):
+            assert xqemu_kd_capturer.get_line() == f"line {i}\n"
+        assert xqemu_kd_capturer.get_all() == "rest"
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+def test_get_line_connection_closed(tmp_path):
+    """Ensure that we don't wait forever for a line that will never end"""
+    with unix_kd_connection(tmp_path) as (xqemu_kd_capturer, conn):
+        conn.sendall(b"partial line")
+        conn.close()
+        with pytest.raises(EOFError):
+            xqemu_kd_capturer.get_line()
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+def test_background_capture(tmp_path):
+    """Ensure that output is read without a getter being called and that the
+    getters and cursors both see all of it
+    """
+    with unix_kd_connection(tmp_path, capture_in_background=True) as (
+        xqemu_kd_capturer,
+        conn,
+    ):
+        cursor = xqemu_kd_capturer.get_cursor()
+        conn.sendall(b"first line\nsecond line\nthird")
+        assert cursor.read_line(10).text == "first line\n"
+        assert cursor.read_line(10).text == "second line\n"
+
+        assert xqemu_kd_capturer.get_line(" ") == "first "
+        assert xqemu_kd_capturer.get_num_chars(5) == "line\n"
+        conn.sendall(b" line\n")
+        assert xqemu_kd_capturer.get_line() == "second line\n"
+        assert xqemu_kd_capturer.get_line() == "third line\n"
+        assert xqemu_kd_capturer.get_all() == ""
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+def test_background_capture_connection_closed(tmp_path):
+    """Ensure that the reader thread stops when XQEMU closes the connection"""
+    with unix_kd_connection(tmp_path, capture_in_background=True) as (
+        xqemu_kd_capturer,
+        conn,
+    ):
+        conn.sendall(b"last line\n")
+        conn.close()
+        assert xqemu_kd_capturer.get_line() == "last line\n"
+        with pytest.raises(EOFError):
+            xqemu_kd_capturer.get_line()
+
+
+def test_cursor_needs_background_capture(mocked_socket):
+    """Ensure that asking for a cursor without a ring buffer fails clearly"""
+    with pytest.raises(RuntimeError):
+        XQEMUKDCapturer(1234).get_cursor()
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+@pytest.mark.parametrize("capture_in_background", (False, True))
+def test_expect(tmp_path, capture_in_background: bool):
+    """Ensure that expect finds patterns split across reads, reports where
+    they were found and consumes the output up to the end of the match
+    """
+    score_regex = re.compile(r"score: (\d+)")
+    with unix_kd_connection(tmp_path, capture_in_background) as (
+        xqemu_kd_capturer,
+        conn,
+    ):
+        conn.sendall(b"booting\nsco")
+        sleep(0.1)
+        conn.sendall(b"re: 42\nready\n")
+        match = xqemu_kd_capturer.expect(("ready", score_regex), timeout=10)
+        assert match == XQEMUKDMatch(score_regex, 1, "score: 42", ("42",), 8)
+        assert xqemu_kd_capturer.expect("ready", timeout=10).offset == 18
+        assert xqemu_kd_capturer.get_line() == "\n", "consumed up to the match"
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+@pytest.mark.parametrize("capture_in_background", (False, True))
+def test_expect_timeout(tmp_path, capture_in_background: bool):
+    """Ensure that expect gives up at the deadline without consuming output"""
+    with unix_kd_connection(tmp_path, capture_in_background) as (
+        xqemu_kd_capturer,
+        conn,
+    ):
+        conn.sendall(b"still booting\n")
+        with pytest.raises(XQEMUKDExpectTimeoutError):
+            xqemu_kd_capturer.expect(("ready", "error"), timeout=0.1)
+        assert xqemu_kd_capturer.get_line() == "still booting\n"
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+@pytest.mark.parametrize("capture_in_background", (False, True))
+def test_expect_connection_closed(tmp_path, capture_in_background: bool):
+    """Ensure that expect fails straight away if XQEMU goes away"""
+    with unix_kd_connection(tmp_path, capture_in_background) as (
+        xqemu_kd_capturer,
+        conn,
+    ):
+        conn.close()
+        with pytest.raises(EOFError):
+            xqemu_kd_capturer.expect("ready", timeout=1000)
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+def test_capture_with_hub(tmp_path):
+    """Ensure that output is captured in the background by a hub rather than
+    a thread of the capturer's own
+    """
+    hub = XQEMUKDHub()
+    with unix_kd_connection(tmp_path, hub=hub) as (xqemu_kd_capturer, conn):
+        conn.sendall(b"from the hub\n")
+        assert xqemu_kd_capturer.get_cursor().read_line(10).text == "from the hub\n"
+        assert xqemu_kd_capturer.get_line() == "from the hub\n"
+        assert xqemu_kd_capturer.get_hub_stats().bytes_received == 13
+    hub.close()
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+@pytest.mark.parametrize("capture_in_background", (False, True))
+def test_iter_json_records(tmp_path, capture_in_background: bool):
+    """Ensure that JSON records are decoded, other output is skipped and that
+    iteration stops when XQEMU closes the connection
+    """
+    with unix_kd_connection(tmp_path, capture_in_background) as (
+        xqemu_kd_capturer,
+        conn,
+    ):
+        conn.sendall(b'booting\n{"frame": 1, "fps": 60}\n{"other"')
+        conn.sendall(b': true}\n{"frame": 2, "fps": 59}\n')
+        conn.close()
+        records = list(xqemu_kd_capturer.iter_json_records(keys=("frame",)))
+    assert records == [{"frame": 1, "fps": 60}, {"frame": 2, "fps": 59}]
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+def test_json_record_timeout(tmp_path):
+    """Ensure that waiting for a record that never comes does not hang"""
+    with unix_kd_connection(tmp_path) as (xqemu_kd_capturer, conn):
+        conn.sendall(b"not a record\n")
+        with pytest.raises(XQEMUKDRecordTimeoutError):
+            xqemu_kd_capturer.get_json_record(timeout=0.1)
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+@pytest.mark.parametrize("capture_in_background", (False, True))
+def test_iter_binary_records(tmp_path, capture_in_background: bool):
+    """Ensure that length prefixed records are split correctly, whatever
+    bytes they contain
+    """
+    payloads = (b"\x00\xff\n\x80", b"", b"telemetry", b"\n#TLM c frames\n")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(str(tmp_path / "kd.sock"))
+        server.listen(1)
+        xqemu_kd_capturer = XQEMUKDCapturer(
+            str(tmp_path / "kd.sock"),
+            capture_in_background=capture_in_background,
+            background_encoding="latin-1",
+            parse_telemetry=not capture_in_background,
+        )
+        conn, _ = server.accept()
+        with conn:
+            for payload in payloads:
+                conn.sendall(struct.pack("<I", len(payload)) + payload)
+        records = tuple(xqemu_kd_capturer.iter_binary_records(timeout=10))
+        xqemu_kd_capturer.close()
+    assert records == payloads
+
+
+def test_binary_records_need_latin_1(mocked_socket):
+    """Ensure that binary data can't be corrupted by the background decoder"""
+    socket.socket.recv.return_value = b""  # pylint: disable=no-member
+    xqemu_kd_capturer = XQEMUKDCapturer(1234, capture_in_background=True)
+    with pytest.raises(ValueError):
+        next(xqemu_kd_capturer.iter_binary_records())
+    xqemu_kd_capturer.close()
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+@pytest.mark.parametrize("capture_in_background", (False, True))
+def test_log(tmp_path, capture_in_background: bool):
+    """Ensure that everything received is logged, even if it isn't read"""
+    kd_log = XQEMUKDLog(str(tmp_path / "kd.log"))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(str(tmp_path / "kd.sock"))
+        server.listen(1)
+        xqemu_kd_capturer = XQEMUKDCapturer(
+            str(tmp_path / "kd.sock"),
+            capture_in_background=capture_in_background,
+            log=kd_log,
+        )
+        conn, _ = server.accept()
+        with conn:
+            conn.sendall(b"read\nnot read\n")
+            assert xqemu_kd_capturer.get_line() == "read\n"
+        sleep(0.1)
+        xqemu_kd_capturer.get_all()
+        xqemu_kd_capturer.close()
+    kd_log.close()
+    with open(kd_log.get_filename(), "rb") as log_file:
+        assert log_file.read() == b"read\nnot read\n"
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+@pytest.mark.parametrize("capture_in_background", (False, True))
+def test_telemetry(tmp_path, capture_in_background: bool):
+    """Ensure that telemetry is aggregated and removed from the output"""
+    with unix_kd_connection(tmp_path, capture_in_background) as (
+        xqemu_kd_capturer,
+        conn,
+    ):
+        conn.sendall(b"booting\n#TLM t frame 16.7\n#TL")
+        conn.sendall(b"M t frame 33.4\n#TLM c draws 20\nready\n")
+        assert xqemu_kd_capturer.expect("ready", timeout=10).text == "ready"
+        telemetry = xqemu_kd_capturer.get_telemetry()
+        assert telemetry.get_timer_samples("frame") == (16.7, 33.4)
+        assert telemetry.get_counter("draws") == 20
+        conn.close()
+        assert xqemu_kd_capturer.get_line() == "\n"
+        with pytest.raises(EOFError):
+            xqemu_kd_capturer.get_line()
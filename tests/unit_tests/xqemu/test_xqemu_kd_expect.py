@@ -0,0 +1,93 @@
+"""Tests for the pattern matching used by
+:py:meth:`~pyxboxtest.xqemu.XQEMUKDCapturer.expect`
+"""
+import random
+import re
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+import pytest
+
+from pyxboxtest.xqemu.xqemu_kd_expect import (
+    KDPattern,
+    _MIN_LITERALS_FOR_AUTOMATON,
+    _KDPatternMatcher,
+)
+
+
+class SearchParams(NamedTuple):
+    patterns: Sequence[KDPattern]
+    text: str
+    expected: Optional[Tuple[int, int, int, Tuple[Optional[str], ...]]]
+
+
+@pytest.mark.parametrize(
+    "patterns, text, expected",
+    (
+        SearchParams(("ready",), "booting\nready\n", (0, 8, 13, ())),
+        SearchParams(("missing",), "booting\nready\n", None),
+        # The match that ends first wins, even if another starts earlier
+        SearchParams(("one two", "one"), "one two", (1, 0, 3, ())),
+        # Ties go to the first pattern
+        SearchParams(("one", "ne"), "one", (0, 0, 3, ())),
+        SearchParams(
+            (re.compile(r"score: (\d+)"), "game over"),
+            "score: 10\ngame over",
+            (0, 0, 9, ("10",)),
+        ),
+        SearchParams(
+            ("fail", re.compile(r"pass (\w+)")), "pass test1 ", (1, 0, 10, ("test1",)),
+        ),
+    ),
+)
+def test_search(
+    patterns: Sequence[KDPattern],
+    text: str,
+    expected: Optional[Tuple[int, int, int, Tuple[Optional[str], ...]]],
+):
+    """Ensure that the right pattern and position are found"""
+    assert _KDPatternMatcher(patterns).search(text, 0, 0) == expected
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_automaton_matches_simple_search(seed: int):
+    """Ensure that the automaton used for many literals finds exactly what
+    searching for each literal separately would
+    """
+    rng = random.Random(seed)
+    literals = [
+        "".join(rng.choice("abc") for _ in range(rng.randint(1, 4)))
+        for _ in range(_MIN_LITERALS_FOR_AUTOMATON * 2)
+    ]
+    with_automaton = _KDPatternMatcher(literals)
+    without_automaton = _KDPatternMatcher(literals[: _MIN_LITERALS_FOR_AUTOMATON - 1])
+    for _ in range(100):
+        text = "".join(rng.choice("abcd") for _ in range(20))
+        matches = sorted(
+            (text.find(literal) + len(literal), index)
+            for index, literal in enumerate(literals)
+            if literal in text
+        )
+        found = with_automaton.search(text, 0, 0)
+        if matches:
+            end, index = matches[0]
+            assert found == (index, end - len(literals[index]), end, ())
+        else:
+            assert found is None
+    assert with_automaton._automaton is not None
+    assert without_automaton._automaton is None
+
+
+def test_searched_text_skipped():
+    """Ensure that literals are not searched for again in text that has
+    already been searched, except where a match could overlap new text
+    """
+    matcher = _KDPatternMatcher(("abc",))
+    assert matcher.search("abcab", 0, 5) is None, "already searched"
+    assert matcher.search("abcabc", 0, 5) == (0, 3, 6, ()), "overlaps new text"
+
+
+@pytest.mark.parametrize("patterns", (tuple(), ("",)))
+def test_invalid_patterns(patterns: Tuple[str, ...]):
+    """Ensure that patterns that can never be waited for are rejected"""
+    with pytest.raises(ValueError):
+        _KDPatternMatcher(patterns)
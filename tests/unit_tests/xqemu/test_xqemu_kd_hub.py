@@ -0,0 +1,161 @@
+"""Tests for :py:class:`~pyxboxtest.xqemu.XQEMUKDHub`"""
+import socket
+import threading
+from typing import Iterator
+
+import pytest
+
+from pyxboxtest.xqemu import (
+    XQEMUKDHub,
+    XQEMUKDHubStats,
+    XQEMUKDRingBuffer,
+    close_shared_kd_hub,
+    get_shared_kd_hub,
+)
+
+
+@pytest.fixture
+def kd_hub() -> Iterator[XQEMUKDHub]:
+    """A hub that is only used by one test"""
+    hub = XQEMUKDHub()
+    yield hub
+    hub.close()
+
+
+@pytest.mark.parametrize("num_vms", (1, 20))
+def test_drains_every_socket(kd_hub: XQEMUKDHub, num_vms: int):
+    """Ensure that the output of many instances of XQEMU is read by the
+    hub's single thread into the right ring buffers
+    """
+    connections = [socket.socketpair() for _ in range(num_vms)]
+    ring_buffers = [XQEMUKDRingBuffer() for _ in range(num_vms)]
+    keys = [
+        kd_hub.register(kd_socket, ring_buffer, f"vm{i}")
+        for i, ((kd_socket, _), ring_buffer) in enumerate(
+            zip(connections, ring_buffers)
+        )
+    ]
+    threads_before = threading.active_count()
+
+    for i, (_, xqemu_side) in enumerate(connections):
+        xqemu_side.sendall(b"vm %d\n" % i)
+    for i, ring_buffer in enumerate(ring_buffers):
+        assert ring_buffer.get_cursor().read_line(10).text == f"vm {i}\n"
+
+    assert threading.active_count() == threads_before, "no thread per VM"
+    for i, key in enumerate(keys):
+        assert kd_hub.get_stats(key) == {
+            key: XQEMUKDHubStats(
+                bytes_received=len(f"vm {i}\n"),
+                num_reads=1,
+                lines_received=1,
+                lines_dropped=0,
+                backlog_lines=1,
+            )
+        }
+    for kd_socket, xqemu_side in connections:
+        kd_socket.close()
+        xqemu_side.close()
+
+
+def test_connection_closed(kd_hub: XQEMUKDHub):
+    """Ensure that the ring buffer is closed when XQEMU goes away"""
+    kd_socket, xqemu_side = socket.socketpair()
+    ring_buffer = XQEMUKDRingBuffer()
+    key = kd_hub.register(kd_socket, ring_buffer, "vm")
+    xqemu_side.sendall(b"last words")
+    xqemu_side.close()
+
+    cursor = ring_buffer.get_cursor()
+    assert cursor.read_line(10).text == "last words"
+    assert cursor.read_line(10) is None
+    kd_hub.unregister(key)  # Must still be allowed
+    kd_socket.close()
+
+
+def test_unregister(kd_hub: XQEMUKDHub):
+    """Ensure that the hub stops reading once a socket is unregistered but
+    keeps its stats
+    """
+    kd_socket, xqemu_side = socket.socketpair()
+    ring_buffer = XQEMUKDRingBuffer()
+    key = kd_hub.register(kd_socket, ring_buffer, "vm")
+    kd_hub.unregister(key)
+    xqemu_side.sendall(b"ignored\n")
+
+    assert ring_buffer.is_closed()
+    assert kd_hub.get_stats()[key].bytes_received == 0
+    assert kd_socket.recv(100) == b"ignored\n", "hub left the data alone"
+    kd_socket.close()
+    xqemu_side.close()
+
+
+def test_closed_hub():
+    """Ensure that a closed hub can't be used"""
+    hub = XQEMUKDHub()
+    hub.close()
+    kd_socket, xqemu_side = socket.socketpair()
+    with pytest.raises(RuntimeError):
+        hub.register(kd_socket, XQEMUKDRingBuffer(), "vm")
+    kd_socket.close()
+    xqemu_side.close()
+
+
+def test_shared_hub():
+    """Ensure that everything that asks for the shared hub gets the same one"""
+    assert get_shared_kd_hub() is get_shared_kd_hub()
+
+
+def test_feed_error(kd_hub: XQEMUKDHub, mocker):
+    """Ensure that an instance of XQEMU whose output can't be stored (e.g. \
+        its KD log is on a full disk) doesn't stop the hub draining the others
+    """
+    connections = [socket.socketpair() for _ in range(2)]
+    ring_buffers = [XQEMUKDRingBuffer() for _ in range(2)]
+    mocker.patch.object(ring_buffers[0], "feed", side_effect=OSError("disk full"))
+    keys = [
+        kd_hub.register(kd_socket, ring_buffer, "vm")
+        for (kd_socket, _), ring_buffer in zip(connections, ring_buffers)
+    ]
+    for _, xqemu_side in connections:
+        xqemu_side.sendall(b"output\n")
+
+    assert ring_buffers[1].get_cursor().read_line(10).text == "output\n"
+    assert ring_buffers[0].get_cursor().read_line(10) is None, "closed"
+    for key in keys:
+        kd_hub.unregister(key)
+    for kd_socket, xqemu_side in connections:
+        kd_socket.close()
+        xqemu_side.close()
+
+
+def test_hub_thread_failed(kd_hub: XQEMUKDHub, mocker):
+    """Ensure that registering and unregistering don't hang if the hub \
+        thread has died
+    """
+    kd_socket, xqemu_side = socket.socketpair()
+    ring_buffer = XQEMUKDRingBuffer()
+    key = kd_hub.register(kd_socket, ring_buffer, "vm")
+    mocker.patch.object(kd_hub, "_drain", side_effect=ValueError("bug"))
+    xqemu_side.sendall(b"output\n")
+    kd_hub._thread.join(10)
+
+    other_socket, other_xqemu_side = socket.socketpair()
+    with pytest.raises(RuntimeError):
+        kd_hub.register(other_socket, XQEMUKDRingBuffer(), "vm")
+    kd_hub.unregister(key)
+    assert ring_buffer.is_closed()
+    for sock in (kd_socket, xqemu_side, other_socket, other_xqemu_side):
+        sock.close()
+
+
+def test_close_shared_hub():
+    """Ensure that the shared hub can be closed and is started again if it \
+        is needed again
+    """
+    hub = get_shared_kd_hub()
+    close_shared_kd_hub()
+    with socket.socket() as kd_socket, pytest.raises(RuntimeError):
+        hub.register(kd_socket, XQEMUKDRingBuffer(), "vm")
+    assert get_shared_kd_hub() is not hub
+    close_shared_kd_hub()
@@ -0,0 +1,66 @@
+"""Tests for :py:class:`~pyxboxtest.xqemu.XQEMUKDLog`"""
+import os
+import re
+
+import pytest
+
+from pyxboxtest.xqemu import XQEMUKDLog, XQEMUKDLogMatch
+
+
+def test_write(tmp_path):
+    """Ensure that everything written ends up in the file, in order"""
+    filename = str(tmp_path / "kd.log")
+    kd_log = XQEMUKDLog(filename)
+    kd_log.write(b"first\n")
+    kd_log.write(b"second\n")
+    kd_log.close()
+    with open(filename, "rb") as log_file:
+        assert log_file.read() == b"first\nsecond\n"
+
+
+@pytest.mark.parametrize("num_backups", (0, 1, 3))
+def test_rotation(tmp_path, num_backups: int):
+    """Ensure that the log is rotated when it gets too big and that only the
+    newest backups are kept
+    """
+    filename = str(tmp_path / "kd.log")
+    kd_log = XQEMUKDLog(filename, max_bytes=10, num_backups=num_backups)
+    for i in range(5):
+        kd_log.write(b"line %d...\n" % i)  # Each line is 11 bytes
+    kd_log.close()
+
+    filenames = kd_log.get_filenames()
+    assert filenames[-1] == filename
+    assert len(filenames) == min(num_backups, 4) + 1
+    contents = []
+    for log_filename in filenames:
+        with open(log_filename, "rb") as log_file:
+            contents.append(log_file.read())
+    assert contents == [
+        b"line %d...\n" % i for i in range(4 - len(filenames) + 1, 5)
+    ], "oldest first"
+    assert not os.path.exists(f"{filename}.{num_backups + 1}")
+
+
+def test_search(tmp_path):
+    """Ensure that matches are found in every log file, with their lines"""
+    filename = str(tmp_path / "kd.log")
+    kd_log = XQEMUKDLog(filename, max_bytes=20)
+    kd_log.write(b"boot\nerror: 1\n")
+    kd_log.write(b"ok\nerror: 2")
+
+    assert list(kd_log.search(re.compile(rb"error: (\d)"))) == [
+        XQEMUKDLogMatch(f"{filename}.1", 5, b"error: 1", b"error: 1"),
+        XQEMUKDLogMatch(filename, 3, b"error: 2", b"error: 2"),
+    ]
+    assert [match.line for match in kd_log.search("ot")] == [b"boot"]
+    assert len(list(kd_log.search(b"error", max_matches=1))) == 1
+    kd_log.close()
+    assert len(list(kd_log.search(b"error"))) == 2, "can search once closed"
+
+
+def test_search_empty_log(tmp_path):
+    """Ensure that an empty log (which can't be memory mapped) is fine"""
+    kd_log = XQEMUKDLog(str(tmp_path / "kd.log"))
+    assert list(kd_log.search(b"anything")) == []
+    kd_log.close()
@@ -0,0 +1,50 @@
+"""Tests for the decoding of structured KD records"""
+from typing import Any, NamedTuple, Optional, Sequence
+
+import pytest
+
+from pyxboxtest.xqemu import XQEMUKDInvalidRecordError
+from pyxboxtest.xqemu.xqemu_kd_records import _JSONRecordFilter
+
+
+class DecodeParams(NamedTuple):
+    keys: Optional[Sequence[str]]
+    line: str
+    expected: Any
+
+
+@pytest.mark.parametrize(
+    "keys, line, expected",
+    (
+        DecodeParams(None, '{"a": 1}\n', {"a": 1}),
+        DecodeParams(None, "[1, 2]\n", [1, 2]),
+        DecodeParams(None, "not json\n", None),
+        DecodeParams(None, "{not json\n", None),
+        DecodeParams(("a",), '{"a": 1, "b": 2}\n', {"a": 1, "b": 2}),
+        DecodeParams(("a", "c"), '{"a": 1, "b": 2}\n', None),
+        # The key is in the line but is not a key of the object
+        DecodeParams(("a",), '{"b": "a"}\n', None),
+        DecodeParams(("a",), '{"b": {"a": 1}}\n', None),
+        DecodeParams(("a",), "[1]\n", None),
+        # Non-ASCII keys may be written as they are or escaped
+        DecodeParams(("größe",), '{"größe": 1}\n', {"größe": 1}),
+        DecodeParams(("größe",), '{"gr\\u00f6\\u00dfe": 1}\n', {"größe": 1}),
+    ),
+)
+def test_decode(keys: Optional[Sequence[str]], line: str, expected: Any):
+    """Ensure that only the right records are returned"""
+    assert _JSONRecordFilter(keys, skip_invalid=True).decode(line) == expected
+
+
+def test_filtered_lines_not_decoded(mocker):
+    """Ensure that lines that can't contain the keys are never decoded"""
+    record_filter = _JSONRecordFilter(("Buttons",), skip_invalid=True)
+    decode = mocker.spy(record_filter._decoder, "decode")
+    assert record_filter.decode('{"Axis": {"x": 1}}\n') is None
+    decode.assert_not_called()
+
+
+def test_invalid_record():
+    """Ensure that invalid records can be reported rather than skipped"""
+    with pytest.raises(XQEMUKDInvalidRecordError):
+        _JSONRecordFilter(None, skip_invalid=False).decode('{"a": \n')
@@ -0,0 +1,126 @@
+"""Tests for :py:class:`~pyxboxtest.xqemu.XQEMUKDRingBuffer` and its cursors"""
+import threading
+from typing import NamedTuple, Tuple
+
+import pytest
+
+from pyxboxtest.xqemu import XQEMUKDLine, XQEMUKDRingBuffer
+
+
+@pytest.mark.parametrize(
+    "chunks, expected_lines",
+    (
+        ((b"one\ntwo\n",), ("one\n", "two\n")),
+        ((b"o", b"ne\ntw", b"o\n"), ("one\n", "two\n")),
+        ((b"\n\n",), ("\n", "\n")),
+        ((b"no line ending",), tuple()),
+    ),
+)
+def test_lines_split(chunks: Tuple[bytes, ...], expected_lines: Tuple[str, ...]):
+    """Ensure that only whole lines are stored, however the data arrives"""
+    ring_buffer = XQEMUKDRingBuffer()
+    for chunk in chunks:
+        ring_buffer.feed(chunk)
+    lines = ring_buffer.get_cursor().read_available()
+    assert tuple(line.text for line in lines) == expected_lines
+    assert [line.index for line in lines] == list(range(len(expected_lines)))
+
+
+def test_timestamps():
+    """Ensure that each line is stamped with the time its end arrived"""
+    ring_buffer = XQEMUKDRingBuffer()
+    ring_buffer.feed(b"first\nsec", 1.0)
+    ring_buffer.feed(b"ond\n", 2.0)
+    assert ring_buffer.get_cursor().read_available() == [
+        XQEMUKDLine(0, 1.0, "first\n"),
+        XQEMUKDLine(1, 2.0, "second\n"),
+    ]
+
+
+def test_multi_byte_character_split_across_chunks():
+    """Ensure that characters are not corrupted when split across chunks"""
+    ring_buffer = XQEMUKDRingBuffer(encoding="utf-8")
+    encoded = "caf\u00e9\n".encode("utf-8")
+    ring_buffer.feed(encoded[:-2])
+    ring_buffer.feed(encoded[-2:])
+    assert ring_buffer.get_cursor().read_line(0).text == "caf\u00e9\n"
+
+
+def test_invalid_bytes_escaped():
+    """Ensure that bad output can't break background capture"""
+    ring_buffer = XQEMUKDRingBuffer()
+    ring_buffer.feed(b"\xff\n")
+    assert ring_buffer.get_cursor().read_line(0).text == "\\xff\n"
+
+
+class MemoryCapParams(NamedTuple):
+    max_chars: int
+    num_lines_fed: int
+    expected_first_kept_index: int
+
+
+@pytest.mark.parametrize(
+    "max_chars, num_lines_fed, expected_first_kept_index",
+    (
+        MemoryCapParams(100, 10, 0),
+        MemoryCapParams(10, 10, 8),
+        MemoryCapParams(1, 10, 9),  # Newest line is always kept
+    ),
+)
+def test_memory_cap(max_chars: int, num_lines_fed: int, expected_first_kept_index: int):
+    """Ensure that the oldest lines are dropped once the cap is reached and
+    that cursors that fell behind know how many lines they missed
+    """
+    ring_buffer = XQEMUKDRingBuffer(max_chars)
+    cursor = ring_buffer.get_cursor()
+    for i in range(num_lines_fed):
+        ring_buffer.feed(b"%04d\n" % i)
+
+    lines = cursor.read_available()
+    assert lines[0].index == expected_first_kept_index
+    assert cursor.num_missed == expected_first_kept_index
+    assert ring_buffer.get_num_dropped() == expected_first_kept_index
+    assert lines[-1].index == num_lines_fed - 1
+
+
+def test_cursors_are_independent():
+    """Ensure that reading with one cursor does not affect another"""
+    ring_buffer = XQEMUKDRingBuffer()
+    first_cursor = ring_buffer.get_cursor()
+    ring_buffer.feed(b"old\n")
+    new_lines_cursor = ring_buffer.get_cursor(from_oldest=False)
+    ring_buffer.feed(b"new\n")
+
+    assert [line.text for line in first_cursor.read_available()] == ["old\n", "new\n"]
+    assert [line.text for line in new_lines_cursor.read_available()] == ["new\n"]
+    assert first_cursor.read_available() == [], "already read"
+
+
+def test_read_line_timeout():
+    """Ensure that waiting for a line that never comes does not block"""
+    ring_buffer = XQEMUKDRingBuffer()
+    assert ring_buffer.get_cursor().read_line(0.01) is None
+
+
+def test_read_line_wakes_up():
+    """Ensure that a cursor waiting for a line gets it when it arrives from
+    another thread
+    """
+    ring_buffer = XQEMUKDRingBuffer()
+    cursor = ring_buffer.get_cursor()
+    feeder = threading.Timer(0.05, ring_buffer.feed, (b"late\n",))
+    feeder.start()
+    assert cursor.read_line(10).text == "late\n"
+    feeder.join()
+
+
+def test_close():
+    """Ensure that an incomplete last line is kept and that waiting cursors
+    stop waiting once there will be no more output
+    """
+    ring_buffer = XQEMUKDRingBuffer()
+    cursor = ring_buffer.get_cursor()
+    ring_buffer.feed(b"unfinished")
+    ring_buffer.close()
+    assert cursor.read_line().text == "unfinished"
+    assert cursor.read_line() is None, "did not block"
@@ -0,0 +1,169 @@
+"""Tests for the telemetry that apps send over KD"""
+import json
+import random
+from typing import NamedTuple, Sequence
+
+import pytest
+
+from pyxboxtest.xqemu import (
+    XQEMUKDTelemetry,
+    XQEMUKDTelemetryAssertionError,
+    XQEMUKDTelemetryMarker,
+)
+from pyxboxtest.xqemu.xqemu_kd_telemetry import _KDTelemetryFilter
+
+
+class FilterParams(NamedTuple):
+    chunks: Sequence[str]
+    expected_output: str
+    expected_counters: dict
+
+
+@pytest.mark.parametrize(
+    "params",
+    (
+        FilterParams(("hello\n",), "hello\n", {}),
+        FilterParams(("#TLM c draws\n",), "", {"draws": 1}),
+        FilterParams(("a\n#TLM c draws 3\nb\n",), "a\nb\n", {"draws": 3}),
+        # Only recognised at the start of a line
+        FilterParams(("a #TLM c draws\n",), "a #TLM c draws\n", {}),
+        FilterParams(("a", "#TLM c draws\n"), "a#TLM c draws\n", {}),
+        # Split across chunks at every awkward point
+        FilterParams(("a\n#", "TLM c dr", "aws\nb"), "a\nb", {"draws": 1}),
+        FilterParams(("a\n", "#TLM ", "c draws\r\n"), "a\n", {"draws": 1}),
+        FilterParams(("#T", "x\n"), "#Tx\n", {}),
+        # Invalid telemetry is left in the output
+        FilterParams(("#TLM c\n#TLM x y\n",), "#TLM c\n#TLM x y\n", {}),
+        FilterParams(("#TLM c draws lots\n",), "#TLM c draws lots\n", {}),
+    ),
+)
+def test_filter(params: FilterParams):
+    """Ensure that telemetry lines are removed, however the output is split"""
+    telemetry = XQEMUKDTelemetry()
+    telemetry_filter = _KDTelemetryFilter(telemetry)
+    output = "".join(telemetry_filter.feed(chunk, 0.0) for chunk in params.chunks)
+    output += telemetry_filter.flush(0.0)
+    assert output == params.expected_output
+    assert telemetry.get_counters() == params.expected_counters
+
+
+def test_filter_random_chunks():
+    """Compare against filtering whole lines"""
+    rng = random.Random(15)
+    lines = [
+        rng.choice(("frame\n", "#TLM t frame 16.5\n", "#TLM\n", "# TLM\n", "x#TLM\n"))
+        for _ in range(500)
+    ]
+    text = "".join(lines)
+    expected = "".join(line for line in lines if not line.startswith("#TLM "))
+    for _ in range(20):
+        telemetry = XQEMUKDTelemetry()
+        telemetry_filter = _KDTelemetryFilter(telemetry)
+        output = []
+        position = 0
+        while position < len(text):
+            chunk_size = rng.randint(1, 30)
+            output.append(telemetry_filter.feed(text[position : position + chunk_size], 0))
+            position += chunk_size
+        output.append(telemetry_filter.flush(0))
+        assert "".join(output) == expected
+        assert len(telemetry.get_timer_samples("frame")) == len(lines) - len(
+            expected.splitlines()
+        )
+
+
+def test_incomplete_telemetry_at_end():
+    """A telemetry line without a line ending still counts at the end"""
+    telemetry = XQEMUKDTelemetry()
+    telemetry_filter = _KDTelemetryFilter(telemetry)
+    assert telemetry_filter.feed("x\n#TLM m loaded 12", 5.0) == "x\n"
+    assert telemetry_filter.flush(6.0) == ""
+    assert telemetry.get_markers() == [XQEMUKDTelemetryMarker("loaded", 6.0, 12.0)]
+
+
+class StatParams(NamedTuple):
+    stat: str
+    expected: float
+
+
+@pytest.mark.parametrize(
+    "params",
+    (
+        StatParams("count", 10),
+        StatParams("sum", 55),
+        StatParams("min", 1),
+        StatParams("max", 10),
+        StatParams("mean", 5.5),
+        StatParams("p0", 1),
+        StatParams("p50", 5),
+        StatParams("p95", 10),
+        StatParams("p90", 9),
+        StatParams("p99.9", 10),
+        StatParams("p100", 10),
+    ),
+)
+def test_get_stat(params: StatParams):
+    """Percentiles use the nearest rank"""
+    telemetry = XQEMUKDTelemetry()
+    for sample in (3, 1, 4, 10, 5, 9, 2, 6, 8, 7):
+        telemetry.add_timer_sample("frame", sample)
+    assert telemetry.get_stat("frame", params.stat) == params.expected
+
+
+@pytest.mark.parametrize("stat", ("p101", "median", "p-1"))
+def test_unknown_stat(stat: str):
+    telemetry = XQEMUKDTelemetry()
+    telemetry.add_timer_sample("frame", 1)
+    with pytest.raises(ValueError):
+        telemetry.get_stat("frame", stat)
+
+
+def test_stats_updated_after_more_samples():
+    """Ensure that sorted samples aren't reused once they are out of date"""
+    telemetry = XQEMUKDTelemetry()
+    telemetry.add_timer_sample("frame", 10)
+    assert telemetry.get_stat("frame", "max") == 10
+    telemetry.add_timer_sample("frame", 50)
+    assert telemetry.get_stat("frame", "max") == 50
+    assert telemetry.get_timer_samples("frame") == (10, 50)
+
+
+def test_assert_stat():
+    """Test the assertion API, e.g. p95 frame time < 33 ms"""
+    telemetry = XQEMUKDTelemetry()
+    for _ in range(95):
+        telemetry.add_timer_sample("frame", 16.7)
+    for _ in range(5):
+        telemetry.add_timer_sample("frame", 50)
+    assert telemetry.assert_stat("frame", "p95", less_than=33) == 16.7
+    with pytest.raises(XQEMUKDTelemetryAssertionError, match="p96 of frame is 50"):
+        telemetry.assert_stat("frame", "p96", less_than=33)
+    with pytest.raises(XQEMUKDTelemetryAssertionError):
+        telemetry.assert_stat("frame", "mean", greater_than=20)
+    with pytest.raises(XQEMUKDTelemetryAssertionError, match="No samples"):
+        telemetry.assert_stat("load", "max", less_than=1000)
+
+
+def test_histogram():
+    telemetry = XQEMUKDTelemetry()
+    for sample in (0.5, 1, 1.5, 5, 100):
+        telemetry.add_timer_sample("frame", sample)
+    assert telemetry.get_histogram("frame", (1, 2, 10)) == [1, 2, 1, 1]
+
+
+def test_report(tmp_path):
+    """Ensure that the report can be saved as JSON and contains everything"""
+    telemetry = XQEMUKDTelemetry()
+    telemetry.add_to_counter("draws", 2)
+    telemetry.add_timer_sample("frame", 16.7)
+    telemetry.add_marker(XQEMUKDTelemetryMarker("loaded", 1.5, None))
+    telemetry.write_report(str(tmp_path / "report.json"))
+    with open(tmp_path / "report.json") as report_file:
+        report = json.load(report_file)
+    assert report["counters"] == {"draws": 2}
+    assert report["timers"]["frame"]["p95"] == 16.7
+    assert sum(report["timers"]["frame"]["histogram"]["counts"]) == 1
+    assert report["markers"] == [{"name": "loaded", "timestamp": 1.5, "value": None}]
+
+    telemetry.reset()
+    assert telemetry.is_empty()
@@ -0,0 +1,102 @@
+"""Tests for :py:class:`~pyxboxtest.xqemu.XQEMUReadinessMonitor`"""
+import subprocess
+
+from mock import Mock
+import pytest
+
+from pyxboxtest.xqemu import (
+    XQEMUExitedError,
+    XQEMUKDRecordTimeoutError,
+    XQEMUReadinessMonitor,
+    XQEMUReadinessTimeoutError,
+)
+
+
+@pytest.fixture
+def running_process() -> Mock:
+    """A mock XQEMU process that never exits"""
+    process = Mock()
+    process.poll.return_value = None
+    process.wait.side_effect = subprocess.TimeoutExpired("xqemu", 0)
+    return process
+
+
+@pytest.mark.parametrize("num_failures", (0, 1, 5))
+def test_retries_until_ready(running_process: Mock, num_failures: int):
+    """Ensure that connecting is retried until it succeeds and that the time
+    to ready is recorded
+    """
+    try_connect = Mock(
+        side_effect=[ConnectionRefusedError() for _ in range(num_failures)]
+        + ["connected"]
+    )
+    readiness = XQEMUReadinessMonitor(running_process)
+    assert readiness.wait_until_ready("kd", try_connect) == "connected"
+    assert try_connect.call_count == num_failures + 1
+    assert tuple(readiness.get_times_to_ready()) == ("kd",), "time recorded"
+
+
+def test_other_exceptions_not_retried(running_process: Mock):
+    """Ensure that exceptions that don't mean "not ready yet" are not
+    swallowed
+    """
+    try_connect = Mock(side_effect=ValueError("a real problem"))
+    readiness = XQEMUReadinessMonitor(running_process)
+    with pytest.raises(ValueError):
+        readiness.wait_until_ready("kd", try_connect)
+    try_connect.assert_called_once_with()
+
+
+def test_fails_fast_if_xqemu_exits():
+    """Ensure that we stop waiting as soon as XQEMU has exited"""
+    process = Mock()
+    process.poll.side_effect = [None, 1]
+    process.returncode = 1
+    try_connect = Mock(side_effect=ConnectionRefusedError())
+
+    readiness = XQEMUReadinessMonitor(process, timeout=1000)
+    with pytest.raises(XQEMUExitedError):
+        readiness.wait_until_ready("qmp", try_connect)
+    try_connect.assert_called_once_with()
+    assert readiness.get_times_to_ready() == {}, "channel never became ready"
+
+
+def test_timeout(mocker):
+    """Ensure that we give up once the timeout has passed"""
+    mocker.patch("time.sleep")
+    try_connect = Mock(side_effect=ConnectionRefusedError())
+    readiness = XQEMUReadinessMonitor(timeout=0)
+    with pytest.raises(XQEMUReadinessTimeoutError):
+        readiness.wait_until_ready("ftp", try_connect)
+
+
+@pytest.mark.parametrize(
+    "lines,num_lines_read",
+    ((("ready\n",), 1), (("booting\n", "still booting\n", "app ready!\n"), 3)),
+)
+def test_wait_for_kd_marker(running_process: Mock, lines, num_lines_read: int):
+    """Ensure that KD lines are read until the marker is found"""
+    get_line = Mock(side_effect=lines + ("unused\n",))
+    readiness = XQEMUReadinessMonitor(running_process)
+    readiness.wait_for_kd_marker(get_line, "ready")
+    assert get_line.call_count == num_lines_read
+    assert "kd_marker" in readiness.get_times_to_ready()
+    assert all(
+        0 < call.args[0] <= 15 for call in get_line.call_args_list
+    ), "each line waited for until the deadline at most"
+
+
+@pytest.mark.parametrize(
+    "timeout,get_line_error", ((15, XQEMUKDRecordTimeoutError()), (0, None))
+)
+def test_kd_marker_timeout(
+    running_process: Mock, timeout: float, get_line_error: Exception
+):
+    """Ensure that we give up on a marker that the app never outputs, whether \
+        no more lines arrive or the lines that do never contain it
+    """
+    get_line = Mock(side_effect=get_line_error, return_value="not it\n")
+    readiness = XQEMUReadinessMonitor(running_process, timeout=timeout)
+    with pytest.raises(XQEMUReadinessTimeoutError, match="'ready'"):
+        readiness.wait_for_kd_marker(get_line, "ready")
+    assert "kd_marker" not in readiness.get_times_to_ready()
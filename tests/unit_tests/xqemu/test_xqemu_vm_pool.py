@@ -0,0 +1,158 @@
+"""Tests for :py:class:`~pyxboxtest.xqemu.XQEMUVMPool`"""
+import pytest
+
+from pyxboxtest.xqemu import (
+    XQEMUChannelTransport,
+    XQEMURAMSize,
+    XQEMUVMPool,
+    XQEMUVMPoolStats,
+    XQEMUXboxAppRunner,
+)
+from pyxboxtest.xqemu.xqemu_xbox_app_runner import _XQEMUXboxAppRunnerGlobalParams
+
+
+@pytest.fixture(autouse=True)
+def mocked_pooled_app_runner(mocker):
+    """We don't want to really start XQEMU so we mock the app runner used by
+    the pool. Every instance created is a new mock.
+    """
+    XQEMUXboxAppRunner._global_params = _XQEMUXboxAppRunnerGlobalParams(
+        mocker.Mock(), False
+    )
+
+    def create_app(*_, **__):
+        app = mocker.Mock()
+        app.__enter__ = mocker.Mock(return_value=app)
+        app.__exit__ = mocker.Mock()
+        app.is_running.return_value = True
+        return app
+
+    return mocker.patch(
+        "pyxboxtest.xqemu.xqemu_vm_pool._XQEMUPooledAppRunner", side_effect=create_app
+    )
+
+
+def test_first_lease_is_a_miss(mocked_pooled_app_runner):
+    """Ensure that an instance is started when the pool is empty"""
+    pool = XQEMUVMPool()
+    with pool.lease("test.iso") as app:
+        app.__enter__.assert_called_once()
+    mocked_pooled_app_runner.assert_called_once_with(
+        "test.iso", XQEMURAMSize.RAM64m, False, XQEMUChannelTransport.TCP_PORT
+    )
+    assert pool.get_stats() == XQEMUVMPoolStats(0, 1)
+
+
+def test_released_instance_is_reused():
+    """Ensure that an instance that has been returned is reset and given to
+    the next lease with the new DVD in the drive
+    """
+    pool = XQEMUVMPool()
+    with pool.lease("first.iso") as first_app:
+        first_app.start_lease.assert_not_called()
+    first_app.finish_lease.assert_called_once_with(None)
+    first_app.eject_dvd.assert_called_once_with()
+    first_app.__exit__.assert_not_called()
+
+    with pool.lease("second.iso") as second_app:
+        assert second_app is first_app, "same instance was reused"
+        second_app.start_lease.assert_called_once_with()
+        second_app.insert_dvd.assert_called_once_with("second.iso")
+        second_app.reset_xbox.assert_called_once_with()
+    assert pool.get_stats() == XQEMUVMPoolStats(1, 1)
+
+
+@pytest.mark.parametrize(
+    "first_params,second_params",
+    (
+        ((XQEMURAMSize.RAM64m, False), (XQEMURAMSize.RAM128m, False)),
+        ((XQEMURAMSize.RAM64m, False), (XQEMURAMSize.RAM64m, True)),
+        (
+            (XQEMURAMSize.RAM64m, False, XQEMUChannelTransport.TCP_PORT),
+            (XQEMURAMSize.RAM64m, False, XQEMUChannelTransport.UNIX_SOCKET),
+        ),
+    ),
+)
+def test_instances_not_shared_between_keys(first_params, second_params):
+    """Ensure that instances are only reused if they were started in the same
+    way
+    """
+    pool = XQEMUVMPool()
+    with pool.lease(None, *first_params) as first_app:
+        pass
+    with pool.lease(None, *second_params) as second_app:
+        assert second_app is not first_app, "instance not shared"
+    assert pool.get_stats() == XQEMUVMPoolStats(0, 2)
+
+
+@pytest.mark.parametrize("instances_per_key", (0, 1, 3))
+def test_extra_instances_shut_down(instances_per_key: int):
+    """Ensure that no more than instances_per_key instances are kept idle"""
+    pool = XQEMUVMPool(instances_per_key)
+    with pool.lease() as first_app, pool.lease() as second_app, pool.lease() as third_app:
+        pass
+    apps = (first_app, second_app, third_app)
+    num_shut_down = sum(app.__exit__.call_count for app in apps)
+    assert num_shut_down == 3 - min(instances_per_key, 3)
+
+
+def test_failed_lease_saves_recording():
+    """Ensure that the test's state is saved knowing that it failed, and that \
+        the next lease gets state of its own
+    """
+    pool = XQEMUVMPool()
+    with pytest.raises(RuntimeError):
+        with pool.lease() as first_app:
+            raise RuntimeError("test failed")
+    first_app.finish_lease.assert_called_once_with(RuntimeError)
+    first_app.__exit__.assert_not_called()
+
+
+def test_binary_is_part_of_key(mocker):
+    """Ensure that instances of different XQEMU binaries aren't shared"""
+    pool = XQEMUVMPool()
+    with pool.lease() as first_app:
+        pass
+    XQEMUXboxAppRunner._global_params = _XQEMUXboxAppRunnerGlobalParams(
+        mocker.Mock(), False, "other-xqemu"
+    )
+    with pool.lease() as second_app:
+        assert second_app is not first_app, "instance not shared"
+
+
+def test_exited_instance_not_reused():
+    """Ensure that an instance of XQEMU that has died is not given out"""
+    pool = XQEMUVMPool()
+    with pool.lease() as first_app:
+        first_app.is_running.return_value = False
+    first_app.__exit__.assert_called_once()
+
+    with pool.lease() as second_app:
+        assert second_app is not first_app, "dead instance not reused"
+
+
+@pytest.mark.parametrize("instances_per_key", (1, 2, 4))
+def test_prewarm(mocked_pooled_app_runner, instances_per_key: int):
+    """Ensure that prewarming boots enough instances for leases to be hits"""
+    pool = XQEMUVMPool(instances_per_key)
+    pool.prewarm()
+    assert mocked_pooled_app_runner.call_count == instances_per_key
+    with pool.lease():
+        pass
+    assert pool.get_stats() == XQEMUVMPoolStats(1, 0)
+
+
+def test_close_shuts_down_idle_instances():
+    """Ensure that closing the pool stops XQEMU"""
+    pool = XQEMUVMPool(2)
+    with pool.lease() as first_app, pool.lease() as second_app:
+        pass
+    pool.close()
+    first_app.__exit__.assert_called_once()
+    second_app.__exit__.assert_called_once()
+
+
+def test_negative_instances_per_key():
+    """Ensure that a pool can't be created with a negative size"""
+    with pytest.raises(ValueError):
+        XQEMUVMPool(-1)
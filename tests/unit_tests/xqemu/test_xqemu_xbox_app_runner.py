@@ -1,16 +1,36 @@
 """Tests for :py:class:`~pyxboxtest.xqemu.XQEMUXboxAppRunner`"""
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
 import os
 import random
+import threading
+import time
 from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple
 
+from mock import ANY, call
+import numpy as np
 import pytest
 
 from pyxboxtest.xqemu import (
+    XQEMUChannelTransport,
+    XQEMUInputTimeline,
+    XQEMUKDRecordTimeoutError,
+    XQEMUKDTelemetry,
     XQEMURAMSize,
+    XQEMUReadinessTimeoutError,
     XQEMUXboxAppRunner,
     XQEMUXboxControllerButtons,
 )
-from pyxboxtest.xqemu.xqemu_xbox_app_runner import _XQEMUXboxAppRunnerGlobalParams
+from pyxboxtest.xqemu.screen import load_png
+from pyxboxtest.xqemu.screen.xqemu_frame_recorder import _get_encoder
+from pyxboxtest.xqemu.xqemu_xbox_app_runner import (
+    _XQEMUXboxAppRunnerGlobalParams,
+    _get_frame_path,
+    _get_recording_path,
+    _load_frame,
+    _save_recordings,
+    _take_new_screenshots,
+)
 from pyxboxtest.xqemu._xqemu_temporary_directories import get_temp_dirs
 
 _XQEMU_DEFAULT_BINARY = "xqemu"
@@ -46,7 +66,9 @@ def mocked_qemu_monitor(mocker):
     """mock :py:class:`~qmp.QEMUMonitorProtocol` so that we can check it is
     used correctly
     """
-    return mocker.patch("pyxboxtest.xqemu.xqemu_xbox_app_runner.QEMUMonitorProtocol")
+    return mocker.patch(
+        "pyxboxtest.xqemu.xqemu_xbox_app_runner._ThreadSafeQEMUMonitorProtocol"
+    )
 
 
 def get_common_params(
@@ -342,7 +364,114 @@ def test_kd_capturer(
     kd_capturer_port = get_kd_capturer_port_from_xqemu_params(
         default_xqemu_xbox_app_runner.xqemu_params_for_test
     )
-    mocked_kd_capturer.assert_called_once_with(kd_capturer_port)
+    mocked_kd_capturer.assert_called_once_with(
+        kd_capturer_port, ANY, capture_in_background=False, hub=None, log=ANY
+    )
+
+
+def test_kd_log(
+    default_xqemu_xbox_app_runner: AppRunnerWithParams, mocked_kd_capturer
+):
+    """Ensures that KD output is logged to a file named after the test"""
+    kd_log = default_xqemu_xbox_app_runner.get_kd_log()
+    assert mocked_kd_capturer.call_args.kwargs["log"] is kd_log
+    assert os.path.dirname(kd_log.get_filename()) == str(get_temp_dirs().kd_logs_dir)
+    assert os.path.basename(kd_log.get_filename()).endswith("-test_kd_log.log")
+
+
+def test_telemetry_report(
+    mocked_unused_port, mocked_xqemu_firmware, mocked_subprocess_popen, mocked_kd_capturer
+):
+    """Ensures that a report of the app's telemetry is saved next to the KD log"""
+    # pylint: disable=unused-argument
+    mocked_xqemu_firmware.get_command_line_args.return_value = tuple()
+    XQEMUXboxAppRunner._global_params = _XQEMUXboxAppRunnerGlobalParams(
+        mocked_xqemu_firmware, True
+    )
+    telemetry = XQEMUKDTelemetry()
+    telemetry.add_timer_sample("frame", 16.7)
+    mocked_kd_capturer.return_value.get_telemetry.return_value = telemetry
+
+    with XQEMUXboxAppRunner() as app_runner:
+        kd_log_filename = app_runner.get_kd_log().get_filename()
+
+    report_filename = kd_log_filename[: -len(".log")] + ".telemetry.json"
+    with open(report_filename) as report_file:
+        assert '"frame"' in report_file.read()
+
+
+@pytest.mark.parametrize("kd_ready_marker", (None, "ready"))
+def test_failed_enter_stops_xqemu(
+    mocked_unused_port,
+    mocked_xqemu_firmware,
+    mocked_subprocess_popen,
+    mocked_kd_capturer,
+    kd_ready_marker: Optional[str],
+):
+    """Ensures that XQEMU isn't left running, nor its ports leased, if it \
+        never becomes ready
+    """
+    mocked_xqemu_firmware.get_command_line_args.return_value = tuple()
+    XQEMUXboxAppRunner._global_params = _XQEMUXboxAppRunnerGlobalParams(
+        mocked_xqemu_firmware, True
+    )
+    if kd_ready_marker is None:
+        mocked_kd_capturer.side_effect = ConnectionRefusedError()
+    else:
+        # The marker never arrives
+        mocked_kd_capturer.return_value.get_line.side_effect = (
+            XQEMUKDRecordTimeoutError()
+        )
+
+    app_runner = XQEMUXboxAppRunner(kd_ready_marker=kd_ready_marker)
+    with pytest.raises((ConnectionRefusedError, XQEMUReadinessTimeoutError)):
+        with app_runner:
+            pass
+    mocked_subprocess_popen.return_value.terminate.assert_called_once_with()
+    mocked_subprocess_popen.return_value.wait.assert_called_once_with()
+    assert mocked_unused_port.return_value.release.called, "ports released"
+    if kd_ready_marker is not None:
+        mocked_kd_capturer.return_value.close.assert_called_once_with()
+        assert app_runner.get_kd_log()._file.closed
+
+
+def test_start_next_test(
+    mocked_unused_port,
+    mocked_xqemu_firmware,
+    mocked_subprocess_popen,
+    mocked_kd_capturer,
+    mocker,
+):
+    """Ensures that the next test to use a running instance (e.g. from the VM \
+        pool) has a KD log, telemetry and recording of its own
+    """
+    # pylint: disable=unused-argument,protected-access
+    mocked_xqemu_firmware.get_command_line_args.return_value = tuple()
+    XQEMUXboxAppRunner._global_params = _XQEMUXboxAppRunnerGlobalParams(
+        mocked_xqemu_firmware, True
+    )
+    telemetry = XQEMUKDTelemetry()
+    mocked_kd_capturer.return_value.get_telemetry.return_value = telemetry
+    # Only the frame added below is recorded
+    mocker.patch.object(XQEMUXboxAppRunner, "grab_frame", side_effect=RuntimeError)
+
+    with XQEMUXboxAppRunner(record_fps=1) as app_runner:
+        kd_log = app_runner.get_kd_log()
+        first_filename = kd_log.get_filename()
+        kd_log.write(b"first test\n")
+        telemetry.add_to_counter("draws")
+        recorder = app_runner.get_frame_recorder()
+        recorder._frames.append([None, b"", 0, 0])
+
+        app_runner._start_next_test()
+        assert kd_log.get_filename() != first_filename
+        assert not list(kd_log.search("first test")), "not in the next test's log"
+        assert telemetry.is_empty()
+        assert not recorder.get_frames()
+        assert recorder.is_recording()
+
+    with open(first_filename[: -len(".log")] + ".telemetry.json") as report_file:
+        assert '"draws"' in report_file.read(), "first test's telemetry saved"
 
 
 class PressControllerButtonsParams(NamedTuple):
@@ -465,6 +594,7 @@ def test_save_screenshot_filename_contains_path(
     ),
 )
 def test_save_screenshot_correct_paths(
+    mocker,
     default_xqemu_xbox_app_runner: AppRunnerWithParams,
     screenshot_filenames: Tuple[str],
     first_screenshot_number: int,
@@ -472,6 +602,11 @@ def test_save_screenshot_correct_paths(
     """Ensure that a screenshot is stored in the temporary directory and that
     each one is numbered to make sure that they are unique
     """
+    wanted = threading.Event()
+    wanted.set()
+    mocker.patch(
+        "pyxboxtest.xqemu.xqemu_xbox_app_runner._new_screenshots_wanted", wanted
+    )
     qemu_monitor = default_xqemu_xbox_app_runner.get_qemu_monitor()
     for screenshot_number, screenshot_filename in enumerate(
         screenshot_filenames, first_screenshot_number
@@ -482,3 +617,329 @@ def test_save_screenshot_correct_paths(
             str(screenshot_number) + "-" + screenshot_filename,
         )
         qemu_monitor.command.assert_called_with("screendump", filename=screenshot_path)
+        assert _take_new_screenshots() == [screenshot_path], "to be compressed"
+    assert not _take_new_screenshots()
+
+
+@pytest.mark.usefixtures("mocked_qemu_monitor")
+def test_save_screenshot_not_kept_unless_wanted(
+    mocker, default_xqemu_xbox_app_runner: AppRunnerWithParams
+):
+    """Without anything to take them (e.g. with raw screenshots kept) the \
+        paths of screenshots mustn't pile up
+    """
+    mocker.patch(
+        "pyxboxtest.xqemu.xqemu_xbox_app_runner._new_screenshots_wanted",
+        threading.Event(),
+    )
+    mocker.patch(
+        "pyxboxtest.xqemu.xqemu_xbox_app_runner._screenshot_nums", count(1)
+    )
+    default_xqemu_xbox_app_runner.save_screenshot("screenshot.ppm")
+    assert not _take_new_screenshots()
+
+
+@pytest.mark.usefixtures("mocked_qemu_monitor")
+def test_grab_frame(default_xqemu_xbox_app_runner: AppRunnerWithParams):
+    """Ensure that the frame is read from the frames dir and then removed"""
+    saved_filenames = []
+
+    def screendump(_, filename: str) -> None:
+        saved_filenames.append(filename)
+        with open(filename, "wb") as frame_file:
+            frame_file.write(b"P6\n2 1\n255\n" + bytes(range(6)))
+
+    qemu_monitor = default_xqemu_xbox_app_runner.get_qemu_monitor()
+    qemu_monitor.command.side_effect = screendump
+    frame = default_xqemu_xbox_app_runner.grab_frame()
+    assert np.array_equal(frame, np.arange(6).reshape(1, 2, 3))
+    assert os.path.dirname(saved_filenames[0]) == get_temp_dirs().frames_dir
+    assert not os.path.exists(saved_filenames[0]), "no file left behind"
+
+
+@pytest.mark.usefixtures("mocked_qemu_monitor")
+def test_grab_frame_removal_retried(
+    default_xqemu_xbox_app_runner: AppRunnerWithParams, mocker
+):
+    """Ensure that a frame that can't be removed yet (e.g. it is mapped on \
+        Windows) doesn't fail the grab and is removed with the next frame
+    """
+    saved_filenames = []
+
+    def screendump(_, filename: str) -> None:
+        saved_filenames.append(filename)
+        with open(filename, "wb") as frame_file:
+            frame_file.write(b"P6\n1 1\n255\n" + bytes(3))
+
+    qemu_monitor = default_xqemu_xbox_app_runner.get_qemu_monitor()
+    qemu_monitor.command.side_effect = screendump
+    remove = mocker.patch("os.remove", side_effect=PermissionError)
+    default_xqemu_xbox_app_runner.grab_frame()
+    assert os.path.exists(saved_filenames[0])
+
+    remove.side_effect = os.unlink
+    default_xqemu_xbox_app_runner.grab_frame()
+    assert not any(os.path.exists(filename) for filename in saved_filenames)
+
+
+@pytest.mark.parametrize("get_path", (_get_frame_path, _get_recording_path))
+def test_unique_paths_across_threads(get_path):
+    """Ensure that frames grabbed (and recordings saved) from several threads \
+        at once never share a path
+    """
+    with ThreadPoolExecutor(8) as executor:
+        paths = list(executor.map(lambda _: get_path(), range(2000)))
+    assert len(set(paths)) == len(paths)
+
+
+def test_grab_frame_copied_without_posix(mocker, tmp_path):
+    """Ensure that frames aren't left mapped where mapped files can't be \
+        removed
+    """
+    frame_path = str(tmp_path / "frame.ppm")
+    with open(frame_path, "wb") as frame_file:
+        frame_file.write(b"P6\n1 1\n255\n" + bytes(range(3)))
+    mocker.patch("pyxboxtest.xqemu.xqemu_xbox_app_runner.os.name", "nt")
+    frame = _load_frame(frame_path)
+    assert frame.base is None, "not a view of the map"
+    assert not frame.flags.writeable
+    assert np.array_equal(frame, np.arange(3).reshape(1, 1, 3))
+
+
+def test_wait_for_screen_stable(
+    default_xqemu_xbox_app_runner: AppRunnerWithParams, mocker
+):
+    """Ensure that the runner's frames are watched"""
+    frame = np.zeros((2, 2, 3), dtype=np.uint8)
+    mocker.patch.object(
+        default_xqemu_xbox_app_runner, "grab_frame", return_value=frame
+    )
+    assert default_xqemu_xbox_app_runner.wait_for_screen_stable(0) is frame
+    assert default_xqemu_xbox_app_runner.wait_for_screen_change(
+        np.ones((2, 2, 3), dtype=np.uint8)
+    ) is frame
+
+
+@pytest.mark.usefixtures("mocked_qemu_monitor")
+def test_play_input_timeline(
+    default_xqemu_xbox_app_runner: AppRunnerWithParams, mocker
+):
+    """Ensure that each batch of input is sent to the runner's monitor, with \
+        the screen recording paused so that it doesn't delay them
+    """
+    recorder = mocker.Mock()
+    recorder.is_recording.return_value = True
+    mocker.patch.object(default_xqemu_xbox_app_runner, "_frame_recorder", recorder)
+    qemu_monitor = default_xqemu_xbox_app_runner.get_qemu_monitor()
+    recorder_states = []
+    qemu_monitor.command.side_effect = lambda *args, **kwargs: recorder_states.append(
+        (recorder.stop.called, recorder.start.called)
+    )
+    timeline = XQEMUInputTimeline().hold(
+        0, 0.001, XQEMUXboxControllerButtons.A, XQEMUXboxControllerButtons.B
+    )
+    report = default_xqemu_xbox_app_runner.play_input_timeline(timeline)
+    assert qemu_monitor.command.call_args_list == [
+        call("input-send-event", events=list(batch.events))
+        for batch in timeline.compile()
+    ]
+    assert (report.num_batches, report.num_events) == (2, 4)
+    assert recorder_states == [(True, False)] * 2, "paused whilst sending"
+    recorder.start.assert_called_once_with()
+
+
+def test_measure_frame_rate(
+    default_xqemu_xbox_app_runner: AppRunnerWithParams, mocker
+):
+    """Ensure that the runner's screen is watched"""
+    frames = (np.full((2, 2, 3), value % 256, dtype=np.uint8) for value in count())
+    mocker.patch.object(
+        default_xqemu_xbox_app_runner, "grab_frame", side_effect=lambda: next(frames)
+    )
+    measurement = default_xqemu_xbox_app_runner.measure_frame_rate(0.001)
+    assert measurement.num_samples >= 2
+    assert measurement.num_frames == measurement.num_samples - 1
+    assert measurement.is_sample_limited
+
+
+def test_find_on_screen(default_xqemu_xbox_app_runner: AppRunnerWithParams, mocker):
+    """Ensure that the template is searched for on the runner's screen"""
+    frame = np.zeros((20, 20, 3), dtype=np.uint8)
+    frame[5:10, 8:16] = np.arange(40, dtype=np.uint8).reshape(5, 8, 1)
+    mocker.patch.object(
+        default_xqemu_xbox_app_runner, "grab_frame", return_value=frame
+    )
+    matches = default_xqemu_xbox_app_runner.find_on_screen(frame[4:11, 7:17])
+    assert [match[:4] for match in matches] == [(7, 4, 10, 7)]
+    assert matches[0].score == pytest.approx(1)
+
+
+def test_read_text(default_xqemu_xbox_app_runner: AppRunnerWithParams, mocker):
+    """Ensure that the text is read from the runner's screen"""
+    frame = np.zeros((2, 2, 3), dtype=np.uint8)
+    mocker.patch.object(
+        default_xqemu_xbox_app_runner, "grab_frame", return_value=frame
+    )
+    reader = mocker.Mock()
+    reader.read_text.return_value = {"title": "Hello"}
+    assert default_xqemu_xbox_app_runner.read_text(reader, ("title",), 1) == {
+        "title": "Hello"
+    }
+    reader.read_text.assert_called_once_with(frame, ("title",), 1)
+
+
+def test_recording(
+    mocked_unused_port, mocked_xqemu_firmware, mocked_subprocess_popen, mocker
+):
+    """Ensure that the screen is recorded and the recording is saved if the \
+        test fails, either in the with block or elsewhere
+    """
+    # pylint: disable=unused-argument
+    mocked_xqemu_firmware.get_command_line_args.return_value = tuple()
+    XQEMUXboxAppRunner._global_params = _XQEMUXboxAppRunnerGlobalParams(
+        mocked_xqemu_firmware, True, record_fps=100
+    )
+    mocker.patch.object(
+        XQEMUXboxAppRunner,
+        "grab_frame",
+        return_value=np.zeros((2, 2, 3), dtype=np.uint8),
+    )
+    with XQEMUXboxAppRunner(record_fps=0) as app_runner:
+        assert app_runner.get_frame_recorder() is None
+        assert app_runner.save_recording() is None
+
+    with pytest.raises(RuntimeError):
+        with XQEMUXboxAppRunner(record_max_frames=5) as app_runner:
+            recorder = app_runner.get_frame_recorder()
+            while not recorder.get_num_samples():
+                time.sleep(0.01)
+            recording_paths = _save_recordings()
+            raise RuntimeError("Test failed")
+    assert not recorder.is_recording()
+    assert not _save_recordings(), "only saved whilst recording"
+
+    recordings_dir = get_temp_dirs().recordings_dir
+    assert len(recording_paths) == 1
+    assert os.path.dirname(recording_paths[0]) == str(recordings_dir)
+    assert recording_paths[0].endswith("-test_recording.png")
+    # Recordings are saved in order, so once this has run they all have
+    _get_encoder().submit(lambda: None).result(10)
+    assert len(os.listdir(recordings_dir)) == 2, "and saved when the block failed"
+    assert np.array_equal(
+        load_png(recording_paths[0]), np.zeros((2, 2, 3), dtype=np.uint8)
+    )
+
+
+@pytest.mark.usefixtures("mocked_qemu_monitor")
+@pytest.mark.parametrize("dvd_filename", ("test.iso", "/path/to/other.iso"))
+def test_insert_and_eject_dvd(
+    default_xqemu_xbox_app_runner: AppRunnerWithParams, dvd_filename: str
+):
+    """Ensure that the qemu monitor is used to change the disc in the DVD
+    drive
+    """
+    qemu_monitor = default_xqemu_xbox_app_runner.get_qemu_monitor()
+    default_xqemu_xbox_app_runner.insert_dvd(dvd_filename)
+    qemu_monitor.command.assert_called_with(
+        "blockdev-change-medium", device="ide0-cd1", filename=dvd_filename
+    )
+    default_xqemu_xbox_app_runner.eject_dvd()
+    qemu_monitor.command.assert_called_with("eject", device="ide0-cd1", force=True)
+
+
+@pytest.mark.usefixtures("mocked_qemu_monitor")
+@pytest.mark.parametrize(
+    "checkpoint_name", ("pyxboxtest_checkpoint", "menu_loaded", "other")
+)
+def test_save_and_restore_checkpoint(
+    default_xqemu_xbox_app_runner: AppRunnerWithParams, checkpoint_name: str
+):
+    """Ensure that savevm and loadvm are used to save and restore checkpoints
+    and that the time taken for each restore is recorded
+    """
+    qemu_monitor = default_xqemu_xbox_app_runner.get_qemu_monitor()
+    qemu_monitor.command.return_value = ""
+
+    default_xqemu_xbox_app_runner.save_checkpoint(checkpoint_name)
+    qemu_monitor.command.assert_called_with(
+        "human-monitor-command", **{"command-line": f"savevm {checkpoint_name}"}
+    )
+
+    restore_times = tuple(
+        default_xqemu_xbox_app_runner.restore_checkpoint(checkpoint_name)
+        for _ in range(3)
+    )
+    qemu_monitor.command.assert_called_with(
+        "human-monitor-command", **{"command-line": f"loadvm {checkpoint_name}"}
+    )
+    assert (
+        default_xqemu_xbox_app_runner.get_checkpoint_restore_times() == restore_times
+    ), "every restore was timed"
+
+
+@pytest.mark.usefixtures("mocked_qemu_monitor")
+def test_checkpoint_error(default_xqemu_xbox_app_runner: AppRunnerWithParams):
+    """Ensure that an exception is raised if XQEMU can't restore a checkpoint"""
+    qemu_monitor = default_xqemu_xbox_app_runner.get_qemu_monitor()
+    qemu_monitor.command.return_value = "Snapshot 'missing' does not exist"
+    with pytest.raises(RuntimeError):
+        default_xqemu_xbox_app_runner.restore_checkpoint("missing")
+    assert (
+        default_xqemu_xbox_app_runner.get_checkpoint_restore_times() == tuple()
+    ), "failed restore not recorded"
+
+
+@pytest.mark.skipif(os.name != "posix", reason="sockets are only inherited on POSIX")
+def test_inherited_socket_transport(
+    mocked_unused_port, mocked_xqemu_firmware, mocked_subprocess_popen, mocked_kd_capturer
+):
+    """Ensure that XQEMU is given listening sockets for KD and QMP rather than
+    port numbers, and that the KD capturer connects to the same socket
+    """
+    mocked_xqemu_firmware.get_command_line_args.return_value = tuple()
+    mocked_unused_port.return_value.get_port_number.return_value = 21
+    XQEMUXboxAppRunner._global_params = _XQEMUXboxAppRunnerGlobalParams(
+        mocked_xqemu_firmware, True
+    )
+
+    with XQEMUXboxAppRunner(
+        channel_transport=XQEMUChannelTransport.INHERITED_SOCKET
+    ) as _:
+        xqemu_params = mocked_subprocess_popen.call_args.args[0]
+        pass_fds = mocked_subprocess_popen.call_args.kwargs["pass_fds"]
+
+    assert len(pass_fds) == 2, "KD and QMP sockets inherited"
+    assert f"socket,id=kd,fd={pass_fds[0]},server" in xqemu_params
+    assert f"socket,id=qmp,fd={pass_fds[1]},server,nowait" in xqemu_params
+    assert "chardev:kd" in xqemu_params, "KD output sent to the socket"
+    kd_port = mocked_kd_capturer.call_args.args[0]
+    assert kd_port not in (0, 21), "KD capturer uses the port of the socket"
+
+
+@pytest.mark.skipif(os.name != "posix", reason="Unix sockets are only used on POSIX")
+def test_unix_socket_transport(
+    mocked_unused_port, mocked_xqemu_firmware, mocked_subprocess_popen, mocked_kd_capturer
+):
+    """Ensure that XQEMU is told to use Unix sockets for KD and QMP, that the
+    KD capturer uses the same socket and that the sockets are cleaned up
+    """
+    mocked_xqemu_firmware.get_command_line_args.return_value = tuple()
+    mocked_unused_port.return_value.get_port_number.return_value = 21
+    XQEMUXboxAppRunner._global_params = _XQEMUXboxAppRunnerGlobalParams(
+        mocked_xqemu_firmware, True
+    )
+
+    with XQEMUXboxAppRunner(
+        channel_transport=XQEMUChannelTransport.UNIX_SOCKET
+    ) as _:
+        xqemu_params = mocked_subprocess_popen.call_args.args[0]
+        kd_socket_path = mocked_kd_capturer.call_args.args[0]
+
+    sockets_dir = os.path.dirname(kd_socket_path)
+    assert os.path.dirname(sockets_dir) == get_temp_dirs().sockets_dir
+    assert f"unix:{kd_socket_path},server" in xqemu_params
+    assert (
+        f"unix:{os.path.join(sockets_dir, 'qmp.sock')},server,nowait" in xqemu_params
+    )
+    assert mocked_unused_port.call_count == 1, "only the FTP port is reserved"
+    assert not os.path.exists(sockets_dir), "cleaned up after XQEMU stops"